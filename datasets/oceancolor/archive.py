@@ -0,0 +1,384 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spatio-temporal index (SQLite R*Tree) of a local granule archive
+
+The archive is scanned once: footprint, bounds, time coverage, sensor and variables of
+each granule are stored, and the granules covering an area/period are then found
+without opening any file. Rescans only index the new or modified granules.
+
+    python archive.py index 'archive/**/*.nc' 'archive/**/*.h5' --index archive.sqlite
+    python archive.py query --index archive.sqlite --bounds 117 145 25 52 --start 2021-01-01 --end 2021-01-31
+"""
+
+import argparse
+import glob
+import json
+import os
+import sqlite3
+from datetime import timezone
+
+import numpy as np
+from dateutil.parser import parse
+
+from example import (
+    get_sensor,
+    get_times
+)
+from swathutils import Granule
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS granules (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sensor TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    variables TEXT NOT NULL,
+    footprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS granules_sensor ON granules (sensor);
+-- R*Tree bounds are float32, rounded outwards, so queries stay conservative
+CREATE VIRTUAL TABLE IF NOT EXISTS granules_rtree USING rtree(
+    id, min_lon, max_lon, min_lat, max_lat, min_time, max_time
+);
+'''
+
+
+def to_epoch(value):
+    """Seconds since 1970-01-01 UTC of a datetime or date string (naive is taken as UTC)"""
+    value = parse(value) if isinstance(value, str) else value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def get_footprint(granule: Granule, points: int = 16):
+    """Swath outline (lon/lat polygon) from the edges of the geolocation, reading only the
+    edge scan-lines/pixels (netCDF) or the tie-point grid (SGLI)
+
+    Parameters
+    ----------
+    granule: Granule
+        opened granule
+    points: int
+        number of vertices per swath edge
+
+    Returns
+    -------
+        list
+            [[lon, lat], ...] closed polygon
+    """
+    if granule.flag == 'h5':
+        lon, lat = (granule.get_tie_points(key=key) for key in granule.geo_keys)
+
+        def edge(sds, side):
+            return np.asarray((sds[0, :], sds[:, -1], sds[-1, ::-1], sds[::-1, 0])[side], np.float64)
+    else:
+        nav = granule.fid.groups['navigation_data']
+        lon, lat = (nav[key] for key in granule.geo_keys)
+
+        def edge(sds, side):
+            data = (sds[0, :], sds[:, -1], sds[-1, :][::-1], sds[:, 0][::-1])[side]
+            return np.ma.filled(np.ma.asarray(data, np.float64), np.nan)
+
+    polygon = []
+    for side in range(4):
+        x, y = edge(lon, side), edge(lat, side)
+        valid = np.isfinite(x) & np.isfinite(y)
+        x, y = x[valid], y[valid]
+        if x.size == 0:
+            continue
+        take = np.unique(np.linspace(0, x.size - 1, min(points, x.size)).astype(int))
+        polygon.extend([[round(float(x[i]), 5), round(float(y[i]), 5)] for i in take])
+    return polygon + polygon[:1]
+
+
+def clip_area(polygon: np.array, bounds: tuple):
+    """Area of a polygon clipped to a lon/lat box (Sutherland-Hodgman, the box is convex)
+
+    Parameters
+    ----------
+    polygon: np.array
+        (n, 2) lon/lat vertices
+    bounds: tuple
+        (x0, x1, y0, y1) box limits
+
+    Returns
+    -------
+        float
+            area of the intersection (square degrees), 0 if they do not intersect
+    """
+    x0, x1, y0, y1 = bounds
+    points = [tuple(point) for point in polygon]
+    # (axis, limit, sign) of the half-planes sign * (point[axis] - limit) >= 0
+    for axis, limit, sign in ((0, x0, 1), (0, x1, -1), (1, y0, 1), (1, y1, -1)):
+        if not points:
+            return 0.
+        clipped = []
+        for i, cur in enumerate(points):
+            prev = points[i - 1]
+            cur_in, prev_in = sign * (cur[axis] - limit) >= 0, sign * (prev[axis] - limit) >= 0
+            if cur_in != prev_in:
+                ratio = (limit - prev[axis]) / (cur[axis] - prev[axis])
+                clipped.append(tuple(p + ratio * (c - p) for p, c in zip(prev, cur)))
+            if cur_in:
+                clipped.append(cur)
+        points = clipped
+    if len(points) < 3:
+        return 0.
+    x, y = np.array(points).T
+    return float(abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1))) / 2)
+
+
+def footprint_intersects(footprint: list, bounds: tuple):
+    """Whether a granule footprint (see get_footprint) intersects a lon/lat box. Footprints
+    crossing the dateline are unwrapped to 0..360 and the box is tested at +/-360 too.
+    Conservative: footprints which cannot be resolved (too few vertices, polar swaths still
+    spanning more than 180 degrees once unwrapped) are kept
+
+    Parameters
+    ----------
+    footprint: list
+        [[lon, lat], ...] closed polygon
+    bounds: tuple
+        (x0, x1, y0, y1) lon/lat limits
+
+    Returns
+    -------
+        bool
+    """
+    polygon = np.asarray(footprint, np.float64).reshape(-1, 2)
+    if polygon.shape[0] < 4:
+        return True
+    lon = polygon[:, 0]
+    if np.ptp(lon) > 180.:
+        polygon[:, 0] = lon = np.mod(lon, 360.)
+        if np.ptp(lon) > 180.:
+            return True
+    x0, x1, y0, y1 = bounds
+    # point or line queries, e.g., a station, would clip to a zero area
+    x0, x1, y0, y1 = min(x0, x1 - 1e-6), max(x1, x0 + 1e-6), min(y0, y1 - 1e-6), max(y1, y0 + 1e-6)
+    return any(clip_area(polygon=polygon, bounds=(x0 + shift, x1 + shift, y0, y1)) > 0
+               for shift in (-360., 0., 360.))
+
+
+class ArchiveIndex:
+    """SQLite R*Tree index of the granules of a local archive (bounds x time), with their
+    footprint, sensor and variables
+
+    Parameters
+    ----------
+    file: str
+        SQLite database file, created if missing
+
+    Examples
+    --------
+    >>> with ArchiveIndex(file='archive.sqlite') as index:
+    ...     index.scan(patterns=['archive/**/*.nc'])
+    ...     files = index.query(bounds=(117, 145, 25, 52), start='2021-01-01', end='2021-01-31')
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.con = sqlite3.connect(file, timeout=60)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        with self.con:
+            self.con.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def add(self, file: str):
+        """Indexes (or re-indexes) one granule
+
+        Parameters
+        ----------
+        file: str
+            granule file name
+
+        Returns
+        -------
+            dict
+                the granule record
+        """
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        with Granule(file=file) as granule:
+            x0, x1, y0, y1 = granule.get_bounds()
+            start, end = get_times(granule=granule)
+            flag = 'QA_flag' if granule.flag == 'h5' else 'l2_flags'
+            record = {'file': file, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                      'sensor': get_sensor(granule=granule),
+                      'start': start.isoformat(), 'end': end.isoformat(),
+                      'variables': ','.join(granule.get_keys() + [flag]),
+                      'footprint': json.dumps(get_footprint(granule=granule))}
+
+        with self.con:
+            self.con.execute('DELETE FROM granules_rtree WHERE id IN (SELECT id FROM granules WHERE file=?)',
+                             (file,))
+            self.con.execute('DELETE FROM granules WHERE file=?', (file,))
+            cursor = self.con.execute(
+                'INSERT INTO granules (file, size, mtime, sensor, start, end, variables, footprint) '
+                'VALUES (:file, :size, :mtime, :sensor, :start, :end, :variables, :footprint)', record)
+            self.con.execute('INSERT INTO granules_rtree VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (cursor.lastrowid, float(x0), float(x1), float(y0), float(y1),
+                              to_epoch(start), to_epoch(end)))
+        return record
+
+    def scan(self, patterns: list, prune: bool = False):
+        """Indexes the new or modified granules matching patterns (size or mtime changed)
+
+        Parameters
+        ----------
+        patterns: list
+            granule file names or glob patterns (** is recursive)
+        prune: bool
+            whether to drop the indexed granules which no longer exist
+
+        Returns
+        -------
+            tuple
+                (number of granules indexed, list of (file, error) which could not be read)
+        """
+        known = {file: (size, mtime) for file, size, mtime in
+                 self.con.execute('SELECT file, size, mtime FROM granules')}
+        files = set()
+        for pattern in patterns:
+            files.update(os.path.abspath(file) for file in glob.glob(pattern, recursive=True) or [pattern])
+
+        indexed, errors = 0, []
+        for file in sorted(file for file in files if file.endswith(('.nc', '.h5')) and os.path.isfile(file)):
+            stat = os.stat(file)
+            if known.get(file) == (stat.st_size, stat.st_mtime):
+                continue
+            try:
+                self.add(file=file)
+                indexed += 1
+            except Exception as err:
+                errors.append((file, f'{type(err).__name__}: {err}'))
+
+        if prune:
+            with self.con:
+                for file in known:
+                    if not os.path.isfile(file):
+                        self.con.execute('DELETE FROM granules_rtree WHERE id IN '
+                                         '(SELECT id FROM granules WHERE file=?)', (file,))
+                        self.con.execute('DELETE FROM granules WHERE file=?', (file,))
+        return indexed, errors
+
+    def query(self, bounds: tuple = None, start=None, end=None, sensor: str = None,
+              variable: str = None, records: bool = False):
+        """Granules intersecting bounds and the period [start, end]
+
+        Parameters
+        ----------
+        bounds: tuple
+            (x0, x1, y0, y1) lon/lat limits, None for any
+        start: datetime | str
+            period start, None for open ended
+        end: datetime | str
+            period end, None for open ended
+        sensor: str
+            sensor name (see example.get_sensor), e.g., sgli, aqua
+        variable: str
+            variable the granules must contain, e.g., chlor_a
+        records: bool
+            whether to return the full records instead of the file names
+
+        Returns
+        -------
+            list
+                granule file names sorted by start time, or records (dict) if records.
+                The R*Tree candidates are refined with their footprint and exact times
+        """
+        x0, x1, y0, y1 = (-360., 360., -90., 90.) if bounds is None else bounds
+        t0 = -np.inf if start is None else to_epoch(start)
+        t1 = np.inf if end is None else to_epoch(end)
+
+        sql = ('SELECT g.file, g.size, g.mtime, g.sensor, g.start, g.end, g.variables, g.footprint '
+               'FROM granules_rtree r JOIN granules g ON g.id = r.id '
+               'WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ? '
+               'AND r.max_time >= ? AND r.min_time <= ?')
+        params = [x0, x1, y0, y1, max(t0, -1e18), min(t1, 1e18)]
+        if sensor is not None:
+            sql += ' AND g.sensor = ?'
+            params.append(sensor.lower())
+        sql += ' ORDER BY g.start'
+
+        names = 'file', 'size', 'mtime', 'sensor', 'start', 'end', 'variables', 'footprint'
+        rows = [dict(zip(names, row)) for row in self.con.execute(sql, params)]
+        if variable is not None:
+            rows = [row for row in rows if variable in row['variables'].split(',')]
+        # refinement of the R*Tree candidates: exact times (the R*Tree ones are float32) and
+        # the footprint instead of the bounding box
+        rows = [row for row in rows if (to_epoch(row['end']) >= t0) and (to_epoch(row['start']) <= t1)]
+        for row in rows:
+            row['footprint'] = json.loads(row['footprint'])
+        if bounds is not None:
+            rows = [row for row in rows if footprint_intersects(footprint=row['footprint'], bounds=bounds)]
+        if records:
+            for row in rows:
+                row['variables'] = row['variables'].split(',')
+            return rows
+        return [row['file'] for row in rows]
+
+
+def get_parser():
+    """Command line arguments of the archive index"""
+    parser = argparse.ArgumentParser(description='Spatio-temporal index of a local granule archive')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    scan = sub.add_parser('index', help='index the new or modified granules')
+    scan.add_argument('granules', nargs='+', help='granule files or glob patterns (quoted, ** is recursive)')
+    scan.add_argument('--index', default='archive.sqlite', help='index file')
+    scan.add_argument('--prune', action='store_true', help='drop the granules which no longer exist')
+
+    query = sub.add_parser('query', help='list the granules covering an area/period')
+    query.add_argument('--index', default='archive.sqlite', help='index file')
+    query.add_argument('--bounds', nargs=4, type=float, default=None,
+                       metavar=('X0', 'X1', 'Y0', 'Y1'), help='lon/lat limits')
+    query.add_argument('--start', default=None, help='period start, e.g., 2021-01-01')
+    query.add_argument('--end', default=None, help='period end, e.g., 2021-01-31T23:59:59')
+    query.add_argument('--sensor', default=None, help='sensor, e.g., sgli, aqua')
+    query.add_argument('--variable', default=None, help='variable the granules must contain')
+    return parser
+
+
+def main(argv: list = None):
+    args = get_parser().parse_args(argv)
+    with ArchiveIndex(file=args.index) as index:
+        if args.command == 'index':
+            indexed, errors = index.scan(patterns=args.granules, prune=args.prune)
+            for file, error in errors:
+                print(f'{file}: {error}')
+            print(f'{indexed} granules indexed, {len(errors)} errors')
+            return 1 if errors else 0
+
+        for file in index.query(bounds=args.bounds, start=args.start, end=args.end,
+                                sensor=args.sensor, variable=args.variable):
+            print(file)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,108 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the SGLI DN to physical value decode (swathutils.decode_dn)
+
+Compares the time and peak memory of decoding one synthetic 250 m SGLI band
+with the previous implementation (np.where mask chain, float64 conversion).
+
+    python bench_decode.py --shape 4980 5000 --repeat 5
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from swathutils import decode_dn
+
+# NWLR-like attributes of an SGLI L2 Image_data variable
+ATTRS = {'Error_DN': np.array([65535], np.uint16),
+         'Land_DN': np.array([65534], np.uint16),
+         'Cloud_error_DN': np.array([65533], np.uint16),
+         'Retrieval_error_DN': np.array([65532], np.uint16),
+         'Minimum_valid_DN': np.array([0], np.uint16),
+         'Maximum_valid_DN': np.array([65531], np.uint16)}
+SLOPE, OFFSET = np.float32(2e-6), np.float32(-0.01)
+
+
+def legacy_decode(sdn: np.ndarray, attrs: dict, slope: float, offset: float, fill_value: float):
+    """DN decode as done by get_data before decode_dn"""
+    attrs = dict(attrs)
+    mask = np.bool_(np.zeros(sdn.shape))
+    if 'Error_DN' in attrs.keys():
+        mask = mask | np.where(np.equal(sdn, attrs.pop('Error_DN')[0]), True, False)
+    if 'Land_DN' in attrs.keys():
+        mask = mask | np.where(np.equal(sdn, attrs.pop('Land_DN')[0]), True, False)
+    if 'Cloud_error_DN' in attrs.keys():
+        mask = mask | np.where(np.equal(sdn, attrs.pop('Cloud_error_DN')[0]), True, False)
+    if 'Retrieval_error_DN' in attrs.keys():
+        mask = mask | np.where(np.equal(sdn, attrs.pop('Retrieval_error_DN')[0]), True, False)
+    if ('Minimum_valid_DN' in attrs.keys()) and ('Maximum_valid_DN' in attrs.keys()):
+        mask = mask | np.where((sdn < attrs.pop('Minimum_valid_DN')) |
+                               (sdn > attrs.pop('Maximum_valid_DN')), True, False)
+    sds = sdn * slope + offset
+    sds[mask] = fill_value
+    return np.ma.masked_where(mask, sds).astype(np.float32)
+
+
+def synthetic_band(shape: tuple, seed: int = 0):
+    """uint16 DNs with ~30 % land/cloud/error sentinels"""
+    rng = np.random.default_rng(seed)
+    sdn = rng.integers(0, 20000, size=shape, dtype=np.uint16)
+    sentinel = rng.random(size=shape)
+    sdn[sentinel < 0.2] = 65534
+    sdn[(sentinel >= 0.2) & (sentinel < 0.28)] = 65533
+    sdn[(sentinel >= 0.28) & (sentinel < 0.3)] = 65535
+    return sdn
+
+
+def measure(func, sdn: np.ndarray, repeat: int):
+    """Best wall time (s) and peak traced memory (MB) of decoding sdn"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(sdn, ATTRS, SLOPE, OFFSET, np.float32(-32767))
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(sdn, ATTRS, SLOPE, OFFSET, np.float32(-32767))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='SGLI DN decode micro-benchmark')
+    parser.add_argument('--shape', nargs=2, type=int, default=(4980, 5000),
+                        help='band size in lines, pixels (250 m SGLI granule ~ 4980 x 5000)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed repetitions')
+    args = parser.parse_args(argv)
+
+    sdn = synthetic_band(shape=tuple(args.shape))
+    before = legacy_decode(sdn, ATTRS, SLOPE, OFFSET, np.float32(-32767))
+    after = decode_dn(sdn, ATTRS, SLOPE, OFFSET, np.float32(-32767))
+    assert np.array_equal(before.mask, after.mask)
+    assert np.allclose(before.filled(), after.filled(), rtol=1e-6)
+
+    print(f'band {args.shape[0]} x {args.shape[1]} ({sdn.nbytes / 2 ** 20:.0f} MB of DN)')
+    print(f"{'':>8} {'time (s)':>10} {'peak (MB)':>10}")
+    for name, func in (('before', legacy_decode), ('after', decode_dn)):
+        seconds, peak = measure(func=func, sdn=sdn, repeat=args.repeat)
+        print(f'{name:>8} {seconds:>10.3f} {peak:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,545 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Performance benchmark of the swath pipeline (swathutils/example)
+
+Generates synthetic MODIS-like netCDF and SGLI-like hdf5 granules, then times each
+stage (get_geo, get_data, swath_resample, flags_band, write_tif and the end-to-end
+swath_pyresample_gdaltrans) in its own process, so that the peak RSS of a stage is
+not hidden by the previous ones. The peak is reset after the untimed setup of the stage
+(Linux), and its growth over the RSS at the start of the stage is reported too. Results are written as JSON and can be compared
+between commits.
+
+    python benchmark.py run --sensor modis sgli --repeat 3 --output before.json
+    python benchmark.py run --output after.json
+    python benchmark.py compare before.json after.json
+
+The kernels command checks the multi-band gauss and mean resampling against nearest.
+
+    python benchmark.py kernels
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import h5py
+import numpy as np
+from netCDF4 import Dataset
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAGES = ('get_geo', 'get_data', 'swath_resample', 'flags_band', 'write_tif', 'end_to_end')
+
+# granule sizes in lines, pixels (MODIS 1 km, SGLI 250 m is ~4980 x 5000)
+SIZES = {'modis': (2030, 1354), 'sgli': (2000, 2500)}
+# RSS (MB) when the timed section of the stage starts (see timer)
+_RSS = {'baseline': None}
+BOUNDS = {'x0': 130., 'x1': 140., 'y0': 30., 'y1': 40.}
+BANDS = (412, 443, 490, 530, 565, 670)
+
+
+# -------------------
+# synthetic granules
+# -------------------
+def swath_lonlat(lines: int, pixels: int, bounds: dict = None):
+    """Skewed swath geolocation covering bounds
+
+    Parameters
+    ----------
+    lines: int
+        number of scan lines
+    pixels: int
+        number of pixels per line
+    bounds: dict
+        x0, x1, y0, y1 limits of the swath
+
+    Returns
+    -------
+        tuple
+            lon, lat (lines, pixels) float32
+    """
+    bounds = BOUNDS if bounds is None else bounds
+    row = np.linspace(0, 1, lines, dtype=np.float32).reshape(-1, 1)
+    col = np.linspace(0, 1, pixels, dtype=np.float32).reshape(1, -1)
+    width = bounds['x1'] - bounds['x0']
+    lon = bounds['x0'] + 0.9 * width * col + 0.1 * width * row
+    lat = bounds['y1'] - (bounds['y1'] - bounds['y0']) * row + 0.05 * width * (col - 0.5) ** 2
+    return lon.astype(np.float32), lat.astype(np.float32)
+
+
+def make_modis(file: str, lines: int, pixels: int, seed: int = 0):
+    """Writes a MODIS-like level-2 netCDF granule (Rrs, chlor_a, l2_flags)
+
+    Parameters
+    ----------
+    file: str
+        output netCDF file
+    lines: int
+        number of scan lines
+    pixels: int
+        number of pixels per line
+    seed: int
+        random seed
+
+    Returns
+    -------
+        str
+            file
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = swath_lonlat(lines=lines, pixels=pixels)
+    with Dataset(file, 'w') as nc:
+        nc.setncatts({'platform': 'Aqua', 'spatialResolution': '1 km',
+                      'time_coverage_start': '2021-01-01T03:00:00.000Z',
+                      'time_coverage_end': '2021-01-01T03:05:00.000Z',
+                      'geospatial_lon_min': float(lon.min()), 'geospatial_lon_max': float(lon.max()),
+                      'geospatial_lat_min': float(lat.min()), 'geospatial_lat_max': float(lat.max()),
+                      'westernmost_longitude': float(lon.min()), 'easternmost_longitude': float(lon.max()),
+                      'southernmost_latitude': float(lat.min()), 'northernmost_latitude': float(lat.max()),
+                      'start_center_longitude': float(lon[0].mean()),
+                      'start_center_latitude': float(lat[0].mean()),
+                      'end_center_longitude': float(lon[-1].mean()),
+                      'end_center_latitude': float(lat[-1].mean())})
+        nc.createDimension('number_of_lines', lines)
+        nc.createDimension('pixels_per_line', pixels)
+        dims = 'number_of_lines', 'pixels_per_line'
+
+        nav = nc.createGroup('navigation_data')
+        for name, data in (('longitude', lon), ('latitude', lat)):
+            var = nav.createVariable(name, 'f4', dims, fill_value=-999.)
+            var[:] = data
+
+        geo = nc.createGroup('geophysical_data')
+        land = rng.random((lines, pixels)) < 0.2
+        for band in BANDS:
+            var = geo.createVariable(f'Rrs_{band}', 'i2', dims, fill_value=-32767, zlib=True)
+            var.setncatts({'scale_factor': np.float32(2e-6), 'add_offset': np.float32(0.05),
+                           'units': 'sr^-1', 'long_name': f'Remote sensing reflectance at {band} nm'})
+            var[:] = np.ma.masked_where(land, rng.uniform(0, 0.02, (lines, pixels)))
+        var = geo.createVariable('chlor_a', 'f4', dims, fill_value=-32767., zlib=True)
+        var.setncatts({'units': 'mg m^-3', 'long_name': 'Chlorophyll Concentration, OCI Algorithm'})
+        var[:] = np.ma.masked_where(land, rng.lognormal(0, 1, (lines, pixels)))
+
+        names = ('ATMFAIL LAND PRODWARN HIGLINT HILT HISATZEN COASTZ SPARE STRAYLIGHT CLDICE '
+                 'COCCOLITH TURBIDW HISOLZEN SPARE LOWLW CHLFAIL NAVWARN ABSAER SPARE MAXAERITER '
+                 'MODGLINT CHLWARN ATMWARN SPARE SEAICE NAVFAIL FILTER SPARE BOWTIEDEL HIPOL '
+                 'PRODFAIL SPARE')
+        var = geo.createVariable('l2_flags', 'i4', dims, zlib=True)
+        var.setncatts({'flag_masks': np.int32(1) << np.arange(31, dtype=np.int32),
+                       'flag_meanings': names})
+        var[:] = rng.integers(0, 1 << 20, (lines, pixels), dtype=np.int32) | np.where(land, 2, 0)
+    return file
+
+
+def make_sgli(file: str, lines: int, pixels: int, interval: int = 10, seed: int = 0):
+    """Writes an SGLI-like level-2 IWPR hdf5 granule (NWLR, CHLA, QA_flag, tie-point geolocation)
+
+    Parameters
+    ----------
+    file: str
+        output hdf5 file
+    lines: int
+        number of scan lines
+    pixels: int
+        number of pixels per line
+    interval: int
+        tie-point resampling interval
+    seed: int
+        random seed
+
+    Returns
+    -------
+        str
+            file
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = swath_lonlat(lines=lines // interval + 1, pixels=pixels // interval + 1)
+
+    def strings(val: str):
+        return np.array([val.encode()])
+
+    dn = {'Error_DN': np.array([65535], np.uint16), 'Land_DN': np.array([65534], np.uint16),
+          'Cloud_error_DN': np.array([65533], np.uint16),
+          'Retrieval_error_DN': np.array([65532], np.uint16),
+          'Minimum_valid_DN': np.array([0], np.uint16), 'Maximum_valid_DN': np.array([65531], np.uint16)}
+
+    with h5py.File(file, 'w') as h5:
+        glob = h5.create_group('Global_attributes')
+        glob.attrs.update({'Satellite': strings('Global Change Observation Mission - Climate (GCOM-C)'),
+                           'Sensor': strings('Second-generation Global Imager (SGLI)'),
+                           'Scene_start_time': strings('20210101 01:00:00.000'),
+                           'Scene_end_time': strings('20210101 01:05:00.000')})
+
+        geom = h5.create_group('Geometry_data')
+        for name, data in (('Longitude', lon), ('Latitude', lat)):
+            dset = geom.create_dataset(name, data=data)
+            dset.attrs.update({'Resampling_interval': np.array([interval], np.int32),
+                               'Unit': strings('degree')})
+
+        image = h5.create_group('Image_data')
+        image.attrs.update({'Number_of_lines': np.array([lines], np.int32),
+                            'Number_of_pixels': np.array([pixels], np.int32)})
+        sentinel = rng.random((lines, pixels))
+        for band in BANDS:
+            sdn = rng.integers(0, 20000, (lines, pixels), dtype=np.uint16)
+            sdn[sentinel < 0.2] = 65534
+            sdn[(sentinel >= 0.2) & (sentinel < 0.25)] = 65533
+            dset = image.create_dataset(f'NWLR_{band}', data=sdn, chunks=True, compression='gzip')
+            dset.attrs.update({**dn, 'Rrs_slope': np.array([2e-6], np.float32),
+                               'Rrs_offset': np.array([-0.01], np.float32),
+                               'Unit': strings('sr^-1')})
+        sdn = rng.integers(0, 30000, (lines, pixels), dtype=np.uint16)
+        sdn[sentinel < 0.2] = 65534
+        dset = image.create_dataset('CHLA', data=sdn, chunks=True, compression='gzip')
+        dset.attrs.update({**dn, 'Slope': np.array([0.0016], np.float32),
+                           'Offset': np.array([-0.05], np.float32), 'Unit': strings('mg/m^3')})
+
+        flags = rng.integers(0, 1 << 15, (lines, pixels), dtype=np.uint16)
+        dset = image.create_dataset('QA_flag', data=flags, chunks=True, compression='gzip')
+        description = ''.join(f'Bit-{i}) FLAG{i:02}: synthetic flag {i}\n' for i in range(16))
+        dset.attrs.update({'Error_DN': np.array([0], np.uint16),
+                           'Data_description': strings(description)})
+    return file
+
+
+def make_granule(sensor: str, workdir: str, lines: int, pixels: int):
+    """Writes the synthetic granule of sensor into workdir (once per size)"""
+    ext = 'h5' if sensor == 'sgli' else 'nc'
+    file = f'{workdir}/{sensor}_{lines}x{pixels}.{ext}'
+    if not os.path.isfile(file):
+        make = make_sgli if sensor == 'sgli' else make_modis
+        make(file=file, lines=lines, pixels=pixels)
+    return file
+
+
+# ------------
+# stage runner
+# ------------
+def proc_status(field: str):
+    """Value (MB) of a /proc/self/status memory field, e.g., VmRSS or VmHWM (Linux only)"""
+    try:
+        with open('/proc/self/status') as txt:
+            for line in txt:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return None
+
+
+def timer():
+    """Starts the timed section of a stage: frees the setup temporaries and resets the peak
+    RSS (Linux), so that the memory of the setup is not reported as the stage memory
+
+    Returns
+    -------
+        float
+            perf_counter start time
+    """
+    gc.collect()
+    try:
+        # '5' resets the peak RSS (VmHWM) of the process to its current RSS
+        with open('/proc/self/clear_refs', 'w') as txt:
+            txt.write('5')
+    except OSError:
+        pass
+    _RSS['baseline'] = proc_status(field='VmRSS')
+    return time.perf_counter()
+
+
+def peak_rss():
+    """Peak RSS (MB) since timer where it can be reset (Linux), of the process otherwise"""
+    peak = proc_status(field='VmHWM')
+    if (peak is None) and (resource is not None):
+        # ru_maxrss is in kB on Linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+    return peak
+
+
+def run_stage(stage: str, file: str, workdir: str, epsilon: float = 0.3):
+    """Runs one pipeline stage on file, timing only the stage itself
+
+    Parameters
+    ----------
+    stage: str
+        one of STAGES
+    file: str
+        synthetic granule
+    workdir: str
+        directory of the temporary outputs
+    epsilon: float
+        allowed uncertainty in the neighbour search
+
+    Returns
+    -------
+        float
+            stage wall time in seconds
+    """
+    from example import swath_pyresample_gdaltrans
+    from swathutils import (
+        Granule,
+        create_dataset,
+        flags_band,
+        swath_resample,
+        write_tif
+    )
+
+    subarea = {**BOUNDS, 'area_id': 'bench', 'area_name': 'bench', 'proj_id': 'EPSG:4326'}
+    flag = 'QA_flag' if file.endswith('.h5') else 'l2_flags'
+    dst_tif = f'{workdir}/{stage}.tif'
+
+    with Granule(file=file, subarea=subarea) as granule:
+        keys = granule.get_keys()
+        if stage == 'get_geo':
+            start = timer()
+            for key in granule.geo_keys:
+                granule.get_geo(key=key)
+            return time.perf_counter() - start
+
+        if stage == 'get_data':
+            start = timer()
+            for key in keys + [flag]:
+                granule.get_data(key=key)
+            return time.perf_counter() - start
+
+        if stage == 'end_to_end':
+            start = timer()
+            for job in (keys, [flag]):
+                swath_pyresample_gdaltrans(file=file, var=job, subarea=subarea, epsilon=epsilon,
+                                           src_tif=f'/vsimem/{stage}.tif', dst_tif=dst_tif,
+                                           granule=granule)
+            return time.perf_counter() - start
+
+        dataset = create_dataset(file=file, key=[flag] if stage == 'flags_band' else keys,
+                                 subarea=subarea, granule=granule)
+        dataset['epsilon'] = epsilon
+        if stage == 'flags_band':
+            start = timer()
+            flags_band(dataset=dataset, key=flag, src_tif=f'/vsimem/{stage}.tif', dst_tif=dst_tif)
+            return time.perf_counter() - start
+
+        proj = dataset.pop('proj')
+        metadata = {key: dataset.pop(key) for key in keys}
+        metadata['glob_attrs'] = dataset.pop('glob_attrs')
+        start = timer()
+        result = swath_resample(swath=dataset, trg_proj=proj)
+        if stage == 'swath_resample':
+            return time.perf_counter() - start
+
+        start = timer()
+        write_tif(file=dst_tif, dataset=result, metadata=metadata, area_def=proj, cog=True)
+        return time.perf_counter() - start
+
+
+def stage_process(args):
+    """Child process entry: prints the stage time, peak RSS of the timed section and its growth
+    over the RSS at the start of the section as one JSON line"""
+    seconds = run_stage(stage=args.stage, file=args.file, workdir=args.workdir)
+    maxrss, baseline = peak_rss(), _RSS['baseline']
+    growth = None if (maxrss is None) or (baseline is None) else maxrss - baseline
+    print(json.dumps({'seconds': seconds, 'maxrss_mb': maxrss or 0., 'growth_mb': growth}))
+
+
+def check_kernels(lines: int = 400, pixels: int = 300, bands: int = 3, seed: int = 0):
+    """Resamples a smooth multi-band swath field with the gauss and mean kernels and compares
+    them with nearest: same grid and coverage, values within the field change over the
+    search radius, and each band scaled like the source bands (no channel mixing)
+
+    Parameters
+    ----------
+    lines: int
+        number of scan lines
+    pixels: int
+        number of pixels per line
+    bands: int
+        number of bands, band b is (b + 1) * (lon + lat)
+    seed: int
+        random seed of the masked pixels
+
+    Returns
+    -------
+        dict
+            {method: largest absolute difference with nearest}
+    """
+    from swathutils import (
+        get_adef,
+        get_neighbours,
+        swath_resample
+    )
+
+    lon, lat = swath_lonlat(lines=lines, pixels=pixels)
+    mask = np.random.default_rng(seed).random((lines, pixels)) < 0.1
+    field = (lon + lat).astype(np.float32)
+    channels = np.ma.dstack([np.ma.masked_where(mask, (b + 1) * field) for b in range(bands)])
+
+    # swath pixels are ~3 km apart
+    radius = 3000.
+    subarea = {**BOUNDS, 'area_id': 'bench', 'area_name': 'bench', 'proj_id': 'EPSG:4326'}
+    proj = get_adef(pixel_resolution=radius, subarea=subarea)
+    swath = {'longitude': lon, 'latitude': lat, 'radius_of_influence': radius, 'epsilon': 0.}
+    neighbour_info = get_neighbours(swath=swath, trg_proj=proj, neighbours=8)
+
+    results = {}
+    for method in ('nearest', 'gauss', 'mean'):
+        results[method] = swath_resample(swath={**swath, 'channels': channels.copy()}, trg_proj=proj,
+                                         neighbour_info=neighbour_info, method=method)
+        assert results[method].shape == proj.shape + (bands,), f'{method}: {results[method].shape}'
+
+    nearest = results.pop('nearest')
+    # (lon + lat) changes by less than 0.1 deg per band unit within the 2 x radius search
+    tolerance = 0.1 * np.arange(1, bands + 1)
+    differences = {}
+    for method, result in results.items():
+        both = ~(np.ma.getmaskarray(result) | np.ma.getmaskarray(nearest))
+        assert both[..., 0].sum() >= 0.9 * (~np.ma.getmaskarray(nearest)[..., 0]).sum(), \
+            f'{method}: coverage lost'
+        diff = np.abs(np.ma.getdata(result) - np.ma.getdata(nearest))
+        for b in range(bands):
+            assert diff[..., b][both[..., b]].max() <= tolerance[b], f'{method}: band {b} off nearest'
+            scaled = np.ma.getdata(result)[..., 0][both[..., b]] * (b + 1)
+            assert np.allclose(np.ma.getdata(result)[..., b][both[..., b]], scaled, rtol=1e-5), \
+                f'{method}: band {b} mixed with another band'
+        differences[method] = float(diff[both].max())
+        print(f'{method:>8}: {both[..., 0].sum()} pixels, max |{method} - nearest| = {differences[method]:.4f}')
+    return differences
+
+
+def git_commit():
+    """Current commit of the working tree, if any"""
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    """Generates the granules and runs every stage repeat times, each in a fresh process"""
+    workdir = args.workdir or tempfile.mkdtemp(prefix='oceancolor_bench_')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    for sensor in args.sensor:
+        lines, pixels = args.size or SIZES[sensor]
+        file = make_granule(sensor=sensor, workdir=workdir, lines=lines, pixels=pixels)
+        for stage in args.stage:
+            runs = []
+            for _ in range(args.repeat):
+                cmd = [sys.executable, os.path.abspath(__file__), 'stage',
+                       '--stage', stage, '--file', file, '--workdir', workdir]
+                out = subprocess.run(cmd, capture_output=True, text=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+                if out.returncode != 0:
+                    raise RuntimeError(f'{sensor}/{stage} failed:\n{out.stderr}')
+                runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+            seconds = [item['seconds'] for item in runs]
+            result = {'sensor': sensor, 'stage': stage, 'lines': lines, 'pixels': pixels,
+                      'seconds': seconds, 'best': min(seconds), 'median': float(np.median(seconds)),
+                      'maxrss_mb': max(item['maxrss_mb'] for item in runs),
+                      'growth_mb': max((item.get('growth_mb') or 0. for item in runs), default=0.)}
+            results.append(result)
+            print(f"{sensor:>6} {stage:>15} {result['best']:>9.3f} s {result['maxrss_mb']:>9.0f} MB "
+                  f"(+{result['growth_mb']:.0f} MB)")
+
+    report = {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as txt:
+            json.dump(report, txt, indent=2)
+    return report
+
+
+def compare(args):
+    """Prints the time and memory ratios (new / old) of two benchmark reports. Returns the
+    number of stages slower or larger than the threshold"""
+    reports = []
+    for file in (args.old, args.new):
+        with open(file) as txt:
+            reports.append(json.load(txt))
+    old, new = ({(item['sensor'], item['stage'], item['lines'], item['pixels']): item
+                 for item in report['results']} for report in reports)
+
+    print(f"{reports[0]['commit']} -> {reports[1]['commit']}")
+    print(f"{'sensor':>6} {'stage':>15} {'time':>8} {'memory':>8}")
+    regressions = 0
+    for key in (key for key in new if key in old):
+        time_ratio = new[key]['best'] / max(old[key]['best'], 1e-9)
+        mem_ratio = new[key]['maxrss_mb'] / max(old[key]['maxrss_mb'], 1e-9)
+        flag = ''
+        if max(time_ratio, mem_ratio) > 1 + args.threshold:
+            regressions += 1
+            flag = '  <-- regression'
+        print(f'{key[0]:>6} {key[1]:>15} {time_ratio:>7.2f}x {mem_ratio:>7.2f}x{flag}')
+    return regressions
+
+
+def get_parser():
+    """Command line arguments of the benchmark"""
+    parser = argparse.ArgumentParser(description='Swath pipeline benchmark')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    bench = sub.add_parser('run', help='generate the granules and time every stage')
+    bench.add_argument('--sensor', nargs='+', choices=tuple(SIZES), default=tuple(SIZES))
+    bench.add_argument('--stage', nargs='+', choices=STAGES, default=STAGES)
+    bench.add_argument('--size', nargs=2, type=int, default=None, metavar=('LINES', 'PIXELS'),
+                       help='granule size, defaults to a MODIS (2030 x 1354) or reduced SGLI granule')
+    bench.add_argument('--repeat', type=int, default=3, help='runs (processes) per stage')
+    bench.add_argument('--workdir', default=None, help='granules and outputs, defaults to a temp dir')
+    bench.add_argument('--output', default=None, help='JSON report')
+
+    cmp = sub.add_parser('compare', help='compare two JSON reports')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+    cmp.add_argument('--threshold', type=float, default=0.1,
+                     help='relative slow down/memory growth reported as regression')
+
+    sub.add_parser('kernels', help='check the multi-band gauss and mean resampling against nearest')
+
+    stage = sub.add_parser('stage', help=argparse.SUPPRESS)
+    stage.add_argument('--stage', choices=STAGES, required=True)
+    stage.add_argument('--file', required=True)
+    stage.add_argument('--workdir', required=True)
+    return parser
+
+
+def main(argv: list = None):
+    args = get_parser().parse_args(argv)
+    if args.command == 'stage':
+        return stage_process(args)
+    if args.command == 'compare':
+        return 1 if compare(args) else 0
+    if args.command == 'kernels':
+        check_kernels()
+        return 0
+    run(args)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
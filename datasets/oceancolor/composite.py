@@ -0,0 +1,313 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Daily composites of the resampled granules
+
+The granules of one sensor and day are resampled onto the shared target grid and
+accumulated in memory (latest valid value, mean and count per pixel), then one
+geotif is written per variable and day instead of one per granule.
+"""
+
+import os
+from collections import defaultdict
+
+import numpy as np
+from pyresample import AreaDefinition
+
+from example import (
+    get_sensor,
+    get_times,
+    get_var_names
+)
+from swathutils import (
+    Granule,
+    create_dataset,
+    gdal_translate,
+    swath_resample,
+    write_tif
+)
+
+
+class Composite:
+    """Per pixel latest valid value, sum and count of the granules resampled onto one grid.
+    Flags are only composited as latest and count. Granules are expected in time order
+    (see group_by_day), an older granule only fills the pixels without data
+
+    Memory is about 10 bytes per pixel and variable (float32 latest and sum, uint16 count)
+
+    Parameters
+    ----------
+    area_def: AreaDefinition
+        target grid shared by the granules
+    keys: list
+        variable (band) names
+    attrs: dict
+        attributes of each variable, with _FillValue
+    flags: bool
+        whether the variables are bit flags
+    """
+
+    def __init__(self, area_def: AreaDefinition, keys: list, attrs: dict, flags: bool = False):
+        shape = area_def.shape + (len(keys),)
+        self.area_def = area_def
+        self.keys = list(keys)
+        self.attrs = attrs
+        self.flags = flags
+        self.fill_values = [attrs[key]['_FillValue'] for key in self.keys]
+        dtype = np.int32 if flags else np.float32
+
+        self.latest = np.empty(shape, dtype)
+        for i, fill_value in enumerate(self.fill_values):
+            self.latest[..., i] = fill_value
+        self.total = None if flags else np.zeros(shape, np.float32)
+        self.count = np.zeros(shape, np.uint16)
+        self.start = self.end = None
+        self.granules = []
+
+    @property
+    def stats(self):
+        """Statistics written per variable"""
+        return ('latest', 'count') if self.flags else ('latest', 'mean', 'count')
+
+    def add(self, result: np.ma.MaskedArray, start, end, granule: str = None):
+        """Accumulates one resampled granule
+
+        Parameters
+        ----------
+        result: np.ma.MaskedArray
+            resampled data on area_def, (rows, cols) or (rows, cols, len(keys))
+        start: datetime
+            granule start time
+        end: datetime
+            granule end time
+        granule: str
+            granule name, kept for the composite metadata
+
+        Returns
+        -------
+            None
+        """
+        data = np.ma.getdata(result).reshape(self.latest.shape)
+        valid = ~np.ma.getmaskarray(result).reshape(self.latest.shape)
+
+        if (self.start is not None) and (start < self.start):
+            # older than the granules already added, fill the gaps only
+            np.copyto(self.latest, data, where=valid & (self.count == 0), casting='unsafe')
+        else:
+            np.copyto(self.latest, data, where=valid, casting='unsafe')
+        if self.total is not None:
+            np.add(self.total, data, out=self.total, where=valid, casting='unsafe')
+        self.count += valid
+
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+        if granule is not None:
+            self.granules.append(granule)
+
+    def get(self, key: str):
+        """Composite of one variable
+
+        Parameters
+        ----------
+        key: str
+            variable name
+
+        Returns
+        -------
+            dict
+                {statistic: masked array} with latest and count, and mean for continuous variables
+        """
+        i = self.keys.index(key)
+        count = self.count[..., i]
+        empty = count == 0
+        stats = {'latest': np.ma.masked_where(empty, self.latest[..., i])}
+        if 'mean' in self.stats:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = self.total[..., i] / count
+            stats['mean'] = np.ma.masked_where(empty, mean.astype(np.float32))
+        stats['count'] = np.ma.masked_array(count.astype(np.int32 if self.flags else np.float32))
+        return stats
+
+    def write(self, file: str, key: str, glob_attrs: dict):
+        """Writes the composite of one variable as a geotif with one band per statistic
+        (<key>_latest, <key>_mean, <key>_count)
+
+        Parameters
+        ----------
+        file: str
+            output geotif. Written as COG if area_def is EPSG:4326, warped (see gdal_translate) otherwise
+        key: str
+            variable name
+        glob_attrs: dict
+            global attributes of the composite
+
+        Returns
+        -------
+            dict
+                global and band attributes (see write_tif)
+        """
+        stats = self.get(key=key)
+        metadata, fill_values = {}, []
+        for stat in stats:
+            attrs = dict(self.attrs[key])
+            if stat == 'count':
+                attrs = {'_FillValue': 0, 'long_name': f'number of valid {key} observations'}
+            attrs['composite'] = stat
+            metadata[f'{key}_{stat}'] = attrs
+            fill_values.append(attrs['_FillValue'])
+        metadata['glob_attrs'] = {**glob_attrs,
+                                  'time_coverage_start': self.start, 'time_coverage_end': self.end,
+                                  'composite_granules': ','.join(self.granules)}
+
+        data_type = 'Int32' if self.flags else 'Float32'
+        dataset = np.ma.dstack(list(stats.values()))
+        direct = self.area_def.crs.to_epsg() == 4326
+        src_tif = f"/vsimem/{os.path.basename(file)}"
+        meta = write_tif(file=file if direct else src_tif, dataset=dataset, metadata=metadata,
+                         area_def=self.area_def, data_type=data_type, cog=direct)
+        if not direct:
+            gdal_translate(src_tif=src_tif, dst_tif=file, nodata=fill_values, ot=data_type)
+        return meta
+
+
+def group_by_day(files: list):
+    """Groups granules by sensor and (UTC) day of their start time
+
+    Parameters
+    ----------
+    files: list
+        granule files
+
+    Returns
+    -------
+        dict
+            {(sensor, YYYYMMDD): files sorted by start time}
+    """
+    groups = defaultdict(list)
+    for file in files:
+        with Granule(file=file) as granule:
+            start, _ = get_times(granule=granule)
+            groups[(get_sensor(granule=granule), start.strftime('%Y%m%d'))].append((start, file))
+    return {key: [file for _, file in sorted(items)] for key, items in groups.items()}
+
+
+def resample_granule(granule: Granule, subarea: dict, epsilon: float, method: str = 'nearest',
+                     cache_dir: str = None):
+    """Resamples the geophysical variables, then the flags, of a granule onto the subarea grid
+    in memory, with one neighbour search shared by both
+
+    Parameters
+    ----------
+    granule: Granule
+        opened granule
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    epsilon: float
+        allowed uncertainty in the neighbour search
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean (see swath_resample)
+    cache_dir: str
+        directory where the granule neighbour info is persisted for reruns
+
+    Returns
+    -------
+        generator
+            dicts with names (EE band names, see get_var_names), attrs (per name), glob_attrs,
+            proj (target grid), result (masked array, rows x cols x bands) and flags (bool)
+    """
+    neighbours = 1 if method == 'nearest' else 8
+    keys = [key for key in granule.get_keys() if key not in ('CDOM', 'TSM',)]
+    flag = ['QA_flag'] if granule.flag == 'h5' else ['l2_flags']
+
+    for job in (keys, flag):
+        dataset = create_dataset(file=granule.file, key=job, subarea=subarea, granule=granule)
+        dataset['epsilon'] = epsilon
+        neighbour_info = granule.get_neighbours(
+            swath=dataset, trg_proj=dataset['proj'], cache_dir=cache_dir, neighbours=neighbours)
+
+        proj = dataset.pop('proj')
+        glob_attrs = dataset.pop('glob_attrs')
+        names = get_var_names(keys=job)
+        attrs = {name: dataset.pop(key) for name, key in zip(names, job)}
+        result = swath_resample(swath=dataset, trg_proj=proj, neighbour_info=neighbour_info,
+                                method='nearest' if job is flag else method)
+        yield {'names': names, 'attrs': attrs, 'glob_attrs': glob_attrs, 'proj': proj,
+               'result': result.reshape(proj.shape + (len(names),)), 'flags': job is flag}
+
+
+def composite_day(files: list, subarea: dict, epsilon: float, cwdir: str,
+                  method: str = 'nearest', cache_dir: str = None):
+    """Resamples the granules of one sensor and day onto the subarea grid and writes one
+    daily composite per variable (see Composite)
+
+    Parameters
+    ----------
+    files: list
+        granules of one sensor and day, in time order (see group_by_day)
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    epsilon: float
+        allowed uncertainty in the neighbour search
+    cwdir: str
+        output directory, the composites go into a sub-directory named <sensor>_<YYYYMMDD>
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean (see swath_resample)
+    cache_dir: str
+        directory where the granule neighbour info is persisted for reruns
+
+    Returns
+    -------
+        list:
+            one dict per composite geotif with keys file, sat, var_name (EE band names),
+            attributes, start, end and skipped, as process_granule
+    """
+    composites, glob_attrs, sat = {}, {}, None
+
+    # -----------------------
+    # resample and accumulate
+    # -----------------------
+    for file in files:
+        with Granule(file=file, subarea=subarea) as granule:
+            if granule.get_overlap(subarea=subarea) == 0:
+                continue
+            sat = get_sensor(granule=granule)
+            start, end = get_times(granule=granule)
+
+            for band in resample_granule(granule=granule, subarea=subarea, epsilon=epsilon,
+                                         method=method, cache_dir=cache_dir):
+                names, glob_attrs = band['names'], band['glob_attrs']
+                if tuple(names) not in composites:
+                    composites[tuple(names)] = Composite(area_def=band['proj'], keys=names,
+                                                         attrs=band['attrs'], flags=band['flags'])
+                composites[tuple(names)].add(result=band['result'], start=start, end=end,
+                                             granule=os.path.basename(file))
+
+    # -----------------------
+    # one geotif per variable
+    # -----------------------
+    outputs = []
+    for composite in composites.values():
+        day = composite.start.strftime('%Y%m%d')
+        outdir = os.path.abspath(f'{cwdir}/{sat}_{day}')
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        for key in composite.keys:
+            trg_file = f'{outdir}/{sat}_{day}_{key}.tif'
+            attributes = composite.write(file=trg_file, key=key, glob_attrs=glob_attrs)
+            outputs.append({'file': trg_file, 'sat': sat,
+                            'var_name': [f'{key}_{stat}' for stat in composite.stats],
+                            'attributes': attributes, 'start': composite.start, 'end': composite.end,
+                            'skipped': False})
+    return outputs
@@ -0,0 +1,272 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Append-only Zarr time-series cube of the resampled granules
+
+Each variable is a (time, y, x) array on the fixed get_adef grid, chunked one time step
+per chunk and compressed. A granule appends one time step: the time index is allocated
+under a file lock (resize of the time axis), then the bands are written as region writes
+of their own chunks, so several worker processes can append to the same cube.
+Only the chunks covered by the granule are stored.
+
+Requires zarr (v2 API), numcodecs and a POSIX system (fcntl file locks).
+"""
+
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from pyresample import AreaDefinition
+
+from archive import to_epoch
+from composite import resample_granule
+from example import (
+    get_sensor,
+    get_times
+)
+from swathutils import (
+    Granule,
+    get_adef
+)
+
+try:
+    # POSIX only, the cube output is unavailable on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = Blosc = None
+
+
+class Cube:
+    """Zarr time-series cube on one target grid
+
+    Parameters
+    ----------
+    store: str
+        directory of the Zarr store, created if missing
+    area_def: AreaDefinition
+        target grid, fixed for the cube (see get_adef)
+    chunks: tuple
+        (rows, cols) spatial chunk size, the time chunk is 1
+    compressor:
+        numcodecs compressor, Blosc zstd with bit shuffle by default
+
+    Examples
+    --------
+    >>> cube = Cube(store='Results/aqua.zarr', area_def=get_adef(pixel_resolution=1000, subarea=subarea))
+    >>> index = cube.append(data={'chlor_a': sds}, attrs={'chlor_a': attrs}, time=start, granule=file)
+    """
+
+    def __init__(self, store: str, area_def: AreaDefinition, chunks: tuple = (512, 512), compressor=None):
+        if zarr is None:
+            raise ImportError('the cube output requires zarr and numcodecs (pip install "zarr<3")')
+        if fcntl is None:
+            raise ImportError('the cube output requires fcntl file locks (POSIX systems)')
+        self.store = store
+        self.area_def = area_def
+        self.chunks = tuple(chunks)
+        self.compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE) \
+            if compressor is None else compressor
+
+        with self.lock():
+            group = zarr.open_group(store, mode='a')
+            grid = {'proj_str': area_def.proj_str, 'area_extent': list(area_def.area_extent),
+                    'shape': list(area_def.shape)}
+            if 'grid' not in group.attrs:
+                group.attrs.update(grid=grid, Conventions='CF-1.8')
+                self._coordinates(group=group)
+            elif group.attrs['grid'] != grid:
+                raise ValueError(f'{store} is on another grid: {group.attrs["grid"]}')
+
+            if 'time' not in group:
+                time = group.zeros('time', shape=(0,), chunks=(4096,), dtype='i8')
+                time.attrs.update(units='seconds since 1970-01-01 00:00:00', calendar='standard',
+                                  _ARRAY_DIMENSIONS=['time'])
+                granule = group.zeros('granule', shape=(0,), chunks=(4096,), dtype='<U128')
+                granule.attrs['_ARRAY_DIMENSIONS'] = ['time']
+
+    def _coordinates(self, group):
+        """Writes the x/y coordinates of the grid (lon/lat degrees on geographic grids)"""
+        geographic = self.area_def.crs.is_geographic
+        for name, values in (('y', self.area_def.projection_y_coords),
+                             ('x', self.area_def.projection_x_coords)):
+            coord = group.array(name, np.asarray(values, np.float64), chunks=(len(values),))
+            coord.attrs['_ARRAY_DIMENSIONS'] = [name]
+            if geographic:
+                coord.attrs.update(units='degrees_north' if name == 'y' else 'degrees_east',
+                                   standard_name='latitude' if name == 'y' else 'longitude')
+            else:
+                coord.attrs.update(units='m', standard_name=f'projection_{name}_coordinate')
+
+    @contextmanager
+    def lock(self):
+        """Exclusive lock of the store (metadata changes), shared between processes"""
+        os.makedirs(self.store, exist_ok=True)
+        with open(os.path.join(self.store, '.lock'), 'a') as txt:
+            fcntl.flock(txt, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(txt, fcntl.LOCK_UN)
+
+    def has(self, granule: str):
+        """Whether a granule has already been appended
+
+        Parameters
+        ----------
+        granule: str
+            granule file name
+
+        Returns
+        -------
+            bool
+        """
+        group = zarr.open_group(self.store, mode='r')
+        return os.path.basename(granule) in set(group['granule'][:])
+
+    def allocate(self, time, granule: str, attrs: dict, dtypes: dict):
+        """Appends one time step to every variable (creating the new ones), under the lock
+
+        Parameters
+        ----------
+        time: datetime
+            time of the step (granule start), naive is taken as UTC
+        granule: str
+            granule file name
+        attrs: dict
+            {variable: attributes with _FillValue} of the variables written at this step
+        dtypes: dict
+            {variable: dtype} of the new variables, i4 (flags) or f4
+
+        Returns
+        -------
+            int
+                time index of the step
+        """
+        rows, cols = self.area_def.shape
+        with self.lock():
+            group = zarr.open_group(self.store, mode='r+')
+            index = group['time'].shape[0]
+            for name, var_attrs in attrs.items():
+                if name not in group:
+                    var = group.full(name, shape=(index, rows, cols), chunks=(1,) + self.chunks,
+                                     dtype=dtypes[name], fill_value=var_attrs['_FillValue'],
+                                     compressor=self.compressor)
+                    var.attrs.update({key: val.item() if isinstance(val, np.generic) else f'{val}'
+                                      for key, val in var_attrs.items()
+                                      if key not in ('_FillValue', 'scale_factor', 'add_offset')})
+                    var.attrs['_ARRAY_DIMENSIONS'] = ['time', 'y', 'x']
+
+            for name in group.array_keys():
+                if name in ('x', 'y'):
+                    continue
+                group[name].resize((index + 1,) + group[name].shape[1:])
+            # naive granule times are UTC, not the local time of the worker
+            group['time'][index] = int(round(to_epoch(time)))
+            group['granule'][index] = os.path.basename(granule)
+        return index
+
+    def append(self, data: dict, attrs: dict, time, granule: str):
+        """Appends a resampled granule as one time step. Only the chunks intersecting the valid
+        pixels of each band are written (region writes), the rest of the step stays fill value
+
+        Parameters
+        ----------
+        data: dict
+            {variable: masked array on area_def}
+        attrs: dict
+            {variable: attributes with _FillValue}
+        time: datetime
+            time of the step (granule start)
+        granule: str
+            granule file name
+
+        Returns
+        -------
+            int
+                time index of the step
+        """
+        dtypes = {name: 'i4' if np.issubdtype(sds.dtype, np.integer) else 'f4' for name, sds in data.items()}
+        index = self.allocate(time=time, granule=granule, attrs=attrs, dtypes=dtypes)
+        group = zarr.open_group(self.store, mode='r+')
+        for name, sds in data.items():
+            valid = ~np.ma.getmaskarray(sds)
+            if not valid.any():
+                continue
+            rows, cols = np.flatnonzero(valid.any(axis=1)), np.flatnonzero(valid.any(axis=0))
+            # extend the region to whole chunks, partial chunks would be read back and rewritten
+            (height, width), (rsize, csize) = valid.shape, self.chunks
+            r0, r1 = rows[0] // rsize * rsize, min((rows[-1] // rsize + 1) * rsize, height)
+            c0, c1 = cols[0] // csize * csize, min((cols[-1] // csize + 1) * csize, width)
+            region = np.ma.filled(sds[r0:r1, c0:c1], attrs[name]['_FillValue'])
+            group[name][index, r0:r1, c0:c1] = region.astype(group[name].dtype, copy=False)
+        return index
+
+
+def append_granule(store: str, file: str, subarea: dict, epsilon: float, method: str = 'nearest',
+                   cache_dir: str = None, chunks: tuple = (512, 512)):
+    """Resamples a granule and appends it to the sensor cube <store>/<sensor>.zarr
+
+    Parameters
+    ----------
+    store: str
+        directory of the cubes
+    file: str
+        granule to be appended
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    epsilon: float
+        allowed uncertainty in the neighbour search
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean (see swath_resample)
+    cache_dir: str
+        directory where the granule neighbour info is persisted for reruns
+    chunks: tuple
+        (rows, cols) spatial chunk size of new cubes
+
+    Returns
+    -------
+        dict
+            file (cube), sat, var_name, start, end, index (time step, None if the granule misses
+            the subarea) and skipped (already in the cube)
+    """
+    with Granule(file=file, subarea=subarea) as granule:
+        sat = get_sensor(granule=granule)
+        start, end = get_times(granule=granule)
+        output = {'file': os.path.abspath(f'{store}/{sat}.zarr'), 'sat': sat, 'var_name': [],
+                  'start': start, 'end': end, 'index': None, 'skipped': False}
+        if granule.get_overlap(subarea=subarea) == 0:
+            return output
+
+        # same grid as create_dataset, so reruns skip the granule before any resampling
+        cube = Cube(store=output['file'], chunks=chunks,
+                    area_def=get_adef(pixel_resolution=granule.get_resolution(), subarea=subarea))
+        if cube.has(granule=file):
+            return {**output, 'skipped': True}
+
+        data, attrs = {}, {}
+        for band in resample_granule(granule=granule, subarea=subarea, epsilon=epsilon,
+                                     method=method, cache_dir=cache_dir):
+            for i, name in enumerate(band['names']):
+                data[name] = band['result'][..., i]
+                attrs[name] = band['attrs'][name]
+
+    output['index'] = cube.append(data=data, attrs=attrs, time=start, granule=file)
+    output['var_name'] = list(data)
+    return output
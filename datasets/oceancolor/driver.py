@@ -0,0 +1,425 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parallel granule processing driver
+
+Runs example.process_granule over a list/glob of granules in a process pool.
+Each worker gets its own thread budget (pyresample nprocs, GDAL, numexpr/BLAS),
+so workers x threads matches the number of CPUs without oversubscription.
+
+    python driver.py 'data/*.h5' 'data/*.nc' --workers 4 --threads 2
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import warnings
+from functools import partial
+
+from archive import ArchiveIndex
+from composite import (
+    composite_day,
+    group_by_day
+)
+from cube import append_granule
+from example import process_granule
+from swathutils import (
+    RESAMPLE_METHODS,
+    set_cache_limit,
+    set_cog,
+    set_geo_cache,
+    set_num_threads,
+    set_spans,
+    span,
+    span_tags
+)
+from upload import (
+    EarthEngineBackend,
+    LocalBackend,
+    UploadStage
+)
+
+# thread pools read their size from the environment when the libraries are loaded
+THREAD_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+              'NUMEXPR_NUM_THREADS', 'GDAL_NUM_THREADS')
+
+
+def get_granules(patterns: list):
+    """Expands file names and glob patterns into a sorted list of unique granules
+
+    Parameters
+    ----------
+    patterns: list
+        granule file names or glob patterns
+
+    Returns
+    -------
+        list
+            granule file names
+    """
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(pattern) or [pattern])
+    return sorted(file for file in files if file.endswith(('.nc', '.h5')))
+
+
+def nn_cache(cache_dir: str = None):
+    """Neighbour info cache directory under cache_dir, None if the caches are disabled"""
+    return None if cache_dir is None else f'{cache_dir}/nn_cache'
+
+
+def init_worker(threads: int, cache_dir: str = None, cog: dict = None, spans: str = None,
+                cache_size: int = None):
+    """Process pool initializer: sets the worker thread budget, geolocation cache and output layout
+
+    Parameters
+    ----------
+    threads: int
+        number of threads of the worker
+    cache_dir: str
+        directory of the persistent geolocation and neighbour info caches, None disables them
+    cog: dict
+        Cloud-Optimized GeoTIFF layout of the outputs (see set_cog)
+    spans: str
+        JSON lines file of the stage instrumentation, None disables it (see set_spans)
+    cache_size: int
+        size limit in bytes of each cache directory, least recently used files are evicted
+
+    Returns
+    -------
+        None
+    """
+    warnings.filterwarnings('ignore')
+    set_num_threads(threads=threads)
+    # a worker handles one granule at a time, which keeps its own lon/lat: no in-memory cache
+    set_geo_cache(maxsize=0, cache_dir=None if cache_dir is None else f'{cache_dir}/geo_cache')
+    set_cache_limit(max_bytes=cache_size)
+    set_cog(**(cog or {}))
+    set_spans(file=spans)
+
+
+def run_granule(file: str, subarea: dict, epsilon: float, cwdir: str, batch: bool, cache_dir: str,
+                manifest: str = None, lazy: bool = False, method: str = 'nearest', packing: bool = False):
+    """Processes one granule, catching any error so that the batch carries on
+
+    Parameters
+    ----------
+    file: str
+        granule to be processed
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    epsilon: float
+        allowed uncertainty in the neighbour search
+    cwdir: str
+        output directory
+    batch: bool
+        whether to resample all Rrs/chlor_a at once into one multi-band geotif
+    cache_dir: str
+        directory of the neighbour info cache, None disables it
+    manifest: str
+        processing manifest file, completed outputs are skipped
+    lazy: bool
+        whether to resample chunk by chunk with bounded memory (requires dask)
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean
+    packing: bool
+        whether to write scaled int16 bands and the smallest flag type
+
+    Returns
+    -------
+        tuple
+            (file, status, seconds, outputs or error message)
+    """
+    start = time.perf_counter()
+    try:
+        with span_tags(granule=os.path.basename(file)), span('granule'):
+            outputs = process_granule(file=file, subarea=subarea, epsilon=epsilon, cwdir=cwdir,
+                                      batch=batch, cache_dir=nn_cache(cache_dir), manifest=manifest,
+                                      lazy=lazy, method=method, packing=packing)
+        return file, 'ok', time.perf_counter() - start, outputs
+    except Exception as err:
+        return file, 'failed', time.perf_counter() - start, f'{type(err).__name__}: {err}'
+
+
+def run_composite(group: tuple, subarea: dict, epsilon: float, cwdir: str, cache_dir: str,
+                  method: str = 'nearest'):
+    """Composites the granules of one sensor and day, catching any error so that the batch carries on
+
+    Parameters
+    ----------
+    group: tuple
+        ((sensor, YYYYMMDD), granule files), see group_by_day
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    epsilon: float
+        allowed uncertainty in the neighbour search
+    cwdir: str
+        output directory
+    cache_dir: str
+        directory of the neighbour info cache, None disables it
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean
+
+    Returns
+    -------
+        tuple
+            (<sensor>_<YYYYMMDD>, status, seconds, outputs or error message)
+    """
+    (sat, day), files = group
+    start = time.perf_counter()
+    try:
+        with span_tags(granule=f'{sat}_{day}'), span('composite', granules=len(files)):
+            outputs = composite_day(files=files, subarea=subarea, epsilon=epsilon, cwdir=cwdir,
+                                    method=method, cache_dir=nn_cache(cache_dir))
+        return f'{sat}_{day}', 'ok', time.perf_counter() - start, outputs
+    except Exception as err:
+        return f'{sat}_{day}', 'failed', time.perf_counter() - start, f'{type(err).__name__}: {err}'
+
+
+def run_cube(file: str, subarea: dict, epsilon: float, store: str, cache_dir: str,
+             method: str = 'nearest'):
+    """Appends one granule to the sensor time-series cube, catching any error so that the batch carries on
+
+    Parameters
+    ----------
+    file: str
+        granule to be appended
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    epsilon: float
+        allowed uncertainty in the neighbour search
+    store: str
+        directory of the cubes, one <sensor>.zarr per sensor (see cube.append_granule)
+    cache_dir: str
+        directory of the neighbour info cache, None disables it
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean
+
+    Returns
+    -------
+        tuple
+            (file, status, seconds, outputs or error message)
+    """
+    start = time.perf_counter()
+    try:
+        with span_tags(granule=os.path.basename(file)), span('cube'):
+            output = append_granule(store=store, file=file, subarea=subarea, epsilon=epsilon,
+                                    method=method, cache_dir=nn_cache(cache_dir))
+        # no time step: the granule footprint misses the subarea
+        outputs = [] if (output['index'] is None) and not output['skipped'] else [output]
+        return file, 'ok', time.perf_counter() - start, outputs
+    except Exception as err:
+        return file, 'failed', time.perf_counter() - start, f'{type(err).__name__}: {err}'
+
+
+def summarize_spans(file: str):
+    """Prints the total wall/CPU time and the largest peak RSS of each stage in a spans file
+
+    Parameters
+    ----------
+    file: str
+        JSON lines file written by the stage instrumentation (see set_spans)
+
+    Returns
+    -------
+        dict
+            {stage: {'count', 'wall_s', 'cpu_s', 'maxrss_mb'}}
+    """
+    stages = {}
+    with open(file) as txt:
+        for line in txt:
+            record = json.loads(line)
+            total = stages.setdefault(record['stage'], {'count': 0, 'wall_s': 0., 'cpu_s': 0., 'maxrss_mb': 0.})
+            total['count'] += 1
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            total['maxrss_mb'] = max(total['maxrss_mb'], record.get('maxrss_mb', 0.))
+
+    print(f"{'stage':>12} {'count':>7} {'wall (s)':>10} {'cpu (s)':>10} {'rss (MB)':>10}")
+    for stage, total in sorted(stages.items(), key=lambda item: -item[1]['wall_s']):
+        print(f"{stage:>12} {total['count']:>7} {total['wall_s']:>10.1f} "
+              f"{total['cpu_s']:>10.1f} {total['maxrss_mb']:>10.0f}")
+    return stages
+
+
+def get_parser():
+    """Command line arguments of the driver"""
+    parser = argparse.ArgumentParser(description='Resamples level-2 swath granules in parallel')
+    parser.add_argument('granules', nargs='*',
+                        help='granule files or glob patterns (quoted)')
+    parser.add_argument('--index', default=None,
+                        help='archive index (see archive.py) queried for the granules covering --bounds '
+                             'and the period, instead of listing them')
+    parser.add_argument('--start', default=None, help='period start with --index, e.g., 2021-01-01')
+    parser.add_argument('--end', default=None, help='period end with --index, e.g., 2021-01-31T23:59:59')
+    parser.add_argument('--sensor', default=None, help='sensor with --index, e.g., sgli, aqua')
+    parser.add_argument('--bounds', nargs=4, type=float, default=(117, 145, 25, 52),
+                        metavar=('X0', 'X1', 'Y0', 'Y1'), help='subarea lon/lat limits')
+    parser.add_argument('--proj', default='EPSG:4326',
+                        help="target grid projection, EPSG:4326 or any pyproj id ('laea', 'eqc', ...)")
+    parser.add_argument('--epsilon', type=float, default=0.3,
+                        help='allowed uncertainty in the neighbour search')
+    parser.add_argument('--no-batch', dest='batch', action='store_false',
+                        help='one geotif per variable instead of one multi-band geotif')
+    parser.add_argument('--method', default='nearest', choices=RESAMPLE_METHODS,
+                        help='resampling of the continuous variables (flags always use nearest)')
+    parser.add_argument('--composite', action='store_true',
+                        help='one daily composite (latest/mean/count) per sensor, day and variable '
+                             'instead of one geotif per granule')
+    parser.add_argument('--cube', default=None, metavar='STORE',
+                        help='append the granules to one Zarr time-series cube per sensor, '
+                             '<STORE>/<sensor>.zarr, instead of writing geotifs (requires zarr)')
+    parser.add_argument('--pack', dest='packing', action='store_true',
+                        help='int16 bands with scale_factor/add_offset and the smallest flag type')
+    parser.add_argument('--lazy', action='store_true',
+                        help='chunked, bounded memory resampling of large granules (requires dask)')
+    parser.add_argument('--compress', default='DEFLATE',
+                        help='output COG compression, DEFLATE, ZSTD (if GDAL supports it) or LZW')
+    parser.add_argument('--blocksize', type=int, default=512,
+                        help='output COG tile size in pixels')
+    parser.add_argument('--cache', action='store_true',
+                        help='persist the SGLI lon/lat (<outdir>/geo_cache) and the neighbour info '
+                             '(<outdir>/nn_cache) for reruns of the same granules')
+    parser.add_argument('--cache-size', type=float, default=20.,
+                        help='size limit (GB) of each cache directory with --cache, '
+                             'least recently used files are evicted')
+    parser.add_argument('--spans', action='store_true',
+                        help='record per stage timing/memory as JSON lines in <logdir>/stages.jsonl')
+    parser.add_argument('--upload', default=None, choices=('local', 'ee'),
+                        help='upload and ingest the geotifs while the batch runs (see upload.py), '
+                             'ee: GCS + EE ingestion, local: filesystem stand-in (ignored with --cube)')
+    parser.add_argument('--upload-dir', default=f'{os.getcwd()}/uploads',
+                        help='upload directory of the local backend')
+    parser.add_argument('--bucket', default=None, help='GCS bucket of the ee backend, gs://<bucket>')
+    parser.add_argument('--asset-id', default='<full-path-to-ee-asset>',
+                        help='EE image collection the geotifs are ingested into')
+    parser.add_argument('--uploads', type=int, default=4, help='number of concurrent uploads')
+    parser.add_argument('--ingest-batch', type=int, default=10, help='manifests per ingestion call')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, defaults to CPUs // threads')
+    parser.add_argument('--threads', type=int, default=2,
+                        help='number of threads per worker')
+    parser.add_argument('--outdir', default=f'{os.getcwd()}/Results',
+                        help='output directory')
+    parser.add_argument('--logdir', default=f'{os.getcwd()}/eeupload_logs',
+                        help='task log directory')
+    parser.add_argument('--manifest', default=None,
+                        help='processing manifest, defaults to <outdir>/manifest.sqlite')
+    parser.add_argument('--force', action='store_true',
+                        help='reprocess every granule, ignoring the outputs already in the manifest')
+    return parser
+
+
+def main(argv: list = None):
+    args = get_parser().parse_args(argv)
+
+    x0, x1, y0, y1 = args.bounds
+    subarea = {'x0': x0, 'y0': y0,
+               'x1': x1, 'y1': y1,
+               'area_id': 'granule',
+               'proj_id': args.proj,
+               'area_name': 'nw_granule'}
+
+    cache_dir = args.outdir if args.cache else None
+    caches = (nn_cache(cache_dir), f'{cache_dir}/geo_cache') if args.cache else ()
+    for path in (args.outdir, args.logdir) + caches:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    files = get_granules(patterns=args.granules)
+    if args.index is not None:
+        with ArchiveIndex(file=args.index) as index:
+            found = index.query(bounds=args.bounds, start=args.start, end=args.end, sensor=args.sensor)
+        # explicit granules restrict the indexed ones
+        files = sorted(set(found) & set(map(os.path.abspath, files))) if args.granules else found
+    if args.composite:
+        # the pool processes one day of one sensor per task
+        files = list(group_by_day(files=files).items())
+    workers = args.workers or max(os.cpu_count() // args.threads, 1)
+    workers = min(workers, max(len(files), 1))
+
+    # ----------------------------------------
+    # per worker thread budget (spawned procs)
+    # ----------------------------------------
+    os.environ.update({key: f'{args.threads}' for key in THREAD_ENV})
+    context = multiprocessing.get_context('spawn')
+
+    manifest = args.manifest or f'{args.outdir}/manifest.sqlite'
+    if args.force:
+        for file in (manifest, f'{manifest}-wal', f'{manifest}-shm'):
+            if os.path.isfile(file):
+                os.remove(file)
+
+    spans = f'{args.logdir}/stages.jsonl' if args.spans else None
+    run = partial(run_granule, subarea=subarea, epsilon=args.epsilon, cwdir=args.outdir,
+                  batch=args.batch, cache_dir=cache_dir, manifest=manifest,
+                  lazy=args.lazy, method=args.method, packing=args.packing)
+    if args.composite:
+        run = partial(run_composite, subarea=subarea, epsilon=args.epsilon, cwdir=args.outdir,
+                      cache_dir=cache_dir, method=args.method)
+    elif args.cube is not None:
+        run = partial(run_cube, subarea=subarea, epsilon=args.epsilon, store=args.cube,
+                      cache_dir=cache_dir, method=args.method)
+
+    stage = None
+    if (args.upload is not None) and (args.cube is None):
+        backend = LocalBackend(root=args.upload_dir) if args.upload == 'local' \
+            else EarthEngineBackend(bucket=args.bucket)
+        stage = UploadStage(backend=backend, asset_id=args.asset_id, workers=args.uploads,
+                            queue_size=4 * args.uploads, batch_size=args.ingest_batch,
+                            log=f'{args.logdir}/ee.ingest')
+
+    failed = 0
+    with context.Pool(workers, initializer=init_worker,
+                      initargs=(args.threads, cache_dir,
+                                {'compress': args.compress, 'blocksize': args.blocksize},
+                                spans, int(args.cache_size * 2 ** 30))) as pool:
+        for file, status, seconds, detail in pool.imap_unordered(run, files):
+            bsn = os.path.basename(file)
+            sat = file.split('_')[0] if args.composite else 'sgli' if file.endswith('.h5') else 'nc'
+            if status == 'ok':
+                sat = detail[0]['sat'] if detail else sat
+                status = 'skipped' if detail and all(output['skipped'] for output in detail) else status
+                # no outputs: the granule footprint misses the subarea
+                status = status if detail else 'rejected'
+                # outputs of previous runs too, those already ingested are skipped (see UploadStage)
+                for output in detail if stage is not None else []:
+                    stage.submit(output=output)
+                detail = ','.join(os.path.basename(output['file']) for output in detail)
+            else:
+                failed += 1
+            print(f'{bsn}: {status} ({seconds:.1f} s)')
+
+            # ------------
+            # Update log-f
+            # ------------
+            with open(f'{args.logdir}/ee.tasks.{sat}', 'a') as txt:
+                txt.write(f'{bsn}|{status}|{seconds:.1f}|{detail}\n')
+
+    print(f"{len(files) - failed}/{len(files)} {'days' if args.composite else 'granules'} processed")
+    if stage is not None:
+        results = stage.close()
+        errors = sum(task_id is None for _, task_id, _ in results)
+        print(f'{len(results) - errors}/{len(results)} geotifs uploaded and ingested')
+        failed += errors
+    if spans is not None and os.path.isfile(spans):
+        summarize_spans(file=spans)
+    return failed
+
+
+if __name__ == '__main__':
+    raise SystemExit(1 if main() else 0)
@@ -14,39 +14,68 @@
 
 import os
 import warnings
+from contextlib import nullcontext
 from datetime import datetime
 
 import numpy as np
 from dateutil.parser import parse
 
+from manifest import (
+    Manifest,
+    grid_id
+)
 from swathutils import (
     write_tif,
     gdal_translate,
     create_dataset,
     swath_resample,
+    swath_resample_lazy,
     flags_band,
-    get_keys
+    set_cache_limit,
+    set_geo_cache,
+    Granule,
+    BAND_KEYS
 )
 
 
-def swath_pyresample_gdaltrans(file: str, var: str, subarea: dict, epsilon: float, src_tif: str, dst_tif: str):
+def swath_pyresample_gdaltrans(file: str, var, subarea: dict, epsilon: float, src_tif: str, dst_tif: str,
+                               granule: Granule = None, cache_dir: str = None, lazy: bool = False,
+                               method: str = 'nearest', neighbours: int = 8, packing: bool = False):
     """Reprojects swath data using pyresample and translates the image to EE ready tif using gdal
 
     Parameters
     ----------
     file: str
         file to be resampled and uploaded to GC -> EE
-    var: str
-        input variable name
+    var: str | list
+        input variable name. A list of (non-flag) variables runs in batch mode: the variables
+        are stacked into one channel cube, resampled in a single call and written as one
+        multi-band geotif
     subarea: dict
         string name of the projection to resample the data onto (pyproj supported)
     epsilon: float
         The distance to a found value is guaranteed to be no further than (1 + eps)
         times the distance to the correct neighbour. Allowing for uncertainty decreases execution time.
     src_tif: str
-        temporary target geotif file
+        temporary target geotif file, a /vsimem/ path keeps it in memory
     dst_tif: str
         final geotif output, GDAL processed
+    granule: Granule
+        opened granule of file, shared across the variables of the same file.
+        The resampling neighbour search is then done once per granule
+    cache_dir: str
+        directory where the granule neighbour info is persisted for reruns
+    lazy: bool
+        whether to resample chunk by chunk with bounded memory (see swath_resample_lazy,
+        requires dask). src_tif should then be on disk rather than in /vsimem/
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean (see swath_resample).
+        The flags are always resampled with the nearest neighbour
+    neighbours: int
+        number of neighbours searched for gauss/mean. The same search serves the flags
+    packing: bool
+        whether to write the continuous variables as int16 with scale_factor/add_offset
+        and the flags in the smallest sufficient unsigned type (see write_tif, flag_type)
 
     Returns
     -------
@@ -54,47 +83,262 @@ def swath_pyresample_gdaltrans(file: str, var: str, subarea: dict, epsilon: floa
             global and var attributes
     """
 
+    keys = [var] if isinstance(var, str) else list(var)
+    if lazy:
+        if (method != 'nearest') or packing:
+            raise ValueError('the lazy mode only supports nearest resampling to Float32/Int32')
+        direct = subarea['proj_id'].upper() == 'EPSG:4326'
+        # the granule is only closed here if it is opened here
+        with Granule(file=file, subarea=subarea) if granule is None else nullcontext(granule) as granule:
+            meta = swath_resample_lazy(granule=granule, keys=keys, subarea=subarea,
+                                       file=dst_tif if direct else src_tif, epsilon=epsilon, cog=direct)
+        if not direct:
+            # the nodata values are those set on the src_tif bands
+            gdal_translate(src_tif=src_tif,
+                           dst_tif=dst_tif,
+                           ot='Int32' if keys[0] in ('l2_flags', 'QA_flag') else 'Float32',
+                           nodata=None)
+        return meta
+
     # -----------
     # get dataset
     # -----------
-    resample_dst = create_dataset(file=file, key=var, subarea=subarea)
+    resample_dst = create_dataset(file=file, key=keys, subarea=subarea, granule=granule)
     resample_dst['epsilon'] = epsilon
 
+    neighbour_info = None
+    if granule is not None:
+        neighbour_info = granule.get_neighbours(
+            swath=resample_dst, trg_proj=resample_dst['proj'], cache_dir=cache_dir,
+            neighbours=1 if method == 'nearest' else neighbours)
+
     # ---------------
     # resample swaths
     # ---------------
-    if var in ('l2_flags', 'QA_flag'):
+    if keys[0] in ('l2_flags', 'QA_flag'):
         meta = flags_band(dataset=resample_dst,
-                          key=var,
+                          key=keys[0],
                           src_tif=src_tif,
-                          dst_tif=dst_tif)
+                          dst_tif=dst_tif,
+                          neighbour_info=neighbour_info,
+                          packing=packing)
 
     else:
-        attrs = resample_dst.pop(var)
-        glob_attrs = resample_dst.pop('glob_attrs')
+        metadata = {key: resample_dst.pop(key) for key in keys}
+        metadata['glob_attrs'] = resample_dst.pop('glob_attrs')
         proj = resample_dst.pop('proj')
-        fill_value = attrs['_FillValue']
+        fill_value = [attrs['_FillValue'] for key, attrs in metadata.items()
+                      if key != 'glob_attrs']
 
-        result = swath_resample(swath=resample_dst, trg_proj=proj)
-        np.ma.set_fill_value(result, fill_value=fill_value)
+        result = swath_resample(swath=resample_dst, trg_proj=proj, neighbour_info=neighbour_info,
+                                method=method, neighbours=neighbours)
+        np.ma.set_fill_value(result, fill_value=fill_value[0])
 
         # ---------------------
         # write out the g-tif-f
         # ---------------------
-        meta = write_tif(file=src_tif,
+        # resampled onto the EPSG:4326 target grid: no warp, write the final COG
+        direct = proj.crs.to_epsg() == 4326
+        data_type = 'Int16' if packing else 'Float32'
+        meta = write_tif(file=dst_tif if direct else src_tif,
                          dataset=result,
-                         data_type='Float32',
-                         metadata={var: attrs, 'glob_attrs': glob_attrs},
-                         area_def=proj)
-
-        gdal_translate(src_tif=src_tif,
-                       dst_tif=dst_tif,
-                       ot='Float32',
-                       nodata=fill_value)
+                         data_type=data_type,
+                         metadata=metadata,
+                         area_def=proj,
+                         cog=direct)
+
+        if not direct:
+            # packed bands: the nodata values are those set on the src_tif bands
+            gdal_translate(src_tif=src_tif,
+                           dst_tif=dst_tif,
+                           ot=data_type,
+                           nodata=None if packing else fill_value if len(keys) > 1 else fill_value[0])
 
     return meta
 
 
+def get_sensor(granule: Granule):
+    """Short sensor name of a granule, used to name the task logs
+
+    Parameters
+    ----------
+    granule: Granule
+        opened granule
+
+    Returns
+    -------
+        str:
+            sgli for JAXA hdf5 files, platform name (e.g. aqua) for NASA netCDF files
+    """
+    if granule.flag == 'h5':
+        return 'sgli'
+    return f"{granule.get_attrs().get('platform', 'modis')}".lower()
+
+
+def get_times(granule: Granule):
+    """Time coverage of a granule, from its global attributes
+
+    Parameters
+    ----------
+    granule: Granule
+        opened granule
+
+    Returns
+    -------
+        tuple:
+            (start, end) datetimes
+    """
+    attrs = granule.get_attrs()
+    if granule.flag == 'h5':
+        return parse(attrs['Scene_start_time']), parse(attrs['Scene_end_time'])
+    return parse(attrs['time_coverage_start']), parse(attrs['time_coverage_end'])
+
+
+def get_var_names(keys: list):
+    """EE band names of the granule keys, consistent across sensors
+    (CHLA -> chlor_a, QA_flag -> l2_flags, NWLR_xxx -> Rrs_xxx)
+
+    Parameters
+    ----------
+    keys: list
+        variable names in the granule
+
+    Returns
+    -------
+        list
+    """
+    return ['chlor_a' if var in ('chlor_a', 'CHLA')
+            else 'l2_flags' if var in ('l2_flags', 'QA_flag')
+            else var.replace('NWLR', 'Rrs')
+            for var in keys]
+
+
+def process_granule(file: str, subarea: dict, epsilon: float, cwdir: str,
+                    batch: bool = True, cache_dir: str = None, manifest: str = None,
+                    lazy: bool = False, method: str = 'nearest', packing: bool = False):
+    """Resamples all the geophysical variables and the flags of a granule into EE ready geotifs
+
+    Parameters
+    ----------
+    file: str
+        granule (netCDF/hdf5) to be resampled
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    epsilon: float
+        allowed uncertainty in the neighbour search (see swath_pyresample_gdaltrans)
+    cwdir: str
+        output directory, the geotifs go into a sub-directory named after the granule
+    batch: bool
+        whether to resample all Rrs/chlor_a at once into one multi-band geotif
+    cache_dir: str
+        directory where the granule neighbour info is persisted for reruns
+    manifest: str
+        processing manifest (SQLite) file. Outputs already recorded for this granule,
+        grid and code version are skipped, and new outputs are recorded (see Manifest)
+    lazy: bool
+        whether to resample chunk by chunk with bounded memory (requires dask), for
+        granules too large to be resampled in memory
+    method: str
+        resampling of the continuous variables, nearest, gauss or mean (see swath_resample)
+    packing: bool
+        whether to write scaled int16 bands and the smallest flag type (see swath_pyresample_gdaltrans)
+
+    Returns
+    -------
+        list:
+            one dict per output geotif with keys file, sat, var_name (EE band names),
+            attributes, start and end (time coverage), and skipped (whether the output
+            was produced by a previous run). Empty if the granule misses the subarea
+    """
+
+    outputs = []
+    grid = grid_id(subarea=subarea)
+    # one open and one geolocation decode per granule, shared by all keys,
+    # reading only the part of the swath intersecting the subarea
+    with Granule(file=file, subarea=subarea) as granule:
+        # ---------------------------------
+        # footprint pre-filter, no decoding
+        # ---------------------------------
+        overlap = granule.get_overlap(subarea=subarea)
+        print(f'{os.path.basename(file)}: {overlap:.1%} of the subarea')
+        if overlap == 0:
+            return outputs
+
+        # closed on errors too, the recorded outputs are committed as they are produced
+        with nullcontext() if manifest is None else Manifest(file=manifest) as done:
+            sat = get_sensor(granule=granule)
+            l2_key = ['QA_flag'] if sat == 'sgli' else ['l2_flags']
+            keys = [key for key in granule.get_keys()
+                    if key not in ('CDOM', 'TSM',)]
+            jobs = [keys, l2_key] if batch else [[key] for key in keys + l2_key]
+            # outputs of another resampling method are different outputs
+            suffix = '' if method == 'nearest' else f':{method}'
+            suffix += ':packed' if packing else ''
+
+            for job in jobs:
+
+                key = job[0] if len(job) == 1 else 'bands'
+                # ----------
+                # Processing
+                # ----------
+                bsn = os.path.basename(file)
+                print(f'{key}: {bsn}')
+                tempdir = os.path.abspath(f"{cwdir}/{bsn.split('.')[0]}")
+                bsn = bsn.replace(".nc", ".tif").replace(".h5", ".tif")
+                # the resampled tif stays in memory until gdal_translate warps it,
+                # unless lazy where it is written to disk block by block
+                src_file = os.path.abspath(f'{tempdir}/src_{bsn}') if lazy else f'/vsimem/{bsn}'
+                trg_file = os.path.abspath(f"{tempdir}/{bsn.split('.')[0]}_{key}.tif")
+
+                if not os.path.isdir(tempdir):
+                    os.makedirs(tempdir)
+
+                # -------------------------
+                # skip (resume) or resample
+                # -------------------------
+                record = None if done is None else done.done(granule=file, variable=','.join(job) + suffix, grid=grid)
+                if record is not None:
+                    record.update(start=parse(record['start']), end=parse(record['end']), skipped=True)
+                    outputs.append(record)
+                    continue
+
+                attributes = swath_pyresample_gdaltrans(
+                    file=file,
+                    src_tif=src_file,
+                    dst_tif=trg_file,
+                    var=job,
+                    subarea=subarea,
+                    epsilon=epsilon,
+                    granule=granule,
+                    cache_dir=cache_dir,
+                    lazy=lazy,
+                    method=method,
+                    packing=packing)
+
+                # To keep variable names consistent across different sensors
+                var_name = get_var_names(keys=job)
+                # per band attributes (see band_attributes) named after the EE bands as well
+                rename = {f"{key}_{attr.lstrip('_')}": f"{var}_{attr.lstrip('_')}"
+                          for key, var in zip(job, var_name) for attr in BAND_KEYS}
+                attributes = {rename.get(key, key): val for key, val in attributes.items()}
+
+                if sat == 'sgli':
+                    start = parse(attributes.pop("Scene_start_time"))
+                    end = parse(attributes.pop("Scene_end_time"))
+                else:
+                    start = parse(attributes.pop("time_coverage_start"))
+                    end = parse(attributes.pop("time_coverage_end"))
+
+                record = {'file': trg_file, 'sat': sat, 'var_name': var_name,
+                          'attributes': attributes, 'start': start, 'end': end}
+                if done is not None:
+                    done.record(granule=file, variable=','.join(job) + suffix, grid=grid,
+                                output=trg_file, record=record)
+                outputs.append({**record, 'skipped': False})
+
+    return outputs
+
+
 if __name__ == '__main__':
     warnings.filterwarnings('ignore')
 
@@ -103,7 +347,8 @@ if __name__ == '__main__':
     # Constants
     # ---------
     BOUNDS = 117, 145, 25, 52
-    PROJ_ID = 'laea'  # 'eqc', 'cea', 'laea', 'lonlat
+    # EPSG:4326 resamples straight onto the final grid; 'eqc', 'cea', 'laea', 'lonlat' are warped afterwards
+    PROJ_ID = 'EPSG:4326'  # 'EPSG:4326', 'eqc', 'cea', 'laea', 'lonlat'
     X0, X1, Y0, Y1 = BOUNDS
     PILOT_AREA = {'x0': X0, 'y0': Y0,
                   'x1': X1, 'y1': Y1,
@@ -120,7 +365,17 @@ if __name__ == '__main__':
     if not os.path.isdir(LOGDIR):
         os.makedirs(LOGDIR)
 
+    # keep the SGLI lon/lat of the last 2 granules, and persist them for reruns. The persistent
+    # caches are capped as in driver.py (--cache-size), the oldest files are evicted first
+    set_geo_cache(maxsize=4, cache_dir=f'{CWDIR}/geo_cache')
+    set_cache_limit(max_bytes=20 * 2 ** 30)
+    NN_CACHE = f'{CWDIR}/nn_cache'
+    if not os.path.isdir(NN_CACHE):
+        os.makedirs(NN_CACHE)
+
     EPSILON = 0.3
+    # resample all Rrs/chlor_a of a granule at once into one multi-band geotif
+    BATCH = True
     BUCKET = 'gs://<bucket>'
     ASSET_ID = '<full-path-to-ee-asset>'
 
@@ -144,42 +399,27 @@ if __name__ == '__main__':
     #        f"--get_data={HOME}/data"]
     # os.system(' '.join(cmd))
 
-    for fi, sat in zip(test_file, ('sgli',)):
-
-        l2_key = ['QA_flag'] if sat == 'sgli' else ['l2_flags']
-        keys = get_keys(file=fi) + l2_key
+    # granules are processed one after the other here, see driver.py for a process pool
+    for fi in test_file:
 
-        for key in keys:
+        # --------------
+        # swath resample
+        # --------------
+        outputs = process_granule(
+            file=fi,
+            subarea=PILOT_AREA,
+            epsilon=EPSILON,
+            cwdir=CWDIR,
+            batch=BATCH,
+            cache_dir=NN_CACHE,
+            manifest=f'{CWDIR}/manifest.sqlite')
 
-            if key in ('CDOM', 'TSM',):
-                continue
-            # ----------
-            # Processing
-            # ----------
-            log = f'{LOGDIR}/ee.tasks.{sat}'
+        for output in outputs:
+            log = f"{LOGDIR}/ee.tasks.{output['sat']}"
 
             with open(log, 'a') as txt:
-
-                bsn = os.path.basename(fi)
-                print(f'{key}: {bsn}')
-                tempdir = os.path.abspath(f"{CWDIR}/{bsn.split('.')[0]}")
-                bsn = bsn.replace(".nc", ".tif").replace(".h5", ".tif")
-                src_file = os.path.abspath(f'{tempdir}/{bsn}')
-                trg_file = f"{src_file.split('.')[0]}_{key}.tif"
-
-                if not os.path.isdir(tempdir):
-                    os.makedirs(tempdir)
-
-                # --------------
-                # swath resample
-                # --------------
-                attributes = swath_pyresample_gdaltrans(
-                    file=fi,
-                    src_tif=src_file,
-                    dst_tif=trg_file,
-                    var=key,
-                    subarea=PILOT_AREA,
-                    epsilon=EPSILON)
+                trg_file = output['file']
+                attributes = output['attributes']
 
                 # # ------------
                 # # Upload to GC
@@ -192,23 +432,11 @@ if __name__ == '__main__':
                 # ------------
                 # Upload to EE
                 # ------------
-                # To keep variable names consistent across different sensors
-                var_name = 'chlor_a' if key in ('chlor_a', 'CHLA') \
-                    else 'l2_flags' if key in ('l2_flags', 'QA_flag') \
-                    else key.replace('NWLR', 'Rrs')
-
-                if sat == 'sgli':
-                    start = parse(attributes.pop("Scene_start_time"))
-                    end = parse(attributes.pop("Scene_end_time"))
-                else:
-                    start = parse(attributes.pop("time_coverage_start"))
-                    end = parse(attributes.pop("time_coverage_end"))
-
                 # missing_value = attributes.pop('_FillValue')
                 # task_id = eeutil.upload(
                 #     asset_id=ASSET_ID, missing_data=missing_value,
-                #     var=var_name, src_file=uir, attributes=attributes,
-                #     start_time=start, end_time=end)
+                #     var=output['var_name'], src_file=uir, attributes=attributes,
+                #     start_time=output['start'], end_time=output['end'])
                 #
                 # # # ------------
                 # # # Update log-f
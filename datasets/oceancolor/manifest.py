@@ -0,0 +1,195 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Processing manifest (SQLite) of the produced geotifs
+
+Each output is keyed by granule, variable(s), target grid and code version, and is
+recorded with its size and checksum once written, so batch runs are idempotent
+and resume where a previous (crashed) run stopped.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outputs (
+    granule TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    grid TEXT NOT NULL,
+    version TEXT NOT NULL,
+    output TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    record TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (granule, variable, grid, version)
+)
+'''
+
+
+def code_version():
+    """Version of the processing code, i.e., hash of the swathutils and example sources.
+    Any change to the processing code invalidates the outputs recorded before
+
+    Returns
+    -------
+        str
+            hex digest (12 characters)
+    """
+    sha = hashlib.sha1()
+    fdir = os.path.dirname(os.path.abspath(__file__))
+    for name in ('swathutils.py', 'example.py'):
+        with open(os.path.join(fdir, name), 'rb') as src:
+            sha.update(src.read())
+    return sha.hexdigest()[:12]
+
+
+def grid_id(subarea: dict):
+    """Target grid identifier. The grid is fully defined by the subarea and the
+    granule resolution, which is part of the granule key
+
+    Parameters
+    ----------
+    subarea: dict
+        area definition for pyresample (see get_adef)
+
+    Returns
+    -------
+        str
+            hex digest (12 characters)
+    """
+    return hashlib.sha1(json.dumps(subarea, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def file_checksum(file: str, block_size: int = 1 << 20):
+    """sha256 of a file, read in blocks
+
+    Parameters
+    ----------
+    file: str
+        file name
+    block_size: int
+        read block size in bytes
+
+    Returns
+    -------
+        str
+            hex digest
+    """
+    sha = hashlib.sha256()
+    with open(file, 'rb') as src:
+        for block in iter(lambda: src.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Manifest:
+    """SQLite manifest of the completed outputs. Safe to share between the worker
+    processes of a batch (WAL journal, writes retried while the database is locked)
+
+    Parameters
+    ----------
+    file: str
+        SQLite database file, created if missing
+    version: str
+        code version the outputs are recorded with (see code_version)
+
+    Examples
+    --------
+    >>> with Manifest(file='Results/manifest.sqlite') as manifest:
+    ...     if manifest.done(granule=file, variable='QA_flag', grid=grid_id(subarea)) is None:
+    ...         ...
+    """
+
+    def __init__(self, file: str, version: str = None):
+        self.file = file
+        self.version = code_version() if version is None else version
+        self.con = sqlite3.connect(file, timeout=60)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        with self.con:
+            self.con.execute(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def done(self, granule: str, variable: str, grid: str, verify: bool = False):
+        """Gets the record of a completed output, if the output file still exists and
+        matches the recorded size (and checksum if verify)
+
+        Parameters
+        ----------
+        granule: str
+            granule file name
+        variable: str
+            variable name(s), comma separated for multi-band outputs
+        grid: str
+            target grid identifier (see grid_id)
+        verify: bool
+            whether to also compare the output checksum
+
+        Returns
+        -------
+            dict | None
+                the output record (see record), or None if the output has to be produced
+        """
+        row = self.con.execute(
+            'SELECT output, size, checksum, record FROM outputs '
+            'WHERE granule=? AND variable=? AND grid=? AND version=?',
+            (os.path.basename(granule), variable, grid, self.version)).fetchone()
+        if row is None:
+            return None
+
+        output, size, checksum, record = row
+        if (not os.path.isfile(output)) or (os.path.getsize(output) != size):
+            return None
+        if verify and (file_checksum(file=output) != checksum):
+            return None
+        return json.loads(record)
+
+    def record(self, granule: str, variable: str, grid: str, output: str, record: dict = None):
+        """Records a completed output
+
+        Parameters
+        ----------
+        granule: str
+            granule file name
+        variable: str
+            variable name(s), comma separated for multi-band outputs
+        grid: str
+            target grid identifier (see grid_id)
+        output: str
+            output file name
+        record: dict
+            information returned by done on the next run, e.g., attributes and time coverage.
+            Values which are not JSON serializable are stored as strings
+
+        Returns
+        -------
+            None
+        """
+        values = (os.path.basename(granule), variable, grid, self.version, output,
+                  os.path.getsize(output), file_checksum(file=output),
+                  json.dumps(record or {}, default=str), time.time())
+        with self.con:
+            self.con.execute(
+                'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
@@ -12,18 +12,92 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
 import re
-import subprocess
+import sys
+import threading
+import time
 import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import h5py
 import numpy as np
 import pyproj
 from netCDF4 import Dataset
 from osgeo import (gdal, osr)
+from pykdtree.kdtree import KDTree
 from pyresample import (AreaDefinition, SwathDefinition)
-from pyresample.kd_tree import resample_nearest
+from pyresample.kd_tree import (
+    get_neighbour_info,
+    get_sample_from_neighbour_info,
+    resample_nearest
+)
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# --------------------------------------------------------------
+# SGLI geolocation cache, shared by granules (see set_geo_cache)
+# --------------------------------------------------------------
+_GEO_CACHE = OrderedDict()
+_GEO_CACHE_OPTIONS = {'maxsize': 4, 'cache_dir': None}
+
+# ---------------------------------------------------------------------------
+# size limit of each persistent (.npy/.npz) cache directory (set_cache_limit)
+# ---------------------------------------------------------------------------
+_DISK_CACHE = {'max_bytes': None}
+
+# ------------------------------------------------------
+# thread budget of pyresample and GDAL (set_num_threads)
+# ------------------------------------------------------
+_THREADS = {'nprocs': 4, 'gdal': 'ALL_CPUS'}
+
+# -------------------------------------------------------------
+# target grids and their bounds, by subarea/resolution (get_adef)
+# -------------------------------------------------------------
+_ADEF_CACHE = {}
+_BOUNDS_CACHE = {}
+
+# -----------------------------------------------------
+# stage instrumentation, JSON lines (set_spans/span)
+# -----------------------------------------------------
+_SPANS = {'file': None, 'tags': {}}
+
+# ------------------------------------------------------------
+# resampling kernels fed by one neighbour search (swath_resample)
+# ------------------------------------------------------------
+RESAMPLE_METHODS = ('nearest', 'gauss', 'mean')
+
+# --------------------------------------------------------
+# integer output encodings (write_tif packing, flag_type)
+# --------------------------------------------------------
+FLAG_TYPES = ('Byte', 'UInt16', 'UInt32', 'Int32')
+PACKED_FILL = np.int16(-32768)
+# log-normally distributed variables, packed as log10 (a linear int16 scale loses the low values)
+LOG_SCALED = ('chlor_a', 'CHLA')
+# band attributes recorded per band (<band>_<key>) in the attributes of multi-band geotifs
+BAND_KEYS = ('_FillValue', 'scale_factor', 'add_offset', 'scaling', 'valid_min', 'valid_max')
+
+# -----------------------------------------------------
+# Cloud-Optimized GeoTIFF layout of the outputs (set_cog)
+# -----------------------------------------------------
+_COG_OPTIONS = {'compress': 'DEFLATE', 'level': None, 'predictor': True,
+                'blocksize': 512, 'bigtiff': 'IF_SAFER', 'overviews': 'AUTO'}
 
 
 def get_keys(file: str):
@@ -41,17 +115,8 @@ def get_keys(file: str):
             A list of geophysical variables found in file containing Rrs and chlor_a
     """
 
-    if file.endswith('.nc'):
-        with Dataset(file, 'r') as nc:
-            keys = [key for key in nc.groups['geophysical_data'].variables.keys()
-                    if ('Rrs' in key) or ('chl' in key)]
-            return keys
-
-    if file.endswith('.h5'):
-        exclude = ['Cloud_probability', 'Line_tai93', 'QA_flag', 'TAUA_670', 'TAUA_865']
-        with h5py.File(file, 'r') as dst:
-            keys = list(dst[f'/Image_data/'].keys())
-        return [key for key in keys if key not in exclude]
+    with Granule(file=file) as granule:
+        return granule.get_keys()
 
 
 def get_attrs(file: str, loc=None, flag: str = 'nc'):
@@ -107,7 +172,8 @@ def get_attrs(file: str, loc=None, flag: str = 'nc'):
 
 
 def get_bounds(file: str):
-    """Gets the file geospatial boundaries
+    """Gets the file geospatial boundaries, from the global attributes (netCDF) or
+    the tie-point grid (SGLI), i.e., without decoding the full resolution geolocation
 
     Parameters
     ----------
@@ -119,63 +185,91 @@ def get_bounds(file: str):
         tuple
             (x0, x1, y0, y1): geospatial limits of the image
     """
-    if file.endswith('.nc'):
-        with Dataset(file, 'r') as nc:
-            x0 = (min(nc.geospatial_lon_min,
-                      nc.westernmost_longitude))
-            x1 = (max(nc.geospatial_lon_max,
-                      nc.easternmost_longitude))
+    with Granule(file=file) as granule:
+        return granule.get_bounds()
 
-            y0 = (min(nc.geospatial_lat_min,
-                      nc.southernmost_latitude))
-            y1 = (max(nc.geospatial_lat_max,
-                      nc.northernmost_latitude))
-        return x0, x1, y0, y1
 
-    if file.endswith('.h5'):
-        lat = get_geo(file=file, key='Latitude')
-        lon = get_geo(file=file, key='Longitude')
-        return lon.min(), lon.max(), lat.min(), lat.max()
+def get_overlap(file: str, subarea: dict):
+    """Fraction of the subarea covered by the granule footprint. Granules with
+    no overlap can be rejected before any data is decoded
+
+    Parameters
+    ----------
+    file: str
+       source file to extract geolocation information
+    subarea: dict
+        subarea dictionary with x0, x1, y0, y1 (see get_adef)
 
+    Returns
+    -------
+        float
+            overlap fraction, from 0 (no overlap) to 1
+    """
+    with Granule(file=file) as granule:
+        return granule.get_overlap(subarea=subarea)
 
-def geo_interp(src_geo: np.array, interval: int):
+
+def geo_interp(src_geo: np.array, interval: int, window: tuple = None, block_rows: int = 256):
     """Bilinear interpolation of SGLI geo-location corners to a spatial grid
     Code obtained from the GCOM-C PI kick-off meeting 201908
         sample_p3.py: Sample Code of the Practice 5
         Author: K. Ogata
         License: MIT
 
+    Memory-lean version: instead of repeating the whole grid along both axes, the tie-point
+    rows are first interpolated along the columns (1/interval of the output size) using a 1-D
+    ratio vector, then the output rows are interpolated block by block in float32.
+    Peak memory is about the size of the output plus one block
+
     Parameters
     ----------
     src_geo: np.array
         either lon or lat
     interval: int
         resampling interval in pixels
+    window: tuple
+        (row slice, column slice) of the interpolated grid to expand. Defaults to the
+        full grid (src_geo.shape * interval). Use it to expand only the image size or
+        the rows/cols intersecting a subarea (see Granule.geo_window)
+    block_rows: int
+        number of output rows interpolated at once
 
     Return
     ------
         np.array
-            2-D array
+            2-D float32 array
     """
 
+    rows, cols = src_geo.shape
     sds = np.concatenate((src_geo, src_geo[-1].reshape(1, -1)), axis=0)
-    sds = np.concatenate((sds, sds[:, -1].reshape(-1, 1)), axis=1)
-
-    ratio_0 = np.tile(
-        np.linspace(0, (interval - 1) / interval, interval, dtype=np.float32),
-        (sds.shape[0] * interval, sds.shape[1] - 1))
-
-    ratio_1 = np.tile(
-        np.linspace(0, (interval - 1) / interval, interval, dtype=np.float32).reshape(-1, 1),
-        (sds.shape[0] - 1, (sds.shape[1] - 1) * interval))
-
-    sds = np.repeat(sds, interval, axis=0)
-    sds = np.repeat(sds, interval, axis=1)
-    interp = (1. - ratio_0) * sds[:, :-interval] + ratio_0 * sds[:, interval:]
-    return (1. - ratio_1) * interp[:-interval, :] + ratio_1 * interp[interval:, :]
-
-
-def get_geo(file: str, key: str):
+    sds = np.concatenate((sds, sds[:, -1].reshape(-1, 1)), axis=1).astype(np.float32, copy=False)
+
+    if window is None:
+        window = slice(None), slice(None)
+    row = np.arange(rows * interval)[window[0]]
+    col = np.arange(cols * interval)[window[1]]
+    interp = np.empty((row.size, col.size), dtype=np.float32)
+    if interp.size == 0:
+        return interp
+
+    ratio = np.linspace(0, (interval - 1) / interval, interval, dtype=np.float32)
+    ratio_0 = ratio[col % interval]
+    ratio_1 = ratio[row % interval].reshape(-1, 1)
+    col, row = col // interval, row // interval
+
+    # tie-point rows needed by the window, interpolated along the columns
+    r0, r1 = row.min(), row.max()
+    ties = sds[r0:r1 + 2]
+    ties = (1. - ratio_0) * ties[:, col] + ratio_0 * ties[:, col + 1]
+    row = row - r0
+
+    for i in range(0, row.size, block_rows):
+        k = slice(i, i + block_rows)
+        interp[k] = (1. - ratio_1[k]) * ties[row[k]] + ratio_1[k] * ties[row[k] + 1]
+    return interp
+
+
+def get_geo(file: str, key: str, subarea: dict = None):
     """Navigation Data of the SGLI
     Parts of the code obtained from the GCOM-C PI kick-off meeting 201908
         Author: K. Ogata
@@ -187,6 +281,9 @@ def get_geo(file: str, key: str):
         full filename
     key: str
         Either Longitude or Latitude
+    subarea: dict
+        subarea dictionary (see get_adef). If given, only the rows/cols of the swath
+        intersecting the subarea are expanded and returned (see Granule.geo_window)
 
     Return
     ------
@@ -194,11 +291,598 @@ def get_geo(file: str, key: str):
             2-D array with dims == to geophysical variables
     """
 
-    with h5py.File(file, 'r') as h5:
-        nsl = h5['/Image_data'].attrs['Number_of_lines'][0]
-        psl = h5['/Image_data'].attrs['Number_of_pixels'][0]
-        img_size = (slice(0, nsl), slice(0, psl))
+    with Granule(file=file, subarea=subarea) as granule:
+        return granule.get_geo(key=key)
+
+
+def set_num_threads(threads: int):
+    """Sets the number of threads used by pyresample (nprocs), GDAL warping/compression
+    and numexpr if installed. Used to give each worker of a process pool its own thread
+    budget, so the machine is saturated without oversubscription
+
+    Parameters
+    ----------
+    threads: int
+        number of threads of the current process
+
+    Returns
+    -------
+        None
+    """
+    _THREADS.update(nprocs=threads, gdal=threads)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', f'{threads}')
+    if numexpr is not None:
+        numexpr.set_num_threads(threads)
+
+
+def set_geo_cache(maxsize: int = 4, cache_dir: str = None):
+    """Configures the SGLI geolocation cache. The bilinear expansion of the tie-point grid
+    (geo_interp) runs once per granule and key, and the result is kept in memory with
+    least-recently-used eviction. If cache_dir is given, the expanded grids are also persisted
+    as .npy sidecar files keyed by the hash of the granule geolocation, so they are reused
+    across processes and reruns
+
+    Parameters
+    ----------
+    maxsize: int
+        number of lon/lat grids kept in memory (one granule needs 2). 0 disables the memory cache
+    cache_dir: str
+        directory for the .npy sidecar files, kept under the set_cache_limit size.
+        None disables the persistent cache
+
+    Returns
+    -------
+        None
+    """
+    _GEO_CACHE_OPTIONS.update(maxsize=maxsize, cache_dir=cache_dir)
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    while len(_GEO_CACHE) > max(maxsize, 0):
+        _GEO_CACHE.popitem(last=False)
+
+
+def set_cache_limit(max_bytes: int = None):
+    """Caps the size of each persistent cache directory (geolocation .npy, see set_geo_cache,
+    and neighbour info .npz, see get_neighbours). The least recently used files are removed
+    once a new file makes the directory larger than max_bytes
+
+    Parameters
+    ----------
+    max_bytes: int
+        size limit in bytes of each cache directory. None for no limit
+
+    Returns
+    -------
+        None
+    """
+    _DISK_CACHE.update(max_bytes=max_bytes)
+
+
+def touch_cache(file: str):
+    """Marks a cache file as used (mtime), for the least-recently-used eviction"""
+    try:
+        os.utime(file)
+    except OSError:
+        pass
+
+
+def prune_cache(cache_dir: str, max_bytes: int = None):
+    """Removes the least recently used files of cache_dir until it holds at most max_bytes.
+    Files removed by another process meanwhile are ignored
+
+    Parameters
+    ----------
+    cache_dir: str
+        cache directory
+    max_bytes: int
+        size limit in bytes, defaults to the limit of set_cache_limit (None for no limit)
+
+    Returns
+    -------
+        int
+            number of files removed
+    """
+    max_bytes = _DISK_CACHE['max_bytes'] if max_bytes is None else max_bytes
+    if max_bytes is None:
+        return 0
+
+    files = []
+    for entry in os.scandir(cache_dir):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if entry.is_file():
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total, removed = sum(size for _, size, _ in files), 0
+    for _, size, file in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(file)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
+
+
+def set_spans(file: str = None):
+    """Enables the stage instrumentation (see span). Each stage appends one JSON line to file,
+    which can be shared by the worker processes of a batch. None disables it (default)
+
+    Parameters
+    ----------
+    file: str
+        JSON lines file, e.g., next to the task logs
+
+    Returns
+    -------
+        None
+    """
+    if file is not None and not os.path.isdir(os.path.dirname(os.path.abspath(file))):
+        os.makedirs(os.path.dirname(os.path.abspath(file)))
+    _SPANS['file'] = file
+
+
+@contextmanager
+def span_tags(**tags):
+    """Adds tags (e.g., granule=name) to the spans recorded within the context
+
+    Parameters
+    ----------
+    tags:
+        JSON serializable fields added to every span
+
+    Returns
+    -------
+        None
+    """
+    previous = dict(_SPANS['tags'])
+    _SPANS['tags'].update(tags)
+    try:
+        yield
+    finally:
+        _SPANS['tags'] = previous
+
+
+def _io_counters():
+    """Bytes read/written by the process from storage (Linux /proc/self/io), or None"""
+    try:
+        with open('/proc/self/io') as txt:
+            counters = dict(line.split(': ') for line in txt.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _max_rss():
+    """Peak resident set size of the process in bytes, or None"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """Times a processing stage: wall and CPU time, peak RSS (and its growth during the stage)
+    and bytes read/written, appended as one JSON line to the set_spans file. It costs nothing
+    while the instrumentation is disabled
+
+    Parameters
+    ----------
+    stage: str
+        stage name, e.g., read, decode, geo_interp, kdtree, resample, write_tif, warp
+    fields:
+        JSON serializable fields of the span, e.g., key=variable name
+
+    Returns
+    -------
+        None
+    """
+    if _SPANS['file'] is None:
+        yield
+        return
+
+    rss, io = _max_rss(), _io_counters()
+    start, cpu = time.time(), time.process_time()
+    wall = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        record = {**_SPANS['tags'], 'stage': stage, **fields, 'status': status,
+                  'pid': os.getpid(), 'start': round(start, 3),
+                  'wall_s': round(time.perf_counter() - wall, 6),
+                  'cpu_s': round(time.process_time() - cpu, 6)}
+        if rss is not None:
+            peak = _max_rss()
+            record.update(maxrss_mb=round(peak / 2 ** 20, 1), maxrss_growth_mb=round((peak - rss) / 2 ** 20, 1))
+        end = _io_counters()
+        if io is not None and end is not None:
+            record.update(read_bytes=end[0] - io[0], write_bytes=end[1] - io[1])
+        # one short append per line, safe to share between processes
+        with open(_SPANS['file'], 'a') as txt:
+            txt.write(json.dumps(record, default=str) + '\n')
+
+
+def geo_hash(h5: h5py.File):
+    """Hash of the SGLI geolocation of a granule, i.e., tie-point grids and image size
+
+    Parameters
+    ----------
+    h5: h5py.File
+        opened SGLI granule
+
+    Returns
+    -------
+        str
+            hex digest identifying the full resolution lon/lat of the granule
+    """
+    sha = hashlib.sha1()
+    sha.update(h5['/Image_data'].attrs['Number_of_lines'].tobytes())
+    sha.update(h5['/Image_data'].attrs['Number_of_pixels'].tobytes())
+    for key in ('Longitude', 'Latitude'):
+        sha.update(h5[f'Geometry_data/{key}'].attrs['Resampling_interval'].tobytes())
+        sha.update(h5[f'Geometry_data/{key}'][:].tobytes())
+    return sha.hexdigest()
+
+
+def get_data(file: str, key: str):
+    """Gets the key data from file
+    return masked array with geophysical data
 
+    Parameters
+    ----------
+    file: str
+        file name to read
+    key: str
+        pointer of the data to be read in the file
+
+    Returns
+    -------
+        dict:
+            data: geophysical data masked_array
+            attributes: key and global attributes
+    """
+
+    with Granule(file=file) as granule:
+        return granule.get_data(key=key)
+
+
+def get_matchups(file: str, lon: np.ndarray, lat: np.ndarray, keys: list = None,
+                 box: int = 3, max_distance: float = None):
+    """Extracts box x box pixel matchups (data and flags) around in-situ stations straight from
+    the swath geometry, without gridding nor raster I/O. Only the swath window around the
+    stations is read (see Granule.get_matchups)
+
+    Parameters
+    ----------
+    file: str
+        file name of the netCDF/hdf5 granule
+    lon: np.ndarray
+        station longitudes (deg E)
+    lat: np.ndarray
+        station latitudes (deg N)
+    keys: list
+        variables to extract, defaults to the geophysical variables (see get_keys)
+    box: int
+        odd box size in pixels, centred on the nearest swath pixel
+    max_distance: float
+        maximum station to pixel distance in metres, defaults to twice the swath resolution
+
+    Returns
+    -------
+        dict:
+            see Granule.get_matchups
+    """
+    lon, lat = np.atleast_1d(lon), np.atleast_1d(lat)
+    subarea = {'x0': float(np.nanmin(lon)) - 0.5, 'x1': float(np.nanmax(lon)) + 0.5,
+               'y0': float(np.nanmin(lat)) - 0.5, 'y1': float(np.nanmax(lat)) + 0.5}
+    with Granule(file=file, subarea=subarea) as granule:
+        return granule.get_matchups(lon=lon, lat=lat, keys=keys, box=box, max_distance=max_distance)
+
+
+def lonlat2xyz(lon: np.ndarray, lat: np.ndarray, radius: float = 6371008.8):
+    """Earth-centred cartesian coordinates (m) on the sphere, so that the euclidean
+    distance of a KD-tree is close to the great-circle distance at pixel scale
+
+    Parameters
+    ----------
+    lon: np.ndarray
+        longitude (deg E)
+    lat: np.ndarray
+        latitude (deg N)
+    radius: float
+        mean earth radius in metres
+
+    Returns
+    -------
+        np.ndarray
+            (n, 3) float64 coordinates
+    """
+    lon = np.deg2rad(np.asarray(lon, np.float64)).ravel()
+    lat = np.deg2rad(np.asarray(lat, np.float64)).ravel()
+    cos_lat = np.cos(lat)
+    return radius * np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+class Granule:
+    """Level-2 granule reader. The netCDF/hdf5 file is opened once and each variable
+    is decoded lazily when requested. Geolocation (lon/lat) and global attributes are
+    decoded only once and shared by all the variables read from the granule.
+
+    If a subarea is given, only the scan-line/pixel window of the swath intersecting the
+    subarea is read (hyperslabs) and decoded, see geo_window.
+
+    Parameters
+    ----------
+    file: str
+        file name of the netCDF/hdf5 granule
+    subarea: dict
+        subarea dictionary (see get_adef) restricting the reads to the swath window
+        intersecting it. The whole swath is read if None
+
+    Examples
+    --------
+    >>> with Granule(file='GC1SG1_202004140218J06809_L2SG_IWPRQ_2000.h5', subarea=subarea) as granule:
+    ...     for key in granule.get_keys():
+    ...         dataset = create_dataset(file=granule.file, key=key, subarea=subarea, granule=granule)
+    """
+
+    def __init__(self, file: str, subarea: dict = None):
+        self.file = file
+        self.flag = file[-2:]
+        self.subarea = subarea
+        self._window = None
+        self._fid = None
+        self._geo = {}
+        self._glob_attrs = None
+        self._neighbours = {}
+        self._tree = None
+        # one lock per file handle, netCDF-C/HDF5 reads are not thread safe (see get_lazy)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def fid(self):
+        """netCDF4 Dataset or h5py File of the granule, opened on first access"""
+        if self._fid is None:
+            self.open()
+        return self._fid
+
+    @property
+    def geo_keys(self):
+        """Longitude and latitude variable names"""
+        if self.flag == 'h5':
+            return 'Longitude', 'Latitude'
+        return 'longitude', 'latitude'
+
+    @property
+    def window(self):
+        """(row slice, column slice) of the swath read by get_geo and get_data"""
+        if self._window is None:
+            if self.subarea is not None:
+                self._window = self.geo_window(subarea=self.subarea)
+            elif self.flag == 'h5':
+                self._window = self.img_size
+            else:
+                self._window = slice(None), slice(None)
+        return self._window
+
+    def open(self):
+        """Opens the granule file, no-op if the file is already open"""
+        if self._fid is None:
+            if self.flag == 'nc':
+                self._fid = Dataset(self.file, 'r')
+            else:
+                self._fid = h5py.File(self.file, 'r')
+        return self
+
+    def close(self):
+        """Closes the granule file. Decoded geolocation remains available"""
+        if self._fid is not None:
+            self._fid.close()
+            self._fid = None
+
+    def get_keys(self):
+        """Gets the key (variable) names, see get_keys"""
+        if self.flag == 'nc':
+            return [key for key in self.fid.groups['geophysical_data'].variables.keys()
+                    if ('Rrs' in key) or ('chl' in key)]
+
+        exclude = ['Cloud_probability', 'Line_tai93', 'QA_flag', 'TAUA_670', 'TAUA_865']
+        keys = list(self.fid[f'/Image_data/'].keys())
+        return [key for key in keys if key not in exclude]
+
+    def get_attrs(self):
+        """Gets a copy of the granule global attributes
+
+        Returns
+        -------
+            dict:
+                attributes: global attributes
+        """
+        if self._glob_attrs is None:
+            loc = self.fid if self.flag == 'nc' else self.fid['/Global_attributes'].attrs
+            self._glob_attrs = get_attrs(file=self.file, loc=loc, flag=self.flag)
+        return dict(self._glob_attrs)
+
+    def get_bounds(self):
+        """Gets the granule geospatial boundaries, see get_bounds
+
+        Returns
+        -------
+            tuple
+                (x0, x1, y0, y1): geospatial limits of the image
+        """
+        if self.flag == 'nc':
+            nc = self.fid
+            x0 = (min(nc.geospatial_lon_min,
+                      nc.westernmost_longitude))
+            x1 = (max(nc.geospatial_lon_max,
+                      nc.easternmost_longitude))
+
+            y0 = (min(nc.geospatial_lat_min,
+                      nc.southernmost_latitude))
+            y1 = (max(nc.geospatial_lat_max,
+                      nc.northernmost_latitude))
+            return x0, x1, y0, y1
+
+        lon, lat = (self.get_tie_points(key=key) for key in self.geo_keys)
+        return np.nanmin(lon), np.nanmax(lon), np.nanmin(lat), np.nanmax(lat)
+
+    def get_overlap(self, subarea: dict):
+        """Fraction of the subarea covered by the granule bounds, see get_overlap.
+        Granules whose pixels (tie-points for SGLI) all fall outside the subarea do not overlap
+
+        Parameters
+        ----------
+        subarea: dict
+            subarea dictionary with x0, x1, y0, y1 (see get_adef)
+
+        Returns
+        -------
+            float
+                overlap fraction, from 0 (no overlap) to 1
+        """
+        x0, x1, y0, y1 = self.get_bounds()
+        if (x1 - x0) > 180.:
+            # crosses the dateline, keep all longitudes (no false rejection)
+            x0, x1 = -180., 180.
+        # shift the bounds into the longitude frame of the subarea, e.g., 185..195 for a
+        # granule at -175..-165 and a subarea at 170..190
+        shift = 360. * round(((subarea['x0'] + subarea['x1']) - (x0 + x1)) / 720.)
+        x0, x1 = x0 + shift, x1 + shift
+
+        dx = min(x1, subarea['x1']) - max(x0, subarea['x0'])
+        dy = min(y1, subarea['y1']) - max(y0, subarea['y0'])
+        if (dx <= 0) or (dy <= 0):
+            return 0.
+
+        # the bounds can intersect the subarea while no swath pixel does (curved swaths near
+        # the poles or the dateline), the resampling would then fail on an empty window
+        rows, _ = self.window if subarea == self.subarea else self.geo_window(subarea=subarea, margin=0)
+        if rows.stop == rows.start:
+            return 0.
+        return float(dx * dy / ((subarea['x1'] - subarea['x0']) * (subarea['y1'] - subarea['y0'])))
+
+    def get_geo(self, key: str, window: tuple = None):
+        """Gets the swath longitude or latitude. Geolocation is decoded once per granule
+        (tie-point interpolation in the case of SGLI) and shared afterwards
+
+        Parameters
+        ----------
+        key: str
+            Either Longitude or Latitude (longitude or latitude for netCDF)
+        window: tuple
+            (row slice, column slice) of the swath. Only this window is decoded
+            (not cached). Defaults to the granule window (see window)
+
+        Return
+        ------
+            np.array
+                2-D array with dims == to geophysical variables
+        """
+        if window is not None:
+            if self.flag == 'nc':
+                return self.fid.groups['navigation_data'][key][window]
+            return self._sgli_geo_interp(key=key, window=window)
+
+        if key not in self._geo:
+            if self.flag == 'nc':
+                with span('read', key=key):
+                    self._geo[key] = self.fid.groups['navigation_data'][key][self.window]
+            else:
+                self._geo[key] = self._sgli_geo(key=key)
+        return self._geo[key]
+
+    @property
+    def window_id(self):
+        """Window of the granule as a string, e.g. 0-4000_120-3200"""
+        return '_'.join(f'{sl.start}-{sl.stop}' for sl in self.window)
+
+    def _sgli_geo(self, key: str):
+        """Navigation Data of the SGLI, see get_geo. Looks up the geolocation cache
+        (set_geo_cache) before expanding the tie-point grid"""
+
+        stat = os.stat(self.file)
+        cache_key = os.path.realpath(self.file), stat.st_size, stat.st_mtime_ns, key, self.window_id
+        if cache_key in _GEO_CACHE:
+            _GEO_CACHE.move_to_end(cache_key)
+            return _GEO_CACHE[cache_key]
+
+        sidecar = None
+        if _GEO_CACHE_OPTIONS['cache_dir'] is not None:
+            sidecar = os.path.join(_GEO_CACHE_OPTIONS['cache_dir'],
+                                   f'{geo_hash(h5=self.fid)}_{key}_{self.window_id}.npy')
+
+        if (sidecar is not None) and os.path.isfile(sidecar):
+            with span('read', key=key, source='geo_cache'):
+                sds = np.load(sidecar)
+            touch_cache(file=sidecar)
+        else:
+            sds = self._sgli_geo_interp(key=key, window=self.window)
+            if sidecar is not None:
+                # write to a temp file first so concurrent readers never see a partial file
+                temp = f'{sidecar[:-4]}.{os.getpid()}.npy'
+                np.save(temp, sds)
+                os.replace(temp, sidecar)
+                prune_cache(cache_dir=_GEO_CACHE_OPTIONS['cache_dir'])
+
+        if _GEO_CACHE_OPTIONS['maxsize'] > 0:
+            _GEO_CACHE[cache_key] = sds
+            while len(_GEO_CACHE) > _GEO_CACHE_OPTIONS['maxsize']:
+                _GEO_CACHE.popitem(last=False)
+        return sds
+
+    @property
+    def img_size(self):
+        """(row slice, column slice) covering the whole SGLI image"""
+        attrs = self.fid['/Image_data'].attrs
+        return slice(0, attrs['Number_of_lines'][0]), slice(0, attrs['Number_of_pixels'][0])
+
+    def get_tie_points(self, key: str):
+        """Gets the SGLI tie-point grid of key, without interpolation, e.g., for the
+        granule bounds or footprint
+
+        Parameters
+        ----------
+        key: str
+            Longitude or Latitude
+
+        Returns
+        -------
+            np.array
+                tie-point grid, longitude in [-180, 180], NaN where invalid
+        """
+        if self.flag != 'h5':
+            raise ValueError(f'{os.path.basename(self.file)} has no tie-point grid (SGLI only)')
+        data = self._sgli_tie_points(key=key)[0]
+        if key == 'Longitude':
+            data[data > 180.] -= 360.
+        return data
+
+    def _sgli_tie_points(self, key: str):
+        """Decodes the SGLI tie-point grid of key (Longitude or Latitude)
+
+        Returns
+        -------
+            tuple
+                (tie-point grid, resampling interval, whether longitude strides 180)
+        """
+
+        h5 = self.fid
         data = h5[f'Geometry_data/{key}'][:]
         attrs = dict(h5[f'Geometry_data/{key}'].attrs)
 
@@ -229,105 +913,417 @@ def get_geo(file: str, key: str):
             data[data < 0] = 360. + data[data < 0]
 
         interval = h5[f'/Geometry_data/{key}'].attrs['Resampling_interval'][0]
-        sds = geo_interp(src_geo=data, interval=interval)[img_size]
+        return data, interval, is_stride_180
 
-    if is_stride_180:
-        sds[sds > 180.] = sds[sds > 180.] - 360.
-    return sds
+    def _sgli_geo_interp(self, key: str, window: tuple = None):
+        """Decodes the SGLI tie-point grid and interpolates it to the image size (or window)"""
 
+        with span('tie_points', key=key):
+            data, interval, is_stride_180 = self._sgli_tie_points(key=key)
+        with span('geo_interp', key=key):
+            sds = geo_interp(src_geo=data, interval=interval,
+                             window=self.img_size if window is None else window)
 
-def get_data(file: str, key: str):
-    """Gets the key data from file
-    return masked array with geophysical data
+        if is_stride_180:
+            sds[sds > 180.] -= 360.
+        return sds
+
+    def geo_window(self, subarea: dict, margin: int = 2):
+        """Gets the scan-line/pixel window of the swath intersecting the subarea. For SGLI the
+        window is found from the tie-point grid, without interpolation
+
+        Parameters
+        ----------
+        subarea: dict
+            subarea dictionary with x0, x1, y0, y1 (see get_adef)
+        margin: int
+            number of extra tie-points (SGLI) or pixels (netCDF) added around the window
+
+        Returns
+        -------
+            tuple
+                (row slice, column slice). Empty slices if the swath misses the subarea
+        """
+
+        if self.flag == 'nc':
+            lon, lat = (np.ma.filled(self.fid.groups['navigation_data'][key][:], np.nan)
+                        for key in self.geo_keys)
+            interval, (nsl, psl) = 1, lon.shape
+        else:
+            lon, interval, _ = self._sgli_tie_points(key='Longitude')
+            lat = self._sgli_tie_points(key='Latitude')[0]
+            nsl, psl = (size.stop for size in self.img_size)
+
+        width = subarea['x1'] - subarea['x0']
+        with np.errstate(invalid='ignore'):
+            # a global subarea (width of 360 deg) takes every longitude, the modulo would make it empty
+            in_lon = np.isfinite(lon) if width >= 360. else ((lon - subarea['x0']) % 360.) <= (width % 360.)
+            inside = in_lon & (lat >= subarea['y0']) & (lat <= subarea['y1'])
+
+        rows = np.flatnonzero(inside.any(axis=1))
+        cols = np.flatnonzero(inside.any(axis=0))
+        if rows.size == 0:
+            return slice(0, 0), slice(0, 0)
+
+        r0 = max(rows[0] - margin, 0) * interval
+        r1 = min((rows[-1] + margin + 1) * interval, nsl)
+        c0 = max(cols[0] - margin, 0) * interval
+        c1 = min((cols[-1] + margin + 1) * interval, psl)
+        return slice(r0, r1), slice(c0, c1)
+
+    def get_resolution(self):
+        """Gets the swath spatial resolution in metres (250 m for SGLI)
+
+        Returns
+        -------
+            float
+                pixel resolution in metres
+        """
+        sr = '250 m' if self.flag == 'h5' else self.get_attrs()['spatialResolution']
+        unit = ''.join(re.findall('[a-z]', sr, re.IGNORECASE))
+        sr = float(sr.strip(unit))
+        if unit.lower() == 'km':
+            sr *= 1000
+        return sr
+
+    def _sgli_scaling(self, key: str):
+        """SGLI DN to physical value slope and offset of key
+
+        Returns
+        -------
+            tuple
+                (hdf5 attributes, slope, offset)
+        """
+        attrs = dict(self.fid[f'Image_data/{key}'].attrs)
+        slope, offset = 1, 0
+        if 'NWLR' in key:
+            if ('Rrs_slope' in attrs.keys()) and \
+                    ('Rrs_offset' in attrs.keys()):
+                slope = attrs['Rrs_slope'][0]
+                offset = attrs['Rrs_offset'][0]
+        else:
+            if ('Slope' in attrs.keys()) and \
+                    ('Offset' in attrs.keys()):
+                slope = attrs['Slope'][0]
+                offset = attrs['Offset'][0]
+        return attrs, slope, offset
+
+    def get_lazy(self, key: str, chunks: int = 1024):
+        """Gets the key data as a lazy, chunked dask array (see swath_resample_lazy). Nothing is
+        read until the chunks are computed; each chunk is then read as a hyperslab and decoded
+        (DN to physical value, or tie-point interpolation for SGLI lon/lat) on its own.
+        The reads of all the arrays of the granule share one lock, as they share one file handle
+
+        Parameters
+        ----------
+        key: str
+            pointer of the data to be read in the file
+        chunks: int
+            chunk size in lines and pixels
+
+        Returns
+        -------
+            dict:
+                data: dask array with the masked pixels set to _FillValue (NaN for lon/lat)
+                attributes: key attributes
+        """
+        if da is None:
+            raise ImportError('the lazy mode requires dask (pip install "dask[array]")')
+
+        rows, cols = self.window
+        if self.flag == 'nc':
+            group = 'navigation_data' if key in self.geo_keys else 'geophysical_data'
+            sid = self.fid.groups[group][key]
+            attrs = get_attrs(file=self.file, loc=sid)
+            fill_value = np.nan if key in self.geo_keys else attrs['_FillValue']
+            dtype = sid.dtype if 'flag_meanings' in attrs.keys() else np.float32
+            sds = da.from_array(sid, chunks=chunks, lock=self._lock)[rows, cols].map_blocks(
+                lambda block: np.ma.filled(block, fill_value).astype(dtype), dtype=dtype)
+            return {**{key: sds}, **attrs}
+
+        h5 = self.fid
+        if key in self.geo_keys:
+            attrs = get_attrs(file=self.file, flag='h5', loc=h5[f'Geometry_data/{key}'].attrs)
+            data, interval, is_stride_180 = self._sgli_tie_points(key=key)
+            shape = rows.stop - rows.start, cols.stop - cols.start
+
+            def expand(block_info=None):
+                (i0, i1), (j0, j1) = block_info[None]['array-location']
+                sds = geo_interp(src_geo=data, interval=interval,
+                                 window=(slice(rows.start + i0, rows.start + i1),
+                                         slice(cols.start + j0, cols.start + j1)))
+                if is_stride_180:
+                    sds[sds > 180.] -= 360.
+                return sds
+
+            sds = da.map_blocks(expand, chunks=da.core.normalize_chunks(chunks, shape), dtype=np.float32)
+            return {**{key: sds}, **attrs}
+
+        attrs = get_attrs(file=self.file, flag='h5', loc=h5[f'Image_data/{key}'].attrs)
+        sdn = da.from_array(h5[f'Image_data/{key}'], chunks=chunks, lock=self._lock)[rows, cols]
+        if key == 'QA_flag':
+            attrs['_FillValue'] = attrs['Error_DN']
+            return {**{key: sdn}, **attrs}
+
+        dn_attrs, slope, offset = self._sgli_scaling(key=key)
+        fill_value = np.float32(-32767)
+        attrs['_FillValue'] = fill_value
+        sds = sdn.map_blocks(
+            lambda block: decode_dn(sdn=block, attrs=dn_attrs, slope=slope, offset=offset,
+                                    fill_value=fill_value).filled(fill_value),
+            dtype=np.float32)
+        return {**{key: sds}, **attrs}
+
+    def get_matchups(self, lon: np.ndarray, lat: np.ndarray, keys: list = None,
+                     box: int = 3, max_distance: float = None):
+        """Extracts box x box pixel matchups around stations, see get_matchups. The KD-tree of the
+        swath pixels (on the granule window lon/lat, see get_geo) is built once per granule, and
+        all the stations are matched in one query
+
+        Parameters
+        ----------
+        lon: np.ndarray
+            station longitudes (deg E)
+        lat: np.ndarray
+            station latitudes (deg N)
+        keys: list
+            variables to extract, defaults to the geophysical variables. The flags are always added
+        box: int
+            odd box size in pixels, centred on the nearest swath pixel
+        max_distance: float
+            maximum station to pixel distance in metres, defaults to twice the swath resolution
+
+        Returns
+        -------
+            dict:
+                distance: (n,) station to nearest pixel distance (m), inf if unmatched
+                row, col: (n,) nearest pixel line/pixel in the whole swath, -1 if unmatched
+                longitude, latitude and each key: (n, box, box) masked arrays, masked outside
+                the swath, for unmatched stations and for invalid pixels
+        """
+        if box % 2 == 0:
+            raise ValueError(f'box must be odd, got {box}')
+        flag = 'QA_flag' if self.flag == 'h5' else 'l2_flags'
+        keys = [key for key in (self.get_keys() if keys is None else list(keys)) if key != flag] + [flag]
+        max_distance = 2 * self.get_resolution() if max_distance is None else max_distance
+
+        swath_lon, swath_lat = (np.ma.filled(self.get_geo(key=key), np.nan) for key in self.geo_keys)
+        shape = swath_lon.shape
+        if self._tree is None:
+            with span('kdtree', matchups=True):
+                valid = np.flatnonzero(np.isfinite(swath_lon) & np.isfinite(swath_lat))
+                tree = None
+                if valid.size > 0:
+                    tree = KDTree(lonlat2xyz(lon=swath_lon.ravel()[valid], lat=swath_lat.ravel()[valid]))
+                self._tree = valid, tree
+        valid, tree = self._tree
+
+        # ------------------------------
+        # one query for all the stations
+        # ------------------------------
+        lon, lat = np.atleast_1d(lon), np.atleast_1d(lat)
+        if valid.size == 0:
+            # the granule window misses the stations
+            distance, index = np.full(lon.size, np.inf), np.zeros(lon.size, np.int64)
+            shape = max(shape[0], 1), max(shape[1], 1)
+            swath_lon, swath_lat = np.full(shape, np.nan), np.full(shape, np.nan)
+        else:
+            distance, index = tree.query(lonlat2xyz(lon=lon, lat=lat), k=1, distance_upper_bound=max_distance)
+        matched = np.isfinite(distance) & (index < valid.size)
+        row, col = np.unravel_index(valid[np.where(matched, index, 0)], shape)
+
+        # -----------------------
+        # box x box pixel windows
+        # -----------------------
+        offset = np.arange(box) - box // 2
+        rows = row[:, None, None] + offset[None, :, None]
+        cols = col[:, None, None] + offset[None, None, :]
+        outside = (rows < 0) | (rows >= shape[0]) | (cols < 0) | (cols >= shape[1]) | \
+                  ~matched[:, None, None]
+        rows, cols = np.clip(rows, 0, shape[0] - 1), np.clip(cols, 0, shape[1] - 1)
+
+        window = self.window
+        matchups = {'distance': np.where(matched, distance, np.inf),
+                    'row': np.where(matched, row + (window[0].start or 0), -1),
+                    'col': np.where(matched, col + (window[1].start or 0), -1)}
+        for key, sds in zip(self.geo_keys, (swath_lon, swath_lat)):
+            matchups[key.lower()] = np.ma.masked_where(outside, sds[rows, cols])
+        for key in keys:
+            if valid.size == 0:
+                matchups[key] = np.ma.masked_all(rows.shape)
+                continue
+            sds = self.get_data(key=key)[key]
+            matchups[key] = np.ma.masked_array(np.ma.getdata(sds)[rows, cols],
+                                               mask=np.ma.getmaskarray(sds)[rows, cols] | outside)
+        return matchups
+
+    def get_neighbours(self, swath: dict, trg_proj: AreaDefinition, cache_dir: str = None,
+                       neighbours: int = 1):
+        """Gets the neighbour info of the granule swath onto trg_proj, computed once per
+        target grid and shared by every variable of the granule (see get_neighbours)
+
+        Parameters
+        ----------
+        swath: dict
+            dataset from create_dataset, with epsilon added
+        trg_proj: AreaDefinition
+            target projection for data resampling
+        cache_dir: str
+            directory where the neighbour info is persisted (.npz), so reruns of the
+            same granule skip the neighbour search. None keeps it in memory only
+        neighbours: int
+            number of neighbours searched, > 1 for the gauss/mean kernels (see swath_resample)
+
+        Returns
+        -------
+            tuple
+                neighbour info, see get_neighbours
+        """
+        key = area_hash(area_def=trg_proj), swath['radius_of_influence'], swath['epsilon'], neighbours
+        if key not in self._neighbours:
+            cache_file = None
+            if cache_dir is not None:
+                # size and modification time, as the geolocation cache, a replaced granule gets a new key
+                stat = os.stat(self.file)
+                sha = hashlib.sha1(f'{stat.st_size}{stat.st_mtime_ns}{key}{self.window_id}'.encode()).hexdigest()
+                cache_file = os.path.join(cache_dir, f'{os.path.basename(self.file)}.{sha}.npz')
+            with span('kdtree', cached=cache_file is not None and os.path.isfile(cache_file)):
+                self._neighbours[key] = get_neighbours(
+                    swath=swath, trg_proj=trg_proj, cache_file=cache_file, neighbours=neighbours)
+        return self._neighbours[key]
+
+    def get_data(self, key: str):
+        """Gets the key data from the granule, see get_data
+
+        Parameters
+        ----------
+        key: str
+            pointer of the data to be read in the file
+
+        Returns
+        -------
+            dict:
+                data: geophysical data masked_array
+                attributes: key and global attributes
+        """
+
+        if self.flag == 'nc':
+            nc = self.fid
+            if key in self.geo_keys:
+                sid = nc.groups['navigation_data']
+                return {**{key: self.get_geo(key=key)},
+                        **get_attrs(file=self.file, loc=sid[key])}
+
+            sid = nc.groups['geophysical_data']
+            with span('read', key=key):
+                sds = sid[key][self.window]
+            return {**{key: sds},
+                    **get_attrs(file=self.file, loc=sid[key])}
+
+        h5 = self.fid
+        if key in self.geo_keys:
+            sid = self.get_geo(key=key)
+            attrs = get_attrs(file=self.file, flag='h5', loc=h5[f'Geometry_data/{key}'].attrs)
+            sds = {**{key: sid}, **attrs}
+
+        elif key == 'QA_flag':
+            attrs = get_attrs(file=self.file, flag='h5', loc=h5[f'Image_data/{key}'].attrs)
+            with span('read', key=key):
+                sdn = h5[f'Image_data/{key}'][self.window]
+            attrs['_FillValue'] = attrs['Error_DN']
+            sds = {**{key: sdn}, **attrs}
+
+        else:
+            fill_value = np.float32(-32767)
+            attrs, slope, offset = self._sgli_scaling(key=key)
+            with span('read', key=key):
+                sdn = h5[f'Image_data/{key}'][self.window]
+
+            # Convert DN to PV
+            with span('decode', key=key):
+                sds = decode_dn(sdn=sdn, attrs=attrs, slope=slope, offset=offset, fill_value=fill_value)
+            attrs = get_attrs(file=self.file, flag='h5', loc=h5[f'Image_data/{key}'].attrs)
+            attrs['_FillValue'] = fill_value
+            sds = {**{key: sds}, **attrs}
+        return sds
+
+
+def decode_dn(sdn: np.ndarray, attrs: dict, slope: float = 1, offset: float = 0,
+              fill_value: float = -32767):
+    """Converts SGLI digital numbers (DN) to physical values, masking the sentinel DNs
+    (Error_DN, Land_DN, Cloud_error_DN, Retrieval_error_DN) and the DNs outside
+    Minimum_valid_DN/Maximum_valid_DN.
+    For 8/16-bit DNs the mask is a single lookup in a table of all the possible DNs, and the
+    conversion is done in place in float32 (numexpr is used for the DN types it supports)
 
     Parameters
     ----------
-    file: str
-        file name to read
-    key: str
-        pointer of the data to be read in the file
+    sdn: np.ndarray
+        digital numbers
+    attrs: dict
+        hdf5 attributes of the variable
+    slope: float
+        DN to physical value slope
+    offset: float
+        DN to physical value offset
+    fill_value: float
+        value given to the masked pixels
 
     Returns
     -------
-        dict:
-            data: geophysical data masked_array
-            attributes: key and global attributes
+        np.ma.MaskedArray
+            float32 physical values
     """
 
-    if file.endswith('.nc'):
-        with Dataset(file, 'r') as nc:
-            if key in ('longitude', 'latitude'):
-                sid = nc.groups['navigation_data']
-            else:
-                sid = nc.groups['geophysical_data']
-
-            sds = {**{key: sid[key][:]},
-                   **get_attrs(file=file, loc=sid[key])}
-        return sds
-
-    if file.endswith('.h5'):
-        with h5py.File(file, 'r') as h5:
-            if key in ('Longitude', 'Latitude'):
-                sid = get_geo(file=file, key=key)
-                attrs = get_attrs(file=file, flag='h5', loc=h5[f'Geometry_data/{key}'].attrs)
-                sds = {**{key: sid}, **attrs}
-
-            elif key == 'QA_flag':
-                attrs = get_attrs(file=file, flag='h5', loc=h5[f'Image_data/{key}'].attrs)
-                sdn = h5[f'Image_data/{key}'][:]
-                attrs['_FillValue'] = attrs['Error_DN']
-                sds = {**{key: sdn}, **attrs}
+    sentinels = [attrs[name][0] for name in ('Error_DN', 'Land_DN', 'Cloud_error_DN', 'Retrieval_error_DN')
+                 if name in attrs.keys()]
+    valid = ('Minimum_valid_DN' in attrs.keys()) and ('Maximum_valid_DN' in attrs.keys())
+
+    # -------------------------
+    # one mask pass for all DNs
+    # -------------------------
+    if (sdn.dtype.kind in 'ui') and (sdn.dtype.itemsize <= 2):
+        unsigned = np.dtype(f'u{sdn.dtype.itemsize}')
+        values = np.arange(1 << (8 * sdn.dtype.itemsize), dtype=unsigned).view(sdn.dtype)
+        lut = np.isin(values, sentinels)
+        if valid:
+            lut |= (values < attrs['Minimum_valid_DN'][0]) | (values > attrs['Maximum_valid_DN'][0])
+        mask = lut[sdn.view(unsigned)]
+    else:
+        mask = np.isin(sdn, sentinels)
+        if valid:
+            mask |= sdn < attrs['Minimum_valid_DN'][0]
+            mask |= sdn > attrs['Maximum_valid_DN'][0]
 
-            else:
-                fill_value = np.float32(-32767)
-                attrs = dict(h5[f'Image_data/{key}'].attrs)
-                sdn = h5[f'Image_data/{key}'][:]
-
-                mask = np.bool_(np.zeros(sdn.shape))
-                if 'Error_DN' in attrs.keys():
-                    mask = mask | np.where(np.equal(sdn, attrs.pop('Error_DN')[0]), True, False)
-                if 'Land_DN' in attrs.keys():
-                    mask = mask | np.where(np.equal(sdn, attrs.pop('Land_DN')[0]), True, False)
-                if 'Cloud_error_DN' in attrs.keys():
-                    mask = mask | np.where(np.equal(sdn, attrs.pop('Cloud_error_DN')[0]), True, False)
-                if 'Retrieval_error_DN' in attrs.keys():
-                    mask = mask | np.where(np.equal(sdn, attrs.pop('Retrieval_error_DN')[0]), True, False)
-                if ('Minimum_valid_DN' in attrs.keys()) and ('Maximum_valid_DN' in attrs.keys()):
-                    mask = mask | np.where((sdn < attrs.pop('Minimum_valid_DN')) |
-                                           (sdn > attrs.pop('Maximum_valid_DN')), True, False)
-
-                # Convert DN to PV
-                slope, offset = 1, 0
-                if 'NWLR' in key:
-                    if ('Rrs_slope' in attrs.keys()) and \
-                            ('Rrs_slope' in attrs.keys()):
-                        slope = attrs.pop('Rrs_slope')[0]
-                        offset = attrs.pop('Rrs_offset')[0]
-                else:
-                    if ('Slope' in attrs.keys()) and \
-                            ('Offset' in attrs.keys()):
-                        slope = attrs.pop('Slope')[0]
-                        offset = attrs.pop('Offset')[0]
-
-                sds = sdn * slope + offset
-                sds[mask] = fill_value
-                attrs = get_attrs(file=file, flag='h5', loc=h5[f'Image_data/{key}'].attrs)
-                attrs['_FillValue'] = fill_value
-                sds = {**{key: np.ma.masked_where(mask, sds).astype(np.float32)}, **attrs}
-        return sds
+    # -----------------------
+    # DN to PV, float32 fused
+    # -----------------------
+    slope, offset, fill_value = np.float32(slope), np.float32(offset), np.float32(fill_value)
+    sds = np.empty(sdn.shape, dtype=np.float32)
+    if (numexpr is not None) and (sdn.dtype in (np.int32, np.int64, np.float32, np.float64)):
+        numexpr.evaluate('where(mask, fill_value, sdn * slope + offset)', out=sds, casting='unsafe')
+    else:
+        np.multiply(sdn, slope, out=sds)
+        sds += offset
+        np.putmask(sds, mask, fill_value)
+    return np.ma.MaskedArray(sds, mask=mask, copy=False)
 
 
-def create_dataset(file: str, key: str, subarea: dict):
+def create_dataset(file: str, key, subarea: dict, granule: Granule = None):
     """Constructs a dataset for a given key
 
     Parameters
     ----------
     file: str
         file name to read
-    key: str
-        variable name
+    key: str | list
+        variable name, or list of variable names stacked as channels in the given order
     subarea: dict
         area definition for pyresample
+    granule: Granule
+        opened granule of file. Pass the same Granule for every key of a file so the
+        file is opened once and the geolocation is decoded once. Opened here if None,
+        reading only the swath window intersecting the subarea
 
     Returns
     -------
@@ -337,29 +1333,31 @@ def create_dataset(file: str, key: str, subarea: dict):
             proj: AreaDefinition
     """
 
-    dataset = get_data(file=file, key=key)
-    data = dataset.pop(key)
-    fill_value = dataset['_FillValue']
-    dataset = {key: dataset}
-    data = np.ma.dstack((data,))
-    np.ma.set_fill_value(data, fill_value=fill_value)
+    if granule is None:
+        with Granule(file=file, subarea=subarea) as granule:
+            return create_dataset(file=file, key=key, subarea=subarea, granule=granule)
+
+    keys = [key] if isinstance(key, str) else list(key)
+    dataset, channels = {}, []
+    for var in keys:
+        sds = granule.get_data(key=var)
+        channels.append(sds.pop(var))
+        dataset[var] = sds
+    data = np.ma.dstack(channels)
+    np.ma.set_fill_value(data, fill_value=dataset[keys[0]]['_FillValue'])
     dataset.update({'channels': data})
 
     # -----------------
     # Global attributes
     # -----------------
-    glob_attrs = get_attrs(file=file, flag=file[-2:])
+    glob_attrs = granule.get_attrs()
 
     # ------------------
     # spatial resolution
     # ------------------
     if file.endswith('.h5'):
         glob_attrs['spatialResolution'] = '250 m'
-    sr = glob_attrs['spatialResolution']
-    unit = ''.join(re.findall('[a-z]', sr, re.IGNORECASE))
-    sr = float(sr.strip(unit))
-    if unit.lower() == 'km':
-        sr *= 1000
+    sr = granule.get_resolution()
 
     # -----------------------
     # pyresample --> proj map
@@ -371,20 +1369,19 @@ def create_dataset(file: str, key: str, subarea: dict):
     # ---------------------
     # swath geoloc lon/lat
     # ---------------------
-    keys = ('Longitude', 'Latitude') \
-        if file.endswith('.h5') \
-        else ('longitude', 'latitude')
-
-    for loc in keys:
-        out = get_data(file=file, key=loc)
-        dataset.update({loc.lower(): out.pop(loc)})
+    for loc in granule.geo_keys:
+        dataset.update({loc.lower(): granule.get_geo(key=loc)})
 
     return dataset
 
 
 def get_adef(pixel_resolution: float, subarea: dict):
     """Generates the grid projection for mapping L2 data based on input data resolution.
-    If lonlat griding scheme is used, the grid resolution will be exact at the centre
+    If lonlat griding scheme is used, the grid resolution will be exact at the centre.
+    With proj_id EPSG:4326 the grid is the final geographic grid, so the resampled data
+    can be written as the upload-ready geotif without a second warp (see gdal_translate).
+    Grids are memoized by (subarea, resolution, proj_id), the same AreaDefinition is
+    returned for every granule of a batch
 
     Parameters
     ----------
@@ -398,13 +1395,22 @@ def get_adef(pixel_resolution: float, subarea: dict):
         y1 float: latitude (deg N)  of the upper right corner
         area_id str: string with subarea id
         area_name: string name of the subarea
-        proj_id: string name of the projection being used (any recognised by pyproj)
+        proj_id: string name of the projection being used (any recognised by pyproj, or EPSG:4326)
 
     Returns
     -------
     AreaDefinition: AreaDefinition
        area definition with pyproj information embedded
     """
+    key = (float(pixel_resolution), subarea['proj_id'], subarea['area_id'], subarea['area_name'],
+           float(subarea['x0']), float(subarea['y0']), float(subarea['x1']), float(subarea['y1']))
+    if key not in _ADEF_CACHE:
+        _ADEF_CACHE[key] = _area_def(pixel_resolution=pixel_resolution, subarea=subarea)
+    return _ADEF_CACHE[key]
+
+
+def _area_def(pixel_resolution: float, subarea: dict):
+    """Creates the grid of get_adef (not memoized)"""
     # --------------
     # subarea limits (box)
     # --------------
@@ -421,6 +1427,19 @@ def get_adef(pixel_resolution: float, subarea: dict):
     area_id = subarea['area_id']
     area_name = subarea['area_name']
 
+    if proj_id.upper() == 'EPSG:4326':
+        # final lon/lat grid, pixel size in degrees equal to pixel_resolution at the centre
+        g = pyproj.Geod(ellps=datum)
+        x_pixel_size = (pixel_resolution * 360.) / (2. * np.pi * g.a * np.cos(np.deg2rad(lat_0)))
+        y_pixel_size = (pixel_resolution * 360.) / (2. * np.pi * g.b)
+        x_size = int(round((lon_box[1] - lon_box[0]) / x_pixel_size))
+        y_size = int(round((lat_box[1] - lat_box[0]) / y_pixel_size))
+        area_extent = lon_box[0], lat_box[0], lon_box[1], lat_box[1]
+        return AreaDefinition(
+            area_id, area_name, proj_id, 'EPSG:4326',
+            x_size, y_size, area_extent
+        )
+
     # -----------
     # pyproj proj
     # -----------
@@ -461,6 +1480,49 @@ def get_adef(pixel_resolution: float, subarea: dict):
     )
 
 
+def grid_bounds(proj: AreaDefinition):
+    """Lon/lat bounds of the grid pixel centres, memoized per grid. Computed from the
+    projection coordinates of the grid perimeter (plus the top row and left column for the
+    centre), without the full grid lon/lats. The extremes are on the perimeter as long as
+    the grid does not contain a pole
+
+    Parameters
+    ----------
+    proj: AreaDefinition
+       AreaDefinition with grid resampling information
+
+    Returns
+    -------
+    dict
+       lon_min, lon_max, lat_min, lat_max, center_lon (mean of the top row) and
+       center_lat (mean of the left column)
+    """
+    key = area_hash(area_def=proj)
+    if key in _BOUNDS_CACHE:
+        return _BOUNDS_CACHE[key]
+
+    x = proj.projection_x_coords
+    y = proj.projection_y_coords
+    if proj.crs.is_geographic:
+        top_lon, left_lat = x, y
+        lon = np.concatenate([x, x[[0, -1]]])
+        lat = np.concatenate([y[[0, -1]], y])
+    else:
+        # perimeter, top row first then left column, in projection coordinates
+        px = np.concatenate([x, x, np.full(y.size, x[0]), np.full(y.size, x[-1])])
+        py = np.concatenate([np.full(x.size, y[0]), np.full(x.size, y[-1]), y, y])
+        transformer = pyproj.Transformer.from_crs(proj.crs, 'EPSG:4326', always_xy=True)
+        lon, lat = transformer.transform(px, py)
+        top_lon = lon[:x.size]
+        left_lat = lat[2 * x.size:2 * x.size + y.size]
+
+    bounds = {'lon_min': np.nanmin(lon), 'lon_max': np.nanmax(lon),
+              'lat_min': np.nanmin(lat), 'lat_max': np.nanmax(lat),
+              'center_lon': np.nanmean(top_lon), 'center_lat': np.nanmean(left_lat)}
+    _BOUNDS_CACHE[key] = bounds
+    return bounds
+
+
 def fix_bounds(metadata: dict, proj: AreaDefinition):
     """updates the global attributes with information of the new resampling grid
 
@@ -477,11 +1539,11 @@ def fix_bounds(metadata: dict, proj: AreaDefinition):
        Attributes with geospatial information updated to new grid
     """
 
-    lon, lat = proj.get_lonlats()
-    metadata['geospatial_lat_min'] = lon.min()
-    metadata['geospatial_lat_max'] = lon.max()
-    metadata['geospatial_lon_min'] = lat.min()
-    metadata['geospatial_lon_max'] = lat.max()
+    bounds = grid_bounds(proj=proj)
+    metadata['geospatial_lat_min'] = bounds['lat_min']
+    metadata['geospatial_lat_max'] = bounds['lat_max']
+    metadata['geospatial_lon_min'] = bounds['lon_min']
+    metadata['geospatial_lon_max'] = bounds['lon_max']
 
     if 'start_center_longitude' in metadata.keys():
         metadata.pop('start_center_longitude')
@@ -492,13 +1554,13 @@ def fix_bounds(metadata: dict, proj: AreaDefinition):
     if 'end_center_latitude' in metadata.keys():
         metadata.pop('end_center_latitude')
 
-    metadata['center_longitude'] = lon[0, :].mean()
-    metadata['center_latitude'] = lat[:, 0].mean()
+    metadata['center_longitude'] = bounds['center_lon']
+    metadata['center_latitude'] = bounds['center_lat']
 
-    metadata['northernmost_latitude'] = lat.max()
-    metadata['southernmost_latitude'] = lat.min()
-    metadata['easternmost_longitude'] = lon.max()
-    metadata['westernmost_longitude'] = lon.min()
+    metadata['northernmost_latitude'] = bounds['lat_max']
+    metadata['southernmost_latitude'] = bounds['lat_min']
+    metadata['easternmost_longitude'] = bounds['lon_max']
+    metadata['westernmost_longitude'] = bounds['lon_min']
 
     return metadata
 
@@ -533,8 +1595,13 @@ def split_flags(data: np.ndarray, flag_names: list):
     return np.ma.dstack(sds), bits
 
 
-def flags_band(dataset: dict, key: str, src_tif: str, dst_tif: str):
-    """Get the file geospatial boundaries
+def flags_band(dataset: dict, key: str, src_tif: str, dst_tif: str, neighbour_info: tuple = None,
+               packed: bool = True, packing: bool = False):
+    """Resamples and reprojects the level-2 flags.
+    By default the packed integer flags are resampled directly: nearest neighbour copies
+    a whole source pixel, so every bit is preserved and the flags cost the same as one
+    float band (one resample, one write and one warp). With packed=False, the flags are
+    split into one plane per bit and each plane is warped and joined back
 
     Parameters
     ----------
@@ -546,6 +1613,13 @@ def flags_band(dataset: dict, key: str, src_tif: str, dst_tif: str):
        source file being reprojected
     dst_tif: str
        target file after reprojected
+    neighbour_info: tuple
+       precomputed neighbour info (see get_neighbours)
+    packed: bool
+       whether to resample the packed flags at once or split them per bit
+    packing: bool
+       whether to write the packed flags in the smallest unsigned type holding the flag bits
+       (see flag_type) instead of Int32
 
     Returns
     -------
@@ -572,6 +1646,30 @@ def flags_band(dataset: dict, key: str, src_tif: str, dst_tif: str):
                          if len(flag) > 0]
         attrs['flag_meanings'] = ' '.join(flag_meanings)
 
+    if packed:
+        # -- resample packed flags (nearest keeps the bits) --
+        result = swath_resample(swath=dataset, trg_proj=proj, neighbour_info=neighbour_info)
+        np.ma.set_fill_value(result, fill_value=fill_value)
+
+        data_type = 'Int32'
+        if packing:
+            data_type, fill_value = flag_type(attrs=attrs)
+            attrs['_FillValue'] = fill_value
+
+        # -- already on the EPSG:4326 target grid, write the final tif --
+        direct = proj.crs.to_epsg() == 4326
+        meta = write_tif(file=dst_tif if direct else src_tif,
+                         dataset=result,
+                         data_type=data_type,
+                         metadata={key: attrs, 'glob_attrs': glob_attrs},
+                         area_def=proj,
+                         cog=direct)
+
+        # -- warp/translate, nearest neighbour --
+        if not direct:
+            gdal_translate(src_tif=src_tif, dst_tif=dst_tif, nodata=fill_value, ot=data_type)
+        return meta
+
     # -- split --
     sds, bits = split_flags(
         data=dataset['channels'],
@@ -579,7 +1677,7 @@ def flags_band(dataset: dict, key: str, src_tif: str, dst_tif: str):
     dataset.update({'channels': sds})
 
     # -- resample --
-    result = swath_resample(swath=dataset, trg_proj=proj)
+    result = swath_resample(swath=dataset, trg_proj=proj, neighbour_info=neighbour_info)
     np.ma.set_fill_value(result, fill_value=fill_value)
 
     # -- temp geotif --
@@ -612,9 +1710,7 @@ def flags_band(dataset: dict, key: str, src_tif: str, dst_tif: str):
              dst_tif=dst_tif,
              data=sds)
 
-    fdir, bsn = os.path.split(temp)
-    cmd = f'del /f {bsn}' if os.name == 'nt' else f'rm -f {bsn}'
-    subprocess.call(cmd, cwd=fdir, shell=True)
+    os.remove(temp)
 
     # cmap = 'RdBu_r'
     # fig, ax = plt.subplots(figsize=(6, 4))
@@ -626,10 +1722,238 @@ def flags_band(dataset: dict, key: str, src_tif: str, dst_tif: str):
     return meta
 
 
-def swath_resample(swath: dict, trg_proj: AreaDefinition):
+def swath_resample_lazy(granule: Granule, keys: list, subarea: dict, file: str,
+                        epsilon: float = 0.3, chunks: int = 1024, block_rows: int = 512,
+                        cog: bool = False):
+    """Lazy, chunked resampling with bounded memory, for granules too large to be resampled
+    in memory (e.g., 250 m SGLI). The granule variables and geolocation are dask arrays
+    (see Granule.get_lazy). The target grid is processed in blocks of rows: for each block
+    only the swath chunks whose footprint intersects the block are computed, resampled and
+    written into the output geotif. Peak memory is about one target block plus the swath
+    chunks it covers, instead of the whole swath and grid
+
+    Parameters
+    ----------
+    granule: Granule
+        opened granule
+    keys: list
+        variable names written as bands, either continuous variables or one flag variable
+    subarea: dict
+        area definition for pyresample (see get_adef)
+    file: str
+        output geotif (tiled, LZW compressed)
+    epsilon: float
+        allowed uncertainty in the neighbour search
+    chunks: int
+        swath chunk size in lines and pixels
+    block_rows: int
+        number of target grid rows resampled at once
+    cog: bool
+        whether to write file as a Cloud-Optimized GeoTIFF (see cog_options), i.e., the final
+        upload-ready file when the subarea grid is EPSG:4326. The blocks are then written to
+        a temporary geotif on disk next to file, which is converted and removed
+
+    Returns
+    -------
+        dict
+            global and var attributes (see write_tif)
+    """
+
+    warnings.filterwarnings('ignore')
+    keys = [keys] if isinstance(keys, str) else list(keys)
+
+    # -----------------------------
+    # lazy swath and the target grid
+    # -----------------------------
+    glob_attrs = granule.get_attrs()
+    if granule.flag == 'h5':
+        glob_attrs['spatialResolution'] = '250 m'
+    sr = granule.get_resolution()
+    proj = get_adef(pixel_resolution=sr, subarea=subarea)
+    glob_attrs = fix_bounds(metadata=glob_attrs, proj=proj)
+
+    lon, lat = (granule.get_lazy(key=loc, chunks=chunks)[loc] for loc in granule.geo_keys)
+    bands = [granule.get_lazy(key=key, chunks=chunks) for key in keys]
+    data = [band.pop(key) for key, band in zip(keys, bands)]
+    fill_values = [band['_FillValue'] for band in bands]
+
+    # ---------------------------------------------
+    # footprint of each swath chunk, (rows, cols, 4)
+    # ---------------------------------------------
+    def chunk_bounds(lo, la):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return np.array([np.nanmin(lo), np.nanmax(lo),
+                             np.nanmin(la), np.nanmax(la)]).reshape(1, 1, 4)
+
+    bounds = da.map_blocks(chunk_bounds, lon, lat, new_axis=2,
+                           chunks=(1, 1, 4), dtype=np.float64).compute()
+    row_edges = np.cumsum((0,) + lon.chunks[0])
+    col_edges = np.cumsum((0,) + lon.chunks[1])
+    # search margin (deg) so that swath pixels within the radius of influence are included
+    margin = 2. * sr / (111e3 * np.cos(np.deg2rad(min(max(abs(subarea['y0']), abs(subarea['y1'])), 85.))))
+
+    # ---------------------
+    # create the output tif
+    # ---------------------
+    data_type = 'Int32' if keys[0] in ('l2_flags', 'QA_flag') else 'Float32'
+    fill_type = int if data_type == 'Int32' else float
+    meta = {key: f'{val}' for key, val in glob_attrs.items()}
+    # the COG driver only converts complete datasets, the blocks go to a temporary geotif first
+    blocks_file = f'{os.path.splitext(file)[0]}.blocks.{os.getpid()}.tif' if cog else file
+    trg_dst = create_tif(file=blocks_file, area_def=proj, n_bands=len(keys), metadata=meta,
+                         data_type=data_type, options=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+    for i, name in enumerate(keys):
+        trg_dst.GetRasterBand(i + 1).SetDescription(name)
+        trg_dst.GetRasterBand(i + 1).SetNoDataValue(fill_type(fill_values[i]))
+
+    # ------------------------------
+    # resample/write block by block
+    # ------------------------------
+    valid_min = np.full(len(keys), np.inf)
+    valid_max = np.full(len(keys), -np.inf)
+    for r0 in range(0, proj.height, block_rows):
+        sub = proj[r0:r0 + block_rows, :]
+        result = np.ma.masked_all((sub.height, sub.width, len(keys)))
+
+        blon, blat = sub.get_lonlats()
+        hit = (bounds[..., 1] >= np.nanmin(blon) - margin) & (bounds[..., 0] <= np.nanmax(blon) + margin) & \
+              (bounds[..., 3] >= np.nanmin(blat) - margin) & (bounds[..., 2] <= np.nanmax(blat) + margin)
+        blon = blat = None
+
+        if hit.any():
+            rows, cols = np.nonzero(hit)
+            win = (slice(row_edges[rows.min()], row_edges[rows.max() + 1]),
+                   slice(col_edges[cols.min()], col_edges[cols.max() + 1]))
+            slon, slat, *sdata = da.compute(lon[win], lat[win], *[sds[win] for sds in data])
+            channels = np.ma.dstack([np.ma.masked_equal(sds, fill_value)
+                                     for sds, fill_value in zip(sdata, fill_values)])
+            src_proj = SwathDefinition(lons=np.ma.masked_invalid(slon),
+                                       lats=np.ma.masked_invalid(slat))
+            result = resample_nearest(
+                src_proj, channels, sub, fill_value=None,
+                epsilon=epsilon, nprocs=_THREADS['nprocs'],
+                radius_of_influence=sr).reshape(sub.height, sub.width, len(keys))
+
+        for i, fill_value in enumerate(fill_values):
+            sds = result[:, :, i]
+            if sds.count() > 0:
+                valid_min[i] = min(valid_min[i], sds.min())
+                valid_max[i] = max(valid_max[i], sds.max())
+            trg_dst.GetRasterBand(i + 1).WriteArray(np.ma.filled(sds, fill_value), 0, r0)
+
+    # ---------------
+    # band attributes
+    # ---------------
+    for i, (name, band) in enumerate(zip(keys, bands)):
+        if data_type == 'Float32':
+            band['valid_min'] = np.float32(valid_min[i])
+            band['valid_max'] = np.float32(valid_max[i])
+        band.pop('scale_factor', None)
+        band.pop('add_offset', None)
+        band_meta = {key: f'{val}' for key, val in band.items()}
+        trg_dst.GetRasterBand(i + 1).SetMetadata(band_meta)
+        band_attributes(meta=meta, name=name, band_meta=band_meta)
+
+    if cog:
+        with span('write_tif', bands=len(keys), cog=True):
+            cog_dst = gdal.GetDriverByName('COG').CreateCopy(
+                file, trg_dst, options=cog_options(data_type=data_type))
+            if cog_dst is None:
+                raise RuntimeError(f'COG write failed for {file}: {gdal.GetLastErrorMsg()}')
+            cog_dst = None
+    # ------------------
+    # close output image
+    # ------------------
+    trg_dst = None
+    if cog:
+        gdal.GetDriverByName('GTiff').Delete(blocks_file)
+    return meta
+
+
+def area_hash(area_def: AreaDefinition):
+    """Hash identifying a target grid (projection, extent and size)
+
+    Parameters
+    ----------
+    area_def: AreaDefinition
+        target grid
+
+    Returns
+    -------
+        str
+            hex digest of the grid definition
+    """
+    grid = f'{area_def.proj_str}|{area_def.area_extent}|{area_def.shape}'
+    return hashlib.sha1(grid.encode()).hexdigest()
+
+
+def get_neighbours(swath: dict, trg_proj: AreaDefinition, cache_file: str = None, neighbours: int = 1):
+    """Searches the swath neighbour(s) of each trg_proj pixel (KD-tree) once, so that
+    every variable of a granule is resampled with get_sample_from_neighbour_info
+    instead of repeating the search (see swath_resample). With neighbours > 1 the
+    search radius is doubled so that the k neighbours feed the gauss and mean kernels,
+    and the nearest neighbour is still taken from the same search
+
+    Parameters
+    ----------
+        swath: dict
+            dictionary with keys (not consumed)
+                radius_of_influence float:
+                    search distance in m for data resampling
+                epsilon float:
+                    allowed uncertainty in the neighbour search
+                latitude array:
+                    latitude with swath pixel_control_points and number_of_lines
+                longitude ndarray:
+                    longitude with swath pixel_control_points and number_of_lines
+        trg_proj: AreaDefinition
+            target projection for data resampling
+        cache_file: str
+            .npz file where the neighbour info is loaded from, or saved to if missing.
+            The directory is kept under the set_cache_limit size
+        neighbours: int
+            number of neighbours searched, 1 for nearest only
+
+    Returns
+    -------
+        tuple
+            (valid_input_index, valid_output_index, index_array, distance_array)
+    """
+
+    names = 'valid_input_index', 'valid_output_index', 'index_array', 'distance_array'
+    if (cache_file is not None) and os.path.isfile(cache_file):
+        with np.load(cache_file) as npz:
+            neighbour_info = tuple(npz[name] for name in names)
+        touch_cache(file=cache_file)
+        return neighbour_info
+
+    src_proj = SwathDefinition(
+        lons=swath['longitude'],
+        lats=swath['latitude'])
+
+    radius = swath['radius_of_influence'] * (1 if neighbours == 1 else 2)
+    neighbour_info = get_neighbour_info(
+        src_proj, trg_proj, radius,
+        neighbours=neighbours, epsilon=swath['epsilon'], nprocs=_THREADS['nprocs'])
+
+    if cache_file is not None:
+        # write to a temp file first so concurrent readers never see a partial file
+        temp = f'{cache_file[:-4]}.{os.getpid()}.npz'
+        np.savez(temp, **dict(zip(names, neighbour_info)))
+        os.replace(temp, cache_file)
+        prune_cache(cache_dir=os.path.dirname(os.path.abspath(cache_file)))
+    return neighbour_info
+
+
+def swath_resample(swath: dict, trg_proj: AreaDefinition, neighbour_info: tuple = None,
+                   method: str = 'nearest', neighbours: int = 8):
     """
     resamples swath data into a new grid defined by trg_proj.
-    trg_proj is constructed using pyresample (see map_proj)
+    trg_proj is constructed using pyresample (see map_proj).
+    The gauss and mean kernels weight the k neighbours of a single neighbour search,
+    which also gives the nearest neighbour (see get_neighbours), so a granule can be
+    resampled with several methods for about the cost of one search
 
     Parameters
     ----------
@@ -645,6 +1969,15 @@ def swath_resample(swath: dict, trg_proj: AreaDefinition):
                     longitude with swath pixel_control_points and number_of_lines
         trg_proj: AreaDefinition
             target projection for data resampling
+        neighbour_info: tuple
+            precomputed neighbour info of the swath onto trg_proj (see get_neighbours).
+            If given, the KD-tree search is skipped
+        method: str
+            nearest, gauss (weights exp(-d^2/sigma^2), sigma = radius_of_influence / 2)
+            or mean (average of the neighbours within 2 x radius_of_influence, e.g., when
+            the target grid is coarser than the swath). Flags must use nearest
+        neighbours: int
+            number of neighbours searched for gauss/mean when neighbour_info is not given
 
     Returns
     -------
@@ -653,6 +1986,8 @@ def swath_resample(swath: dict, trg_proj: AreaDefinition):
     """
 
     warnings.filterwarnings('ignore')
+    if method not in RESAMPLE_METHODS:
+        raise ValueError(f'unknown resampling method {method}, expected one of {RESAMPLE_METHODS}')
 
     epsilon = swath.pop('epsilon')
     radius_of_influence = swath.pop('radius_of_influence')
@@ -662,55 +1997,146 @@ def swath_resample(swath: dict, trg_proj: AreaDefinition):
         lons=swath.pop('longitude'),
         lats=swath.pop('latitude'))
 
-    nprocs = 4 if len(src_sds.shape) > 2 else 1
-    result = resample_nearest(
-        src_proj, src_sds, trg_proj, fill_value=None,
-        epsilon=epsilon, nprocs=nprocs,
-        radius_of_influence=radius_of_influence)
+    if (neighbour_info is None) and (method != 'nearest'):
+        with span('kdtree', neighbours=neighbours):
+            neighbour_info = get_neighbours(
+                swath={'longitude': src_proj.lons, 'latitude': src_proj.lats,
+                       'radius_of_influence': radius_of_influence, 'epsilon': epsilon},
+                trg_proj=trg_proj, neighbours=neighbours)
+
+    if neighbour_info is not None:
+        valid_input_index, valid_output_index, index_array, distance_array = neighbour_info
+        if (method == 'nearest') and (index_array.ndim > 1):
+            # first (closest) neighbour of a k-neighbour search, within the nearest radius
+            index_array = np.where(distance_array[:, 0] > radius_of_influence,
+                                   valid_input_index.sum(), index_array[:, 0])
+
+        with span('resample', neighbours=True, method=method):
+            if method == 'nearest':
+                return get_sample_from_neighbour_info(
+                    'nn', trg_proj.shape, src_sds,
+                    valid_input_index, valid_output_index,
+                    index_array, fill_value=None)
+
+            if method == 'gauss':
+                sigma = radius_of_influence / 2.
+
+                def weight(distance):
+                    return np.exp(-distance ** 2 / sigma ** 2)
+            else:
+                def weight(distance):
+                    return np.ones_like(distance)
+
+            # pyresample expects one weight function per channel of multi-band data
+            weight_funcs = (weight,) * src_sds.shape[-1] if src_sds.ndim > 2 else weight
+            return get_sample_from_neighbour_info(
+                'custom', trg_proj.shape, src_sds,
+                valid_input_index, valid_output_index,
+                index_array, distance_array=distance_array,
+                weight_funcs=weight_funcs, fill_value=None)
+
+    nprocs = _THREADS['nprocs'] if len(src_sds.shape) > 2 else 1
+    with span('resample', neighbours=False):
+        result = resample_nearest(
+            src_proj, src_sds, trg_proj, fill_value=None,
+            epsilon=epsilon, nprocs=nprocs,
+            radius_of_influence=radius_of_influence)
 
     return result
 
 
-def write_tif(file: str, dataset: np.array, metadata: dict,
-              area_def: AreaDefinition, data_type: str = 'Float32'):
-    """writes out the resampled data into geotiff format
-    https://gdal.org/tutorials/raster_api_tut.html
+def set_cog(**options):
+    """Sets the default Cloud-Optimized GeoTIFF layout of the outputs (see cog_options)
 
     Parameters
     ----------
+    options:
+        compress: str
+            DEFLATE (default), ZSTD (if GDAL is built with it), LZW, ...
+        level: int
+            compression level, None for the GDAL default
+        predictor: bool
+            whether to use the horizontal (Int32) or floating point (Float32) predictor
+        blocksize: int
+            internal tile size in pixels
+        bigtiff: str
+            YES, NO, IF_NEEDED or IF_SAFER
+        overviews: str
+            AUTO, NONE, ... (see the GDAL COG driver)
 
-    file: str
-       target filename to save the tiff file
-    dataset: ndarray
-       3-D array with resampled masked arrays (generated by ma.dstack and resampled with pyresample)
-    metadata: dict
-       attributes of each key (variable) in dataset as well as global attributes
-    area_def: AreaDefinition
-       pyproj data constructed with map_proj containing information about the data projection
+    Returns
+    -------
+        None
+    """
+    unknown = set(options) - set(_COG_OPTIONS)
+    if unknown:
+        raise ValueError(f'unknown COG options: {sorted(unknown)}')
+    _COG_OPTIONS.update(options)
+
+
+def cog_options(data_type: str = 'Float32', **options):
+    """Creation options of the GDAL COG driver
+
+    Parameters
+    ----------
     data_type: str
        data type of the gdal. Either Float32 or Int32 for the case of flags
+    options:
+       overrides of the set_cog defaults
+
     Returns
     -------
-      sds: dict
+        list
+            COG driver creation options
     """
+    options = {**_COG_OPTIONS, **options}
+    compress = f"{options['compress']}".upper()
+    creation = [f'COMPRESS={compress}',
+                f"BLOCKSIZE={options['blocksize']}",
+                f"BIGTIFF={options['bigtiff']}",
+                f"OVERVIEWS={options['overviews']}",
+                f"NUM_THREADS={_THREADS['gdal']}",
+                # flags are bit fields, overviews must not average them
+                f"RESAMPLING={'NEAREST' if data_type in FLAG_TYPES else 'AVERAGE'}"]
+    if options['predictor'] and compress in ('DEFLATE', 'ZSTD', 'LZW', 'LZMA'):
+        # YES selects the horizontal predictor for integers, floating point otherwise
+        creation.append('PREDICTOR=YES')
+    if options['level'] is not None:
+        creation.append(f"LEVEL={options['level']}")
+    return creation
+
+
+def create_tif(file: str, area_def: AreaDefinition, n_bands: int, metadata: dict,
+               data_type: str = 'Float32', driver: str = 'GTiff', options: list = None):
+    """Creates an empty raster on the area_def grid, with georeferencing and global metadata
 
-    driver = gdal.GetDriverByName("GTiff")
-    dtype = gdal.GDT_Float32
-    fill_type = float
-    if data_type == 'Int32':
-        dtype = gdal.GDT_Int32
-        fill_type = int
-    width = area_def.width
-    height = area_def.height
-    glob_attrs = metadata.pop('glob_attrs')
-    n_bands = len(metadata)
+    Parameters
+    ----------
+    file: str
+       target filename ('' for the MEM driver)
+    area_def: AreaDefinition
+       grid of the raster
+    n_bands: int
+       number of bands
+    metadata: dict
+       global metadata (string values)
+    data_type: str
+       gdal data type name, Float32, Int16 (packed, see write_tif) or a flag type (see flag_type)
+    driver: str
+       gdal driver name
+    options: list
+       driver creation options, e.g., ['COMPRESS=LZW', 'TILED=YES']
 
-    # ---------------------
-    # create the output tif
-    # ---------------------
-    trg_dst = driver.Create(file, width, height, n_bands, dtype)
-    meta = {key: f'{val}' for key, val in glob_attrs.items()}
-    trg_dst.SetMetadata(meta)
+    Returns
+    -------
+      gdal.Dataset
+    """
+    dtype = gdal.GetDataTypeByName(data_type)
+    trg_dst = gdal.GetDriverByName(driver).Create(
+        file, area_def.width, area_def.height, n_bands, dtype, options or [])
+    if trg_dst is None:
+        raise RuntimeError(f'could not create {file}: {gdal.GetLastErrorMsg()}')
+    trg_dst.SetMetadata(metadata)
 
     # ------------------------
     # set the affine transform
@@ -725,60 +2151,233 @@ def write_tif(file: str, dataset: np.array, metadata: dict,
     # osr output projection
     # ---------------------
     srs = osr.SpatialReference()
-    srs.ImportFromProj4(area_def.proj_str)
-    srs.SetProjCS(area_def.crs.to_dict()['proj'])
-    srs.SetWellKnownGeogCS("WGS84")
+    if area_def.crs.to_epsg() == 4326:
+        srs.ImportFromEPSG(4326)
+    else:
+        srs.ImportFromProj4(area_def.proj_str)
+        srs.SetProjCS(area_def.crs.to_dict()['proj'])
+        srs.SetWellKnownGeogCS("WGS84")
     trg_dst.SetProjection(srs.ExportToWkt())
+    return trg_dst
 
-    # ---------------------
-    # iterate over the bands
-    # ---------------------
-    for i, name in enumerate(metadata.keys()):
-        band_num = i + 1
 
-        band_meta = metadata[name]
-        try:
-            sds = dataset[:, :, i]
-        except IndexError:
-            sds = dataset
-
-        # -------------------
-        # original fill_value
-        # -------------------
-        if name not in ('l2_flags', 'QA_flag'):
-            band_meta['valid_min'] = sds.min().astype(np.float32)
-            band_meta['valid_max'] = sds.max().astype(np.float32)
-        trg_band = trg_dst.GetRasterBand(band_num)
-        trg_band.SetDescription(name)
-
-        if 'scale_factor' in band_meta.keys():
-            band_meta.pop('scale_factor')
-        if 'add_offset' in band_meta.keys():
-            band_meta.pop('add_offset')
-
-        band_meta = {key: f'{val}' for key, val in band_meta.items()}
-        trg_band.SetMetadata(band_meta)
-        fill_value = band_meta['_FillValue']
-
-        mask = sds.mask.copy()
-        sds[mask] = fill_value
-        sds.mask = mask
-
-        trg_band.SetNoDataValue(fill_type(fill_value))
-        trg_band.WriteArray(sds)
-        trg_band.FlushCache()  # Export data
-
-        meta.update(band_meta)
-    # ------------------
-    # close output image
-    # ------------------
-    trg_dst = None
+def flag_type(attrs: dict):
+    """Smallest unsigned gdal type holding the flag bits, with the type maximum as fill value.
+    The type must have a spare bit, unless the flags already use the type maximum as fill
+    (e.g. SGLI QA_flag Error_DN). Flags defining 32 bits (MODIS l2_flags) stay Int32
+
+    Parameters
+    ----------
+    attrs: dict
+        flag attributes, with flag_meanings (one name per bit) and _FillValue
+
+    Returns
+    -------
+        tuple
+            (gdal data type name, fill value)
+    """
+    nbits = len(f"{attrs['flag_meanings']}".split())
+    fill_value = int(attrs['_FillValue'])
+    for name, bits in (('Byte', 8), ('UInt16', 16), ('UInt32', 32)):
+        top = (1 << bits) - 1
+        if (nbits < bits) or ((nbits == bits) and (fill_value == top)):
+            return name, top
+    return 'Int32', fill_value
+
+
+def pack_band(sds: np.ma.MaskedArray, attrs: dict, log: bool = False):
+    """Encodes a continuous band as int16, value = packed * scale_factor + add_offset.
+    The source encoding is kept when the variable has one (e.g. MODIS Rrs, lossless),
+    otherwise the scale spans the band valid range. A linear scale has a fixed step of
+    (max - min) / 65534, i.e., a large relative error for the low values of log-normal
+    variables (chlor_a from 0.01 to 100 mg m^-3 is rounded to 0.0008 mg m^-3, 8 % of 0.01).
+    With log, log10 of the values is packed, value = 10 ** (packed * scale_factor + add_offset),
+    with a relative error below 0.01 % over the same range
+
+    Parameters
+    ----------
+    sds: np.ma.MaskedArray
+        band values, NaN/inf are treated as masked
+    attrs: dict
+        band attributes, scale_factor and add_offset of the source are used if present
+    log: bool
+        whether to pack log10 of the values (positive variables, see LOG_SCALED). Values
+        not above 0 are set to the smallest positive value of the band
+
+    Returns
+    -------
+        tuple
+            (int16 array with PACKED_FILL for the masked pixels, scale_factor, add_offset, scaling),
+            scaling is linear or log10
+    """
+    values = np.ma.getdata(sds).astype(np.float64, copy=True)
+    mask = np.ma.getmaskarray(sds) | ~np.isfinite(values)
+    source = ('scale_factor' in attrs.keys()) and ('add_offset' in attrs.keys())
+    log = log and not source
+
+    if log:
+        positive = ~mask & (values > 0)
+        floor = values[positive].min() if positive.any() else 1.
+        values[mask] = floor
+        np.maximum(values, floor, out=values)
+        np.log10(values, out=values)
+
+    if source:
+        scale, offset = float(attrs['scale_factor']), float(attrs['add_offset'])
+    else:
+        valid = values[~mask]
+        valid_min, valid_max = (float(valid.min()), float(valid.max())) if valid.size > 0 else (0., 0.)
+        offset = (valid_max + valid_min) / 2.
+        scale = (valid_max - valid_min) / 65534. if valid_max > valid_min else 1.
+
+    # no NaN left for the int16 cast, the masked pixels get PACKED_FILL afterwards
+    values[mask] = offset
+    values -= offset
+    values /= scale
+    np.rint(values, out=values)
+    np.clip(values, -32767, 32767, out=values)
+    packed = values.astype(np.int16)
+    packed[mask] = PACKED_FILL
+    return packed, scale, offset, 'log10' if log else 'linear'
+
+
+def band_attributes(meta: dict, name: str, band_meta: dict):
+    """Adds the attributes of one band to the attributes of a geotif. The band specific ones
+    (BAND_KEYS) are recorded as <name>_<key>, e.g., chlor_a_scale_factor or Rrs_412_FillValue,
+    so the bands of a multi-band geotif keep their own scaling and fill value
+
+    Parameters
+    ----------
+    meta: dict
+        geotif attributes, updated in place
+    name: str
+        band name
+    band_meta: dict
+        band attributes
+
+    Returns
+    -------
+        dict
+            meta
+    """
+    for key, val in band_meta.items():
+        meta[f"{name}_{key.lstrip('_')}" if key in BAND_KEYS else key] = val
+    return meta
+
+
+def write_tif(file: str, dataset: np.array, metadata: dict,
+              area_def: AreaDefinition, data_type: str = 'Float32', cog: bool = False,
+              options: dict = None):
+    """writes out the resampled data into geotiff format
+    https://gdal.org/tutorials/raster_api_tut.html
+
+    Parameters
+    ----------
+
+    file: str
+       target filename to save the tiff file
+    dataset: ndarray
+       3-D array with resampled masked arrays (generated by ma.dstack and resampled with pyresample)
+    metadata: dict
+       attributes of each key (variable) in dataset as well as global attributes
+    area_def: AreaDefinition
+       pyproj data constructed with map_proj containing information about the data projection
+    data_type: str
+       data type of the gdal. Float32, Int16 to pack the continuous bands as scaled integers
+       (see pack_band, the scale_factor/add_offset/scaling are recorded in the band metadata,
+       and as GDAL scale/offset for the linear ones), or a flag type (Int32, or
+       Byte/UInt16/UInt32 from flag_type)
+    cog: bool
+       whether to write a compressed, tiled Cloud-Optimized GeoTIFF with overviews, i.e., the
+       final upload-ready file when area_def is already the target grid (EPSG:4326, see get_adef)
+    options: dict
+       COG layout overrides, e.g., {'compress': 'ZSTD', 'blocksize': 256} (see set_cog)
+    Returns
+    -------
+      dict
+         global attributes and band attributes, the band specific ones per band (see band_attributes)
+    """
+
+    fill_type = float if data_type == 'Float32' else int
+    packing = data_type == 'Int16'
+    glob_attrs = metadata.pop('glob_attrs')
+    meta = {key: f'{val}' for key, val in glob_attrs.items()}
+
+    with span('write_tif', bands=len(metadata), cog=cog):
+        # ---------------------
+        # create the output tif
+        # ---------------------
+        # COG layout is produced by copying a complete in-memory dataset
+        trg_dst = create_tif(file='' if cog else file, area_def=area_def, n_bands=len(metadata),
+                             metadata=meta, data_type=data_type, driver='MEM' if cog else 'GTiff')
+
+        # ---------------------
+        # iterate over the bands
+        # ---------------------
+        for i, name in enumerate(metadata.keys()):
+            band_num = i + 1
+
+            band_meta = metadata[name]
+            try:
+                sds = dataset[:, :, i]
+            except IndexError:
+                sds = dataset
+
+            # -------------------
+            # original fill_value
+            # -------------------
+            if name not in ('l2_flags', 'QA_flag'):
+                band_meta['valid_min'] = sds.min().astype(np.float32)
+                band_meta['valid_max'] = sds.max().astype(np.float32)
+            trg_band = trg_dst.GetRasterBand(band_num)
+            trg_band.SetDescription(name)
+
+            if packing:
+                sds, scale, offset, scaling = pack_band(sds=sds, attrs=band_meta, log=name in LOG_SCALED)
+                band_meta.update(scale_factor=scale, add_offset=offset, scaling=scaling,
+                                 _FillValue=PACKED_FILL)
+                # GDAL scale/offset are linear, log10 bands are decoded from their metadata
+                if scaling == 'linear':
+                    trg_band.SetScale(scale)
+                    trg_band.SetOffset(offset)
+            else:
+                if 'scale_factor' in band_meta.keys():
+                    band_meta.pop('scale_factor')
+                if 'add_offset' in band_meta.keys():
+                    band_meta.pop('add_offset')
+
+            band_meta = {key: f'{val}' for key, val in band_meta.items()}
+            trg_band.SetMetadata(band_meta)
+            fill_value = band_meta['_FillValue']
+
+            if not packing:
+                mask = sds.mask.copy()
+                sds[mask] = fill_value
+                sds.mask = mask
+
+            trg_band.SetNoDataValue(fill_type(fill_value))
+            trg_band.WriteArray(sds)
+            trg_band.FlushCache()  # Export data
+
+            band_attributes(meta=meta, name=name, band_meta=band_meta)
+
+        if cog:
+            cog_dst = gdal.GetDriverByName('COG').CreateCopy(
+                file, trg_dst, options=cog_options(data_type=data_type, **(options or {})))
+            if cog_dst is None:
+                raise RuntimeError(f'COG write failed for {file}: {gdal.GetLastErrorMsg()}')
+            cog_dst = None
+        # ------------------
+        # close output image
+        # ------------------
+        trg_dst = None
     return meta
 
 
 def copy_tif(src_tif: str, dst_tif: str, data):
     """
-        Copy geotif from source file (src_tif) to target file (dst_tif) and updates the data array
+        Copy geotif from source file (src_tif) to target file (dst_tif) and updates the data array.
+        The target is written as a Cloud-Optimized GeoTIFF (see cog_options)
 
         Parameters
         ----------
@@ -797,21 +2396,19 @@ def copy_tif(src_tif: str, dst_tif: str, data):
     # -------------
     src = gdal.Open(src_tif, gdal.GA_ReadOnly)
 
-    # --------------------
-    # geotiff driver/dtype
-    # --------------------
-    driver = gdal.GetDriverByName('GTiff')
+    # ----------------
+    # in memory dtype
+    # ----------------
+    driver = gdal.GetDriverByName('MEM')
     band = src.GetRasterBand(1)
-    dtype = gdal.GDT_Float32
-    if gdal.GetDataTypeName(band.DataType) == 'Int32':
-        dtype = gdal.GDT_Int32
+    data_type = gdal.GetDataTypeName(band.DataType)
+    dtype = gdal.GDT_Int32 if data_type == 'Int32' else gdal.GDT_Float32
 
     # -----------
     # raster copy
     # -----------
-    trg = driver.Create(dst_tif, src.RasterXSize,
-                        src.RasterYSize, 1,
-                        dtype, ['COMPRESS=LZW'])
+    trg = driver.Create('', src.RasterXSize,
+                        src.RasterYSize, 1, dtype)
 
     # --------
     # metadata
@@ -833,16 +2430,45 @@ def copy_tif(src_tif: str, dst_tif: str, data):
     trg_band.WriteArray(data)
     trg_band.FlushCache()
 
+    cog_dst = gdal.GetDriverByName('COG').CreateCopy(
+        dst_tif, trg, options=cog_options(data_type=data_type))
+    if cog_dst is None:
+        raise RuntimeError(f'COG write failed for {dst_tif}: {gdal.GetLastErrorMsg()}')
+
     # -------
     # closing
     # -------
-    trg = None
+    trg = src = cog_dst = None
     return trg
 
 
+@contextmanager
+def gdal_config(**options):
+    """Temporarily sets GDAL configuration options, restoring the previous values on exit
+
+    Parameters
+    ----------
+    options:
+        GDAL configuration options, e.g., GDAL_NUM_THREADS='ALL_CPUS'
+
+    Returns
+    -------
+        None
+    """
+    previous = {key: gdal.GetConfigOption(key) for key in options}
+    for key, val in options.items():
+        gdal.SetConfigOption(key, None if val is None else f'{val}')
+    try:
+        yield
+    finally:
+        for key, val in previous.items():
+            gdal.SetConfigOption(key, val)
+
+
 def gdal_translate(src_tif: str, dst_tif: str, nodata,
-                   ot: str = 'Float32', trg_proj: str = 'EPSG:4326'):
-    """Gdal Warping/Translate
+                   ot: str = 'Float32', trg_proj: str = 'EPSG:4326',
+                   num_threads=None, warp_memory: int = 512, multithread: bool = True):
+    """Gdal Warping/Translate, in-process (gdal.Warp to an in-memory VRT, then gdal.Translate)
     gdalwarp available resampling methods:
     near (default), bilinear, cubic, cubicspline, lanczos, average, mode,  max, min, med, Q1, Q3, sum.\n
     gdalwarp -r resampling_method
@@ -851,15 +2477,23 @@ def gdal_translate(src_tif: str, dst_tif: str, nodata,
     Parameters
     ----------
     src_tif: str
-        source file being reprojected
+        source file being reprojected, it can be a /vsimem/ file (see write_tif). Deleted afterwards
     dst_tif: str
         target file after reprojected
-    nodata: int | float
-        fill_values
+    nodata: int | float | list
+        fill_values, either one for all bands or one per band. If None, the nodata
+        values of the source bands are used
     trg_proj: str
         target projection name
     ot: str
         data type for the gdalwarp command
+    num_threads: int | str
+        number of threads used for warping and compression (GDAL_NUM_THREADS), e.g., 4 or ALL_CPUS.
+        Defaults to the process thread budget (see set_num_threads)
+    warp_memory: int
+        warp memory limit in MB (gdalwarp -wm)
+    multithread: bool
+        whether to warp and read/write the data in parallel threads (gdalwarp -multi)
 
     Returns
     -------
@@ -867,31 +2501,43 @@ def gdal_translate(src_tif: str, dst_tif: str, nodata,
             path to the gdal projected geotif file
     """
 
+    init_dest = nodata
+    if isinstance(nodata, (list, tuple)):
+        nodata = ' '.join(f'{val}' for val in nodata)
+        init_dest = 'NO_DATA'
+    if nodata is None:
+        init_dest = 'NO_DATA'
+    if num_threads is None:
+        num_threads = _THREADS['gdal']
+
     # --------------
     # WARP/TRANSLATE
     # --------------
-    cmd = 'gdalwarp ' \
-          f'-t_srs {trg_proj} ' \
-          f'-srcnodata "{nodata}" ' \
-          f'-dstnodata "{nodata}" ' \
-          f'-wo INIT_DEST={nodata} ' \
-          '-co "PREDICTOR=2" ' \
-          '-co "tiled=yes" ' \
-          f'-ot {ot} ' \
-          f'-of vrt {src_tif} ' \
-          '/vsistdout/ | ' \
-          'gdal_translate ' \
-          '-co compress=lzw ' \
-          f'/vsistdin/ {dst_tif}'
-
-    os.system(cmd)
+    with gdal_config(GDAL_NUM_THREADS=num_threads), span('warp', ot=ot):
+        vrt = gdal.Warp('', src_tif,
+                        format='VRT',
+                        dstSRS=trg_proj,
+                        srcNodata=nodata,
+                        dstNodata=nodata,
+                        outputType=gdal.GetDataTypeByName(ot),
+                        warpOptions=[f'INIT_DEST={init_dest}', f'NUM_THREADS={num_threads}'],
+                        warpMemoryLimit=warp_memory,
+                        multithread=multithread)
+        if vrt is None:
+            raise RuntimeError(f'gdal.Warp failed for {src_tif}: {gdal.GetLastErrorMsg()}')
+
+        # the warped VRT is streamed into the final COG (tiles, overviews, compression)
+        trg = gdal.Translate(dst_tif, vrt, format='COG', creationOptions=cog_options(data_type=ot))
+        if trg is None:
+            raise RuntimeError(f'gdal.Translate failed for {dst_tif}: {gdal.GetLastErrorMsg()}')
+        trg = vrt = None
 
     # --------------------
     # Get rid of input tif
     # --------------------
-    fdir = os.path.dirname(src_tif)
-    bsn = os.path.basename(src_tif)
-    cmd = f'del /f {bsn}' if os.name == 'nt' else f'rm -f {bsn}'
-    subprocess.call(cmd, cwd=fdir, shell=True)
+    if src_tif.startswith('/vsimem/'):
+        gdal.Unlink(src_tif)
+    elif os.path.isfile(src_tif):
+        os.remove(src_tif)
 
     return dst_tif
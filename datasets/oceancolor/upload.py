@@ -0,0 +1,385 @@
+# Copyright 2021 The Google Earth Engine Community Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Upload and EE ingestion stage of the produced geotifs
+
+The outputs are queued as they are produced (bounded queue, processing blocks when the
+uploads fall behind), uploaded by a pool of threads and ingested in batches of manifests,
+with retries and exponential backoff. The storage/ingestion service is a Backend:
+EarthEngineBackend (GCS + EE ingestion) or LocalBackend, a local filesystem stand-in to
+test the throughput offline.
+
+    python driver.py 'data/*.h5' --upload local --upload-dir uploads
+"""
+
+import abc
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+from datetime import timezone
+
+try:
+    import ee
+    from google.cloud import storage
+except ImportError:
+    ee = storage = None
+
+
+def to_seconds(value):
+    """Seconds since 1970-01-01 UTC of a datetime (naive is taken as UTC)"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def get_manifest(output: dict, uri: str, asset_id: str):
+    """EE image ingestion manifest of an output geotif
+
+    Parameters
+    ----------
+    output: dict
+        output of process_granule or composite_day (file, var_name, attributes with the
+        <band>_FillValue of each band, start, end)
+    uri: str
+        uploaded geotif (see Backend.upload)
+    asset_id: str
+        image collection the image is ingested into
+
+    Returns
+    -------
+        dict
+            ingestion manifest, the image is named after the geotif
+    """
+    attributes = dict(output['attributes'])
+    name = os.path.basename(output['file']).split('.')[0]
+    bands = []
+    for i, var in enumerate(output['var_name']):
+        band = {'id': var, 'tileset_id': '0', 'tileset_band_index': i}
+        # each band has its own fill value, e.g., 0 for the count of a composite (see band_attributes)
+        missing_value = attributes.get(f'{var}_FillValue')
+        if missing_value is not None:
+            band['missing_data'] = {'values': [float(missing_value)]}
+        bands.append(band)
+    return {'name': f'{asset_id}/{name}',
+            'tilesets': [{'id': '0', 'sources': [{'uris': [uri]}]}],
+            'bands': bands,
+            'start_time': {'seconds': to_seconds(output['start'])},
+            'end_time': {'seconds': to_seconds(output['end'])},
+            'properties': {key: f'{val}' for key, val in attributes.items()}}
+
+
+def file_stamp(file: str):
+    """Size and modification time of a file, a rewritten output gets a new stamp"""
+    stat = os.stat(file)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def ingested(log: str):
+    """Outputs whose ingestion was started according to an upload log (see UploadStage)
+
+    Parameters
+    ----------
+    log: str
+        upload log, one <geotif>|<stamp>|<ok or failed>|<task id or error> line per output
+
+    Returns
+    -------
+        set
+            (geotif, stamp) of the outputs with a task id
+    """
+    done = set()
+    if (log is None) or not os.path.isfile(log):
+        return done
+    with open(log) as txt:
+        for line in txt:
+            fields = line.rstrip('\n').split('|', 3)
+            if (len(fields) == 4) and (fields[2] == 'ok'):
+                done.add((fields[0], fields[1]))
+    return done
+
+
+def retry(func, *args, retries: int = 4, backoff: float = 2., **kwargs):
+    """Calls func, retrying on any error with exponential backoff and jitter
+
+    Parameters
+    ----------
+    func: callable
+        function to be called with args and kwargs
+    retries: int
+        number of retries after the first attempt
+    backoff: float
+        delay before the first retry (s), doubled at each retry
+
+    Returns
+    -------
+        result of func, the last error is raised once the retries are exhausted
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * random.uniform(.5, 1.5))
+
+
+class Backend(abc.ABC):
+    """Storage and ingestion service of the upload stage. upload is called from several
+    threads at once, ingest from one thread at a time"""
+
+    @abc.abstractmethod
+    def upload(self, file: str):
+        """Uploads a geotif
+
+        Parameters
+        ----------
+        file: str
+            local geotif
+
+        Returns
+        -------
+            str
+                uri of the uploaded file
+        """
+
+    @abc.abstractmethod
+    def ingest(self, manifests: list):
+        """Starts the ingestion of a batch of images
+
+        Parameters
+        ----------
+        manifests: list
+            ingestion manifests (see get_manifest)
+
+        Returns
+        -------
+            list
+                task id of each manifest
+        """
+
+
+class LocalBackend(Backend):
+    """Local filesystem stand-in: files are copied to <root>/bucket and each ingestion batch
+    is written as JSON lines to <root>/ingest. latency (s) simulates the service round trip
+
+    Parameters
+    ----------
+    root: str
+        directory of the uploads
+    latency: float
+        delay added to each upload and ingestion call (s)
+    """
+
+    def __init__(self, root: str, latency: float = 0.):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        for sub in ('bucket', 'ingest'):
+            os.makedirs(f'{self.root}/{sub}', exist_ok=True)
+
+    def upload(self, file: str):
+        time.sleep(self.latency)
+        dst = f'{self.root}/bucket/{os.path.basename(file)}'
+        # copy then rename, a failed upload leaves no partial file behind
+        shutil.copyfile(file, f'{dst}.part')
+        os.replace(f'{dst}.part', dst)
+        return dst
+
+    def ingest(self, manifests: list):
+        time.sleep(self.latency)
+        batch = f'{self.root}/ingest/{time.strftime("%Y%m%dT%H%M%S")}_{time.perf_counter_ns()}.jsonl'
+        with open(batch, 'w') as txt:
+            for manifest in manifests:
+                txt.write(json.dumps(manifest) + '\n')
+        name = os.path.basename(batch).split('.')[0]
+        return [f'{name}_{i}' for i in range(len(manifests))]
+
+
+class EarthEngineBackend(Backend):
+    """Google Cloud Storage upload and Earth Engine ingestion (requires earthengine-api and
+    google-cloud-storage, with the credentials of an initialized EE session)
+
+    Parameters
+    ----------
+    bucket: str
+        GCS bucket, gs://<bucket>
+    prefix: str
+        object name prefix in the bucket
+    """
+
+    def __init__(self, bucket: str, prefix: str = ''):
+        if ee is None:
+            raise ImportError('the EE upload requires earthengine-api and google-cloud-storage')
+        ee.Initialize()
+        self.name = bucket.replace('gs://', '').strip('/')
+        self.prefix = prefix.strip('/')
+        self.local = threading.local()
+
+    def upload(self, file: str):
+        # one client per thread, the GCS client is not thread safe
+        if not hasattr(self.local, 'bucket'):
+            self.local.bucket = storage.Client().bucket(self.name)
+        blob_name = '/'.join(filter(None, (self.prefix, os.path.basename(file))))
+        self.local.bucket.blob(blob_name).upload_from_filename(file)
+        return f'gs://{self.name}/{blob_name}'
+
+    def ingest(self, manifests: list):
+        task_ids = ee.data.newTaskId(len(manifests))
+        for task_id, manifest in zip(task_ids, manifests):
+            ee.data.startIngestion(task_id, manifest, allow_overwrite=True)
+        return task_ids
+
+
+class UploadStage:
+    """Uploads and ingests the outputs in the background while processing carries on
+
+    Parameters
+    ----------
+    backend: Backend
+        storage and ingestion service
+    asset_id: str
+        image collection the images are ingested into
+    workers: int
+        number of concurrent uploads
+    queue_size: int
+        outputs waiting for upload, submit blocks when the queue is full
+    batch_size: int
+        manifests per ingestion call
+    retries: int
+        retries of a failed upload/ingestion (see retry)
+    backoff: float
+        delay before the first retry (s)
+    log: str
+        upload log, one <geotif>|<stamp>|<ok or failed>|<task id or error> line per output.
+        The outputs it records as ingested are not submitted again, so a rerun uploads the
+        outputs of an interrupted run, including those the processing manifest skips
+
+    Examples
+    --------
+    >>> with UploadStage(backend=LocalBackend(root='uploads'), asset_id='users/me/sgli') as stage:
+    ...     for output in process_granule(...):
+    ...         stage.submit(output=output)
+    """
+
+    def __init__(self, backend: Backend, asset_id: str, workers: int = 4, queue_size: int = 16,
+                 batch_size: int = 10, retries: int = 4, backoff: float = 2., log: str = None):
+        self.backend = backend
+        self.asset_id = asset_id
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.log = log
+        self.ingested = ingested(log=log)
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.ingest_lock = threading.Lock()
+        self.pending = []
+        self.results = []
+        self.threads = [threading.Thread(target=self._work, name=f'upload-{i}', daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, output: dict):
+        """Queues an output for upload and ingestion, blocking while the queue is full.
+        Outputs already ingested (same file, size and modification time, see log) are skipped
+
+        Parameters
+        ----------
+        output: dict
+            output of process_granule (file, var_name, attributes, start, end)
+
+        Returns
+        -------
+            bool
+                whether the output was queued
+        """
+        file = os.path.abspath(output['file'])
+        stamp = file_stamp(file=file)
+        if (file, stamp) in self.ingested:
+            return False
+        self.queue.put({**output, 'file': file, 'stamp': stamp})
+        return True
+
+    def close(self):
+        """Waits for the queued uploads and ingests the last (partial) batch
+
+        Returns
+        -------
+            list
+                (geotif, task id or None, error or None) of each output
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._ingest(batch=self._take(size=0))
+        return self.results
+
+    def _take(self, size: int):
+        """Takes the pending manifests if there are at least size of them"""
+        with self.lock:
+            if len(self.pending) < max(size, 1):
+                return []
+            batch, self.pending = self.pending, []
+        return batch
+
+    def _work(self):
+        while True:
+            output = self.queue.get()
+            if output is None:
+                break
+            try:
+                uri = retry(self.backend.upload, output['file'], retries=self.retries, backoff=self.backoff)
+                manifest = get_manifest(output=output, uri=uri, asset_id=self.asset_id)
+            except Exception as err:
+                self._done(files=[(output['file'], output['stamp'])], task_ids=[None],
+                           error=f'{type(err).__name__}: {err}')
+                continue
+            with self.lock:
+                self.pending.append(((output['file'], output['stamp']), manifest))
+            self._ingest(batch=self._take(size=self.batch_size))
+
+    def _ingest(self, batch: list):
+        if not batch:
+            return
+        files, manifests = zip(*batch)
+        try:
+            # one ingestion call at a time, the backends are not required to be thread safe there
+            with self.ingest_lock:
+                task_ids = retry(self.backend.ingest, list(manifests), retries=self.retries, backoff=self.backoff)
+            self._done(files=files, task_ids=task_ids)
+        except Exception as err:
+            self._done(files=files, task_ids=[None] * len(files), error=f'{type(err).__name__}: {err}')
+
+    def _done(self, files: list, task_ids: list, error: str = None):
+        with self.lock:
+            results = [(file, task_id, error) for (file, _), task_id in zip(files, task_ids)]
+            self.results.extend(results)
+            if self.log is not None:
+                with open(self.log, 'a') as txt:
+                    for (file, stamp), task_id in zip(files, task_ids):
+                        status = 'failed' if task_id is None else 'ok'
+                        detail = task_id or f'{error}'.replace('\n', ' ')
+                        txt.write(f'{file}|{stamp}|{status}|{detail}\n')